@@ -0,0 +1,196 @@
+""" Approximate nearest neighbour (IVF) index over movie plot embeddings """
+
+import time
+import numpy as np
+from similarity import top_k
+
+
+def _assign(vectors, centroids, chunk_size=8192):
+    """index of the most similar centroid for every vector, computed in chunks"""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        block = vectors[start : start + chunk_size] @ centroids.T
+        labels[start : start + chunk_size] = block.argmax(axis=1)
+    return labels
+
+
+def spherical_kmeans(vectors, n_clusters, n_iter=20, seed=42):
+    """
+    k-means for unit length vectors using cosine similarity, returns unit length
+    centroids of shape (n_clusters, n_dims)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        ### re-seed empty clusters with random vectors so that no list is wasted
+        empty = np.bincount(labels, minlength=n_clusters) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index: movies are grouped into `n_lists` clusters (k-means coarse
+    quantizer), a query is scored exactly only against the movies of the `n_probe`
+    clusters closest to it. More probes mean higher recall but slower search.
+    """
+
+    def __init__(self, engine, centroids, offsets, rows):
+        self.engine = engine
+        self.centroids = centroids
+        ### movies of list `i` are rows[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.rows = rows
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, engine, n_lists=None, n_iter=20, sample_size=50_000, seed=42):
+        """
+        build the index over the normalized matrix of a `SimilarityEngine`, k-means is
+        fitted on a random sample of at most `sample_size` movies
+        """
+        vectors = engine.matrix
+        n = len(vectors)
+        if n_lists is None:
+            ### common rule of thumb, ~4 * sqrt(n) lists
+            n_lists = max(1, int(4 * np.sqrt(n)))
+        n_lists = min(n_lists, n)
+
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if n > sample_size:
+            sample = vectors[np.sort(rng.choice(n, sample_size, replace=False))]
+        centroids = spherical_kmeans(sample, n_lists, n_iter=n_iter, seed=seed)
+
+        ### assign every movie to its list and store the lists contiguously
+        return cls._from_labels(engine, centroids, _assign(vectors, centroids))
+
+    @classmethod
+    def _from_labels(cls, engine, centroids, labels):
+        """index with every movie stored in the list of its label"""
+        rows = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=len(centroids)))
+        return cls(engine, centroids, offsets, rows)
+
+    def update(self, engine, previous_rows):
+        """
+        index over the updated embeddings of `engine` keeping the centroids, where
+        `previous_rows` (see `manifest.row_mapping`) gives for every movie its row in
+        the indexed corpus or -1 when it is new or its plot changed. only those
+        movies are assigned to a list, the others stay in theirs. rebuild the index
+        once the corpus has drifted far from the centroids
+        """
+        previous_labels = np.empty(len(self.rows), dtype=np.int32)
+        previous_labels[self.rows] = np.repeat(
+            np.arange(self.n_lists, dtype=np.int32), np.diff(self.offsets)
+        )
+        kept = previous_rows >= 0
+        labels = np.empty(len(engine), dtype=np.int32)
+        labels[kept] = previous_labels[previous_rows[kept]]
+        labels[~kept] = _assign(engine.matrix[np.flatnonzero(~kept)], self.centroids)
+        return self._from_labels(engine, self.centroids, labels)
+
+    def _probe_rows(self, query, n_probe):
+        """rows of all movies in the `n_probe` lists closest to the query"""
+        lists, _ = top_k(self.centroids @ query, n_probe)
+        return np.concatenate(
+            [self.rows[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+        )
+
+    def search_vector(
+        self, query, k, n_probe=8, exclude=None, min_score=None, mask=None
+    ):
+        """
+        approximate top `k` movies for a unit length query vector, `exclude` is a
+        row to leave out of the results and `mask` a boolean bitmap over all rows,
+        probed movies not set in it are dropped before scoring (post-filtering).
+        returns (corpus row indices, scores)
+        """
+        candidates = self._probe_rows(query, n_probe)
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        scores = self.engine.matrix[candidates] @ query
+        if exclude is not None:
+            exclude = np.flatnonzero(candidates == exclude)
+        idx, top_scores = top_k(scores, k, exclude=exclude, min_score=min_score)
+        return candidates[idx], top_scores
+
+    def search(
+        self, query_index, k, n_probe=8, exclude_query=True, min_score=None, mask=None
+    ):
+        """approximate counterpart of `SimilarityEngine.most_similar`"""
+        return self.search_vector(
+            self.engine.matrix[query_index],
+            k,
+            n_probe=n_probe,
+            exclude=query_index if exclude_query else None,
+            min_score=min_score,
+            mask=mask,
+        )
+
+    def save(self, file_name):
+        """persist the index (not the embeddings) as a numpy .npz file"""
+        np.savez(
+            file_name,
+            centroids=self.centroids,
+            offsets=self.offsets,
+            rows=self.rows,
+            n_movies=len(self.engine),
+        )
+
+    @classmethod
+    def load(cls, file_name, engine):
+        """load an index saved by `save` and attach it to the given embeddings"""
+        with np.load(file_name) as data:
+            if int(data["n_movies"]) != len(engine):
+                raise ValueError(
+                    f"Index [{file_name}] was built for {int(data['n_movies'])} movies "
+                    f"but embeddings have {len(engine)}, please rebuild the index"
+                )
+            return cls(engine, data["centroids"], data["offsets"], data["rows"])
+
+
+def recall_report(
+    index, k=5, n_probe_values=(1, 2, 4, 8, 16, 32), n_queries=200, seed=42
+):
+    """
+    compare the index against exact search on randomly picked movies, returns a list
+    of dicts with recall@k and mean per-query latency (ms) for every `n_probe` value
+    """
+    engine = index.engine
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(engine), min(n_queries, len(engine)), replace=False)
+
+    ### exact (brute-force) results are the ground truth
+    start = time.perf_counter()
+    exact = [set(engine.most_similar(q, k)[0]) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for n_probe in n_probe_values:
+        if n_probe > index.n_lists:
+            break
+        start = time.perf_counter()
+        found = [index.search(q, k, n_probe=n_probe)[0] for q in queries]
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(truth.intersection(rows)) for truth, rows in zip(exact, found))
+        report.append(
+            {
+                "n_probe": n_probe,
+                f"recall@{k}": hits / (k * len(queries)),
+                "ann_ms": ann_ms,
+                "exact_ms": exact_ms,
+                "speed_up": exact_ms / ann_ms if ann_ms > 0 else float("inf"),
+            }
+        )
+    return report
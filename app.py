@@ -1,8 +1,17 @@
+import time
+
+### start of this page's imports, the first run in a process reports how long they
+### took (see `instrumentation.page_imported`)
+IMPORT_START = time.perf_counter()
+
 import streamlit as st
 from st_pages import show_pages_from_config, add_page_title
+from instrumentation import page_imported, page_rendered
+from warmup import warm_up_app
 
 
-# @st.cache_data
+### the markup is plain markdown rendered by the browser, read once per process
+@st.cache_data
 def _load_markup():
     with open("artifacts/about_markup_main.txt", "r") as f_main:
         main_section = f_main.read()
@@ -39,6 +48,11 @@ def about_the_app():
 
 
 if __name__ == "__main__":
+    page_imported("app", IMPORT_START)
+    ### imports & artifacts of the other pages are loaded in the background, the
+    ### landing page is usually the first one rendered by a new process
+    warm_up_app()
     ### setup page title
     init(title="Movie Buddy", icon="🎥")
     about_the_app()
+    page_rendered("app")
@@ -0,0 +1,134 @@
+"""
+Clusters of the movie embeddings computed offline (`preprocessing/build_clusters.py`)
+and used at query time to diversify recommendations, so that sequels, remakes and
+other near-duplicates don't fill the whole top-k, and as a coarse routing layer
+(the clusters are the lists of an IVF index, see `ann_index.py`)
+"""
+
+import numpy as np
+from ann_index import IVFIndex, _assign
+
+
+def minibatch_spherical_kmeans(
+    vectors, n_clusters, batch_size=4096, n_iter=100, seed=42
+):
+    """
+    mini-batch k-means for unit length vectors using cosine similarity: every
+    iteration reads only `batch_size` random rows (which may be memory-mapped) and
+    moves their centroids towards them by the share of the rows seen so far.
+    returns unit length centroids of shape (n_clusters, n_dims)
+    """
+    rng = np.random.default_rng(seed)
+    init = np.sort(rng.choice(len(vectors), n_clusters, replace=False))
+    centroids = np.array(vectors[init], dtype=np.float32)
+    seen = np.zeros(n_clusters, dtype=np.float64)
+    for _ in range(n_iter):
+        batch = np.sort(rng.choice(len(vectors), min(batch_size, len(vectors))))
+        batch = np.asarray(vectors[batch], dtype=np.float32)
+        labels = _assign(batch, centroids)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, batch)
+        ### running mean of the rows assigned to every centroid
+        moved = counts > 0
+        seen[moved] += counts[moved]
+        rate = (counts[moved] / seen[moved])[:, None]
+        means = sums[moved] / counts[moved][:, None]
+        centroids[moved] += (rate * (means - centroids[moved])).astype(np.float32)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids /= norms
+    return centroids
+
+
+class MovieClusters:
+    """
+    Cluster of every movie (`labels`) and the unit length `centroids`, built once
+    offline and shared read-only by every user session
+    """
+
+    def __init__(self, centroids, labels):
+        self.centroids = centroids
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def n_clusters(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, engine, n_clusters=None, batch_size=4096, n_iter=100, seed=42):
+        """clusters of the normalized matrix of a `SimilarityEngine`"""
+        vectors = engine.matrix
+        if n_clusters is None:
+            ### small clusters group a movie with its closest relatives only
+            n_clusters = max(1, int(4 * np.sqrt(len(vectors))))
+        n_clusters = min(n_clusters, len(vectors))
+        centroids = minibatch_spherical_kmeans(
+            vectors, n_clusters, batch_size=batch_size, n_iter=n_iter, seed=seed
+        )
+        return cls(centroids, _assign(vectors, centroids))
+
+    def update(self, engine, previous_rows):
+        """
+        clusters of the updated embeddings of `engine` keeping the centroids, only
+        movies that are new or whose plot changed (`previous_rows` -1, see
+        `manifest.row_mapping`) are assigned to a cluster
+        """
+        kept = previous_rows >= 0
+        labels = np.empty(len(engine), dtype=np.int32)
+        labels[kept] = self.labels[previous_rows[kept]]
+        labels[~kept] = _assign(engine.matrix[np.flatnonzero(~kept)], self.centroids)
+        return MovieClusters(self.centroids, labels)
+
+    def as_index(self, engine):
+        """IVF index with one list per cluster over the given embeddings"""
+        return IVFIndex._from_labels(engine, self.centroids, self.labels)
+
+    def save(self, file_name):
+        """persist the clusters as a numpy .npz file"""
+        np.savez(file_name, centroids=self.centroids, labels=self.labels)
+
+    @classmethod
+    def load(cls, file_name, n_movies):
+        """load clusters saved by `save`, built for a catalog of `n_movies`"""
+        with np.load(file_name) as data:
+            if len(data["labels"]) != n_movies:
+                raise ValueError(
+                    f"Clusters [{file_name}] were built for {len(data['labels'])} "
+                    f"movies but embeddings have {n_movies}, please rebuild them"
+                )
+            return cls(data["centroids"], data["labels"])
+
+
+def diversify(scores, similarities, k, diversity=0.3, labels=None, per_cluster=None):
+    """
+    greedy maximal marginal relevance re-ranking of a candidate pool of p movies
+    sorted by `scores` (similarity to the query), `similarities` is their (p, p)
+    pairwise similarity matrix: every pick maximizes `(1 - diversity) * score -
+    diversity * highest similarity to the movies already picked`. with cluster
+    `labels` at most `per_cluster` movies of a cluster are picked, as long as other
+    clusters have candidates left. O(k * p) work, returns the positions picked
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    redundancy = np.zeros(len(scores))
+    available = np.ones(len(scores), dtype=bool)
+    ### number of movies picked from the cluster of every candidate
+    taken = np.zeros(len(scores), dtype=np.int64)
+    picked = []
+    for _ in range(min(k, len(scores))):
+        gain = (1 - diversity) * scores - diversity * redundancy
+        gain[~available] = -np.inf
+        if labels is not None and per_cluster is not None:
+            quota_gain = np.where(taken >= per_cluster, -np.inf, gain)
+            if np.isfinite(quota_gain).any():
+                gain = quota_gain
+        best = int(np.argmax(gain))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarities[best])
+        if labels is not None:
+            taken[labels == labels[best]] += 1
+    return np.array(picked, dtype=np.int64)
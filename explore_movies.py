@@ -1,37 +1,114 @@
-import re
+import time
+
+### start of this page's imports, the first run in a process reports how long they
+### took (see `instrumentation.page_imported`)
+IMPORT_START = time.perf_counter()
+
+import importlib.util
 import numpy as np
 import streamlit as st
-import pandas as pd
-import pyarrow.parquet as pq
-from sklearn.metrics.pairwise import cosine_similarity
-
-### For cloud deployment make it "false" due to its large-size, "True" for local run
-USE_TFIDF = False
+from instrumentation import (
+    page_imported,
+    page_rendered,
+    render_timing_panel,
+    start_metrics_server,
+    start_trace,
+    timed,
+    timing_requested,
+)
+from movie_store import load_movie_store
+from query_encoder import QueryEncoder, search_by_description
+from recommender import candidate_bitmap, recommend
+from title_index import TitleIndex
+from warmup import warm_up, warm_up_app
+
+### TF-IDF embeddings are stored & scored sparse hence cheap enough to deploy, the
+### option is shown only if `artifacts/tfidf_embeddings.npz` was generated
+USE_TFIDF = True
+### Use the approximate (IVF) index built by `preprocessing/build_ann_index.py` for
+### unfiltered recommendations and for filters that keep a large enough share of the
+### catalog (see `filtered_search.py`), worth it only once the catalog is large
+USE_ANN_INDEX = False
+### number of index lists scanned per query, higher is more accurate but slower
+ANN_N_PROBE = 8
+### Score SBERT with a compact encoding built by `preprocessing/quantize_embeddings.py`
+### ("float16", "int8" or "pq") to fit larger catalogs in memory, None for float32
+SBERT_ENCODING = None
+### number of compact matches per recommendation re-ranked on exact vectors
+RERANK = 4
+### Diversified recommendations leave out near-duplicates (sequels, remakes...): the
+### weight of the similarity to movies already recommended against the similarity to
+### the movie, and the most movies recommended from one of the clusters built by
+### `preprocessing/build_clusters.py` (used when the clusters were built)
+USE_CLUSTERS = True
+DIVERSITY = 0.3
+CLUSTER_QUOTA = 2
+### Score recommendations in a pool of worker processes attached to one shared copy
+### of the embeddings (see `shared_store.py`), keeps the page responsive under
+### concurrent load on a multi-core server. None workers means all cores
+USE_WORKER_POOL = False
+N_WORKERS = None
+### Free-text "describe a movie" search, the SBERT model is loaded once per process,
+### the option is shown only if the `sentence-transformers` package is installed
+USE_QUERY_SEARCH = True
+### number of distinct queries whose vectors are cached
+QUERY_CACHE_SIZE = 1024
 
 ####
 #### FUNCTIONS
 ####
 
 
-# @st.cache_data(persist="disk")
+@timed("load_data")
+@st.cache_resource
 def _load_data():
-    """Load the parquet file with plots, TF-IDF & BERT vector"""
-    ### read the movie plot into a dataframe
-    df = pd.read_parquet("artifacts/movie_plots.parquet")
-    ### load the sbert embedding data and combine it with movie dataframe
-    sbert_embeddings = (
-        pq.read_table("artifacts/sbert_embeddings.parquet").to_pandas().to_numpy()
+    """
+    Load the movie plots, TF-IDF & BERT vectors once per process, the returned store
+    is read-only and shared by all user sessions
+    """
+    return load_movie_store(
+        "artifacts",
+        use_tfidf=USE_TFIDF,
+        use_ann_index=USE_ANN_INDEX,
+        sbert_encoding=SBERT_ENCODING,
+        rerank=RERANK,
+        use_clusters=USE_CLUSTERS,
     )
-    df["sbert"] = list(sbert_embeddings)
-    ### load TF-IDF only if flag is True (i.e. running app locally)
-    if USE_TFIDF:
-        tfidf_embeddings = (
-            pq.read_table("artifacts/tfidf_embeddings.parquet").to_pandas().to_numpy()
-        )
-        ## combine it with movie dataframe
-        df["tfidf"] = list(tfidf_embeddings)
 
-    return df
+
+@timed("load_worker_pool")
+@st.cache_resource
+def _load_pool():
+    """
+    start the scoring processes once per process and share the embeddings with them,
+    None when the pool is disabled
+    """
+    if not USE_WORKER_POOL:
+        return None
+    ### multiprocessing & shared memory, only imported when the pool is used
+    from shared_store import ScoringPool
+
+    return ScoringPool(_load_data(), N_WORKERS)
+
+
+@timed("load_title_index")
+@st.cache_resource
+def _load_title_index():
+    """index of the movie titles, built on the first search and shared by all sessions"""
+    return TitleIndex(_load_data().titles)
+
+
+@st.cache_resource
+def _load_query_encoder():
+    """SBERT query encoder & its query cache, shared by all user sessions"""
+    return QueryEncoder(cache_size=QUERY_CACHE_SIZE)
+
+
+def _query_search_enabled():
+    return (
+        USE_QUERY_SEARCH
+        and importlib.util.find_spec("sentence_transformers") is not None
+    )
 
 
 def _reset():
@@ -40,12 +117,14 @@ def _reset():
     i.e. remove all forms and filters load full data and start from page 1.
     this callback is used by sidebar "Reset" button and main page "Clear" button
     """
-    st.session_state["data"] = st.session_state["orig_data"]
+    st.session_state["rows"] = range(len(_load_data()))
     st.session_state["curr_page"] = 0
-    st.session_state["last_page"] = len(st.session_state["data"]) - 1
+    st.session_state["last_page"] = len(st.session_state["rows"]) - 1
     st.session_state["filter"] = ""
-    st.session_state["cosine_similarity"] = pd.Series(dtype="float64")
+    st.session_state["filter_rows"] = None
+    st.session_state["scores"] = None
     st.session_state["recommended"] = False
+    st.session_state["query_timing"] = None
     st.experimental_rerun()
 
 
@@ -64,25 +143,32 @@ def init(title, icon):
     col2.image("images/logo.png", width=100)
     st.divider()
 
-    ### load data & initialize session state
-    df = _load_data()
-    if "data" not in st.session_state:
-        st.session_state["data"] = df
-        # backup the original data-frame, required if we need to reset filter
-        st.session_state["orig_data"] = df.copy()
+    ### load data & initialize session state, scoring workers start with the first
+    ### session rather than on its first recommendation
+    store = _load_data()
+    _load_pool()
+    if "rows" not in st.session_state:
+        # a session only keeps the store rows of the movies it shows, a range for all
+        # movies hence no copy of the data is needed to reset the filter
+        st.session_state["rows"] = range(len(store))
         st.session_state["curr_page"] = 0
-        st.session_state["last_page"] = len(st.session_state["data"]) - 1
+        st.session_state["last_page"] = len(st.session_state["rows"]) - 1
         st.session_state["filter"] = ""
-        st.session_state["cosine_similarity"] = pd.Series(dtype="float64")
+        ### rows of the title filter, kept apart as recommendations replace `rows`
+        st.session_state["filter_rows"] = None
+        st.session_state["scores"] = None
         st.session_state["recommended"] = False
+        st.session_state["query_timing"] = None
 
 
+@timed("render_page")
 def render_page():
     """
     main page UI rendering and content display functionality
     """
     ### render prev, next buttons and page no
-    df = st.session_state["data"]
+    store = _load_data()
+    rows = st.session_state["rows"]
     (
         prev,
         next,
@@ -109,77 +195,73 @@ def render_page():
     page_no.write(f"Page {curr_page+1} of {last_page + 1}")
 
     ### render movie content: title, url, plot
-    title = df.loc[curr_page, "title"]
+    row = rows[curr_page]
+    title = store.titles[row]
     st.subheader(title)
     ## if we are showing the recommended movies then also show the similarity score
-    if not st.session_state["cosine_similarity"].empty:
-        score = st.session_state["cosine_similarity"][curr_page]
+    if st.session_state["scores"] is not None:
+        score = float(st.session_state["scores"][curr_page])
         score = f"ℹ️ Movie similarity Score: {str(round(score, 12))} [min: 0, max: 1.0]"
         st.info(score)
-    st.write(df.loc[curr_page, "url"])
+    st.write(store.urls[row])
 
     ### render the movie recommendation panel as an expander
     ### initially remains collapsed
     def _render_recommend_panel():
-        def __recommend_movies(curr_movie_index, df, k, embed):
+        def __recommend_movies(
+            curr_movie_index, rows, k, embed, years=None, diverse=False
+        ):
             """
             get the recommended movies refreshes the page to show them
             """
-            df_matches = __get_similar_movies(
-                movie_index=curr_movie_index, df=df, k=k, use_embed=embed
+            match_rows, scores = __get_similar_movies(
+                movie_index=curr_movie_index,
+                rows=rows,
+                k=k,
+                use_embed=embed,
+                years=years,
+                diverse=diverse,
             )
-            ### Reset the index so that pages can be displayed correctly
-            df_matches = df_matches.reset_index()
-            # set recommended movie df as the active dataframe and re-fresh the page
-            st.session_state["data"] = df_matches[["title", "url", "plot"]]
+            # set recommended movie rows as the active rows and re-fresh the page
+            st.session_state["rows"] = match_rows
             st.session_state["curr_page"] = 0
-            st.session_state["last_page"] = len(st.session_state["data"]) - 1
-            st.session_state["cosine_similarity"] = df_matches["score"]
+            st.session_state["last_page"] = len(st.session_state["rows"]) - 1
+            st.session_state["scores"] = scores
             st.session_state["recommended"] = True
             st.experimental_rerun()
 
-        def __get_similar_movies(movie_index, df, k, use_embed="sbert"):
+        @timed("get_similar_movies")
+        def __get_similar_movies(
+            movie_index, rows, k, use_embed="sbert", years=None, diverse=False
+        ):
             """
             helper function
             get the associated movie plot embed vectors for the given movie index
-            and whole corpus, calculate similarity score and return a dataframe
-            containing only similar movies as recommendation
+            and whole corpus, calculate similarity score and return the store rows
+            and scores of only similar movies as recommendation
             """
-            search_vector = df.loc[movie_index, use_embed]
-            corpus_vectors = df[use_embed].values
-
-            ### Calculate the similarity score for given movie against whole corpus of movies
-            scores = __get_similarity_scores(search_vector, corpus_vectors)
-
-            ### Sort the scores in descending order and grab the sorted indices
-            ### and return a dataframe containing `k` matching movies in order of similarity,
+            ### score against the whole corpus unless data is filtered down to a subset
+            ### (title filter and/or release years), given as a bitmap over the store
+            candidates = candidate_bitmap(store, rows=rows, years=years)
+            ### `k` matching movies in order of similarity,
             ### first one will always be the movie we are searching for
-            sorted_idx = np.flip(scores.argsort())[:k]
-            df_matches = df.iloc[sorted_idx].copy().drop("index", axis=1)
-            df_matches["score"] = scores[sorted_idx]
-            return df_matches
-
-        def __get_similarity_scores(search_vector, corpus_vectors):
-            """
-            helper function
-            compute the cosine similarity between a given vector vs all
-            corpus vectors
-            """
-            scores = []
-            ### function expect 2D array (n_samples, n_features)
-            search_vector = search_vector.reshape(1, -1)
-            for corpus_vector in corpus_vectors:
-                corpus_vector = corpus_vector.reshape(1, -1)
-                score = cosine_similarity(search_vector, corpus_vector)
-                ### just extract and store the scalar score
-                scores.append(score[0][0])
-            return np.array(scores)
+            return recommend(
+                store,
+                rows[movie_index],
+                k,
+                embed=use_embed,
+                candidates=candidates,
+                n_probe=ANN_N_PROBE,
+                diversity=DIVERSITY if diverse else 0.0,
+                per_cluster=CLUSTER_QUOTA if diverse else None,
+                pool=_load_pool(),
+            )
 
         with st.expander("Get Similar Movie Recommendations...", expanded=False):
             with st.form(key="recommend"):
                 col1, col2 = st.columns(2)
-                ### TF-IDF is True only for local run
-                if USE_TFIDF:
+                ### TF-IDF is available only if its embeddings were generated
+                if "tfidf" in store.engines:
                     options = ["SBERT", "TFIDF"]
                     help_text = """TF-IDF: A simple algorithm to convert text 
                             into vectors, quick but accuracy is low.
@@ -198,26 +280,105 @@ def render_page():
                     max_value=5,
                     step=1,
                 )
+                ### release years are available only if the crawl recorded them
+                years = None
+                if store.years is not None and store.years.min() < store.years.max():
+                    first, last = int(store.years.min()), int(store.years.max())
+                    years = col2.slider(
+                        label="Released Between:",
+                        min_value=first,
+                        max_value=last,
+                        value=(first, last),
+                        step=1,
+                    )
+                    if years == (first, last):
+                        years = None
+                diverse = col1.checkbox(
+                    label="Diversify",
+                    help="Leave out near-duplicates such as sequels and remakes",
+                )
                 if col1.form_submit_button(label="Recommend Movies"):
                     __recommend_movies(
                         curr_movie_index=st.session_state["curr_page"],
-                        df=st.session_state["data"],
-                        k=k + 1,
+                        rows=st.session_state["rows"],
+                        k=k,
                         embed=embed_type.lower(),
+                        years=years,
+                        diverse=diverse,
                     )
 
             if st.button("Clear Recommendations"):
                 if st.session_state["recommended"] == True:
                     _reset()
 
-    ## invoke the func
+    ### render the free-text search panel as an expander, initially collapsed
+    def _render_describe_panel():
+        @timed("describe_search")
+        def __search_movies(description, filter_rows, k):
+            """
+            get the movies best matching a description and refresh the page to show them
+            """
+            ### search the whole corpus unless a title filter is applied, the movies
+            ### shown after a recommendation are not a filter
+            candidates = None if filter_rows is None else np.asarray(filter_rows)
+            match_rows, scores, timing = search_by_description(
+                store.engines["sbert"],
+                _load_query_encoder(),
+                description,
+                k,
+                candidates=candidates,
+                ann_index=store.ann_indexes.get("sbert"),
+                n_probe=ANN_N_PROBE,
+            )
+            if len(match_rows) == 0:
+                st.error("⛔ No matches found, please try again.")
+                return
+            st.session_state["rows"] = match_rows
+            st.session_state["curr_page"] = 0
+            st.session_state["last_page"] = len(st.session_state["rows"]) - 1
+            st.session_state["scores"] = scores
+            st.session_state["recommended"] = True
+            st.session_state["query_timing"] = timing
+            st.experimental_rerun()
+
+        with st.expander("Describe a Movie...", expanded=False):
+            with st.form(key="describe"):
+                description = st.text_area(
+                    label="Movie description:",
+                    placeholder="e.g. a heist in space that goes wrong",
+                    max_chars=500,
+                ).strip()
+                k = st.slider(
+                    label="Number of Matches Requested:",
+                    min_value=1,
+                    max_value=10,
+                    value=5,
+                    step=1,
+                )
+                if st.form_submit_button(label="Find Movies") and len(description) > 0:
+                    __search_movies(description, st.session_state["filter_rows"], k)
+
+            ## time spent on the last query, the model is loaded on the first one
+            timing = st.session_state["query_timing"]
+            if timing is not None:
+                cached = " (cached)" if timing["cached"] else ""
+                st.caption(
+                    f"Query encoded in {timing['encode_ms']:.1f} ms{cached}, "
+                    f"{timing['n_searched']} movies searched "
+                    f"({timing['strategy']}) in {timing['search_ms']:.1f} ms"
+                )
+
+    ## invoke the funcs
     _render_recommend_panel()
+    if _query_search_enabled():
+        _render_describe_panel()
 
     ## show movie plot text
-    st.write(df.loc[curr_page, "plot"].replace("$", "\$"))
+    st.write(store.plots[row].replace("$", "\$"))
     st.divider()
 
 
+@timed("render_sidebar")
 def render_sidebar():
     """
     sidebar UI rendering and event handling/callback functionality
@@ -238,6 +399,7 @@ def render_sidebar():
                 st.session_state["curr_page"] = input_page_no - 1
                 st.experimental_rerun()
 
+    @timed("title_search")
     def _search_by_title(search_string):
         """
         filter the data to show only pages that match with search title
@@ -249,19 +411,20 @@ def render_sidebar():
             st.sidebar.error(err_msg)
             search_string = ""
 
-        ## ensure there is a search string entered, then filter the df by matches
+        ## ensure there is a search string entered, then filter the rows by matches,
+        ## best matching titles first (words may be incomplete or have a typo)
         if len(search_string) > 0:
-            df = st.session_state["data"]
-            df_filtered = df[
-                df["title"].str.contains(search_string, flags=re.IGNORECASE, regex=True)
-            ].copy()
+            matched = _load_title_index().search(
+                search_string, rows=st.session_state["rows"]
+            )
             ## if matches found
-            if len(df_filtered) > 0:
+            if len(matched) > 0:
                 st.session_state["filter"] = search_string
-                # set filtered df as active dataframe and re-fresh the page
-                st.session_state["data"] = df_filtered.reset_index()
+                st.session_state["filter_rows"] = matched
+                # set filtered rows as active rows and re-fresh the page
+                st.session_state["rows"] = matched
                 st.session_state["curr_page"] = 0
-                st.session_state["last_page"] = len(st.session_state["data"]) - 1
+                st.session_state["last_page"] = len(st.session_state["rows"]) - 1
                 st.experimental_rerun()
             ## if no matches found
             else:
@@ -308,11 +471,25 @@ def render_sidebar():
 #### MAIN APP FLOW
 ####
 
+### time this rerun when asked for, see `instrumentation.py`
+page_imported("explore", IMPORT_START)
+start_trace("explore", timing_requested())
+start_metrics_server()
+### imports & artifacts of the other pages are loaded in the background
+warm_up_app()
+
 ### initialize page title, icon, app data and session_state
 init(title="Movie Buddy", icon="🎥")
+### load the SBERT model in the background before the first free-text search
+if _query_search_enabled():
+    warm_up("query_encoder", _load_query_encoder().load)
 
 ### build page UI and show content
 render_page()
 
 ### build page sidebar UI and show content
 render_sidebar()
+page_rendered("explore")
+
+### show where the time of this rerun went, only when timed
+render_timing_panel()
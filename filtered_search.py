@@ -0,0 +1,116 @@
+""" Similarity search restricted to a subset of the movies (filters) """
+
+import numpy as np
+
+### index search is used on a subset only when the probed lists are expected to hold
+### at least this many times `k` candidates, otherwise the subset is scored directly
+MIN_HITS_FACTOR = 4
+
+
+def as_candidates(candidates, n):
+    """
+    (bitmap, rows) of a subset of the `n` movies given either as a boolean bitmap of
+    length `n` or as a list of row ids (e.g. the rows of a title search), rows are
+    sorted & unique. (None, None) when the subset is the whole corpus
+    """
+    if candidates is None:
+        return None, None
+    candidates = np.asarray(candidates)
+    if candidates.dtype == bool:
+        if len(candidates) != n:
+            raise ValueError(
+                f"Candidate bitmap has {len(candidates)} entries but there are "
+                f"{n} movies"
+            )
+        mask = candidates
+    else:
+        mask = np.zeros(n, dtype=bool)
+        mask[candidates.astype(np.int64)] = True
+    rows = np.flatnonzero(mask)
+    if len(rows) == n:
+        return None, None
+    return mask, rows
+
+
+def choose_strategy(n, n_candidates, k, ann_index=None, n_probe=8):
+    """
+    how to search `n_candidates` out of `n` movies:
+    * "exact": the whole corpus, scored as one matrix-vector product
+    * "index": the whole corpus, approximately with the IVF index
+    * "subset": only the candidate rows are scored (brute force over the subset)
+    * "filtered-index": the IVF index lists are probed and the probed movies that
+      aren't candidates are dropped before scoring (post-filtering)
+    index search on a subset pays off when it scores fewer movies than the subset
+    itself and enough candidates are expected in the probed lists to fill `k`
+    """
+    if n_candidates is None:
+        return "exact" if ann_index is None else "index"
+    if ann_index is None:
+        return "subset"
+    expected_probed = n * min(n_probe, ann_index.n_lists) / ann_index.n_lists
+    expected_hits = expected_probed * n_candidates / n
+    if expected_probed < n_candidates and expected_hits >= MIN_HITS_FACTOR * k:
+        return "filtered-index"
+    return "subset"
+
+
+def filtered_search(
+    engine,
+    k,
+    query_index=None,
+    vector=None,
+    candidates=None,
+    ann_index=None,
+    n_probe=8,
+    exclude_query=True,
+):
+    """
+    top `k` movies most similar to the movie at `query_index` or to a unit length
+    `vector`, only among `candidates` (bitmap or row ids, see `as_candidates`) of the
+    whole store, without copying any embeddings. the strategy is picked from the
+    selectivity of the subset (see `choose_strategy`), a filtered index search that
+    finds fewer than `k` matches probes more lists and falls back to scoring the
+    subset. returns (corpus row indices, scores, strategy)
+    """
+    mask, rows = as_candidates(candidates, len(engine))
+    n_candidates = None if rows is None else len(rows)
+    strategy = choose_strategy(len(engine), n_candidates, k, ann_index, n_probe)
+
+    if strategy == "index":
+        if query_index is not None:
+            top_rows, top_scores = ann_index.search(
+                query_index, k, n_probe=n_probe, exclude_query=exclude_query
+            )
+        else:
+            top_rows, top_scores = ann_index.search_vector(vector, k, n_probe=n_probe)
+        return top_rows, top_scores, strategy
+
+    if strategy == "filtered-index":
+        if query_index is not None:
+            vector = ann_index.engine.matrix[query_index]
+        exclude = query_index if exclude_query else None
+        ### the query movie itself can't fill a slot
+        wanted = min(k, n_candidates - int(exclude is not None and mask[exclude]))
+        while True:
+            top_rows, top_scores = ann_index.search_vector(
+                vector, k, n_probe=n_probe, exclude=exclude, mask=mask
+            )
+            if len(top_rows) >= wanted:
+                return top_rows, top_scores, strategy
+            ### too few candidates in the probed lists, probe twice as many
+            n_probe *= 2
+            if (
+                n_probe >= ann_index.n_lists
+                or choose_strategy(len(engine), n_candidates, k, ann_index, n_probe)
+                != "filtered-index"
+            ):
+                break
+        strategy = "subset"
+
+    if query_index is not None:
+        top_rows, top_scores = engine.most_similar(
+            query_index, k, candidates=rows, exclude_query=exclude_query
+        )
+    else:
+        top_rows, top_scores = engine.most_similar_vector(vector, k, candidates=rows)
+    return top_rows, top_scores, strategy
@@ -0,0 +1,339 @@
+"""
+Lightweight timing & counters around the hot path of the app, off unless asked for:
+set the `MOVIE_BUDDY_TIMING=1` environment variable (every rerun of every session
+and the HTTP service) or open a page with `?timing=1` (that session only). Every
+timed stage of a page rerun is listed in a sidebar panel along with the memory used,
+logged as one JSON line per rerun (`movie_buddy.timing` logger) and accumulated
+process-wide for the Prometheus text format, served on the port given by the
+`MOVIE_BUDDY_METRICS_PORT` environment variable (and on `/metrics` by `service.py`).
+The cold start of every page (imports & first render in a fresh process) is always
+recorded, it is logged and exported along with the other metrics.
+"""
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENV_VAR = "MOVIE_BUDDY_TIMING"
+QUERY_PARAM = "timing"
+METRICS_PORT_ENV_VAR = "MOVIE_BUDDY_METRICS_PORT"
+### always on for every session, otherwise only for sessions asking for it
+ALWAYS_ON = os.environ.get(ENV_VAR, "").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger("movie_buddy.timing")
+
+
+class Metrics:
+    """process-wide number of calls & time spent per stage and event counters"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.max_seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.calls[stage] += 1
+            self.seconds[stage] += seconds
+            self.max_seconds[stage] = max(self.max_seconds[stage], seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def prometheus(self):
+        """all metrics in the Prometheus text exposition format"""
+        with self.lock:
+            stages = sorted(self.calls)
+            lines = [
+                "# HELP movie_buddy_stage_calls_total Number of calls of a stage",
+                "# TYPE movie_buddy_stage_calls_total counter",
+                *[
+                    f'movie_buddy_stage_calls_total{{stage="{s}"}} {self.calls[s]}'
+                    for s in stages
+                ],
+                "# HELP movie_buddy_stage_seconds_total Time spent in a stage",
+                "# TYPE movie_buddy_stage_seconds_total counter",
+                *[
+                    f'movie_buddy_stage_seconds_total{{stage="{s}"}} '
+                    f"{self.seconds[s]:.6f}"
+                    for s in stages
+                ],
+                "# HELP movie_buddy_stage_max_seconds Slowest call of a stage",
+                "# TYPE movie_buddy_stage_max_seconds gauge",
+                *[
+                    f'movie_buddy_stage_max_seconds{{stage="{s}"}} '
+                    f"{self.max_seconds[s]:.6f}"
+                    for s in stages
+                ],
+                "# HELP movie_buddy_events_total Number of events",
+                "# TYPE movie_buddy_events_total counter",
+                *[
+                    f'movie_buddy_events_total{{name="{name}"}} {n}'
+                    for name, n in sorted(self.counters.items())
+                ],
+            ]
+        report = startup_report()
+        lines += [
+            "# HELP movie_buddy_page_import_seconds Imports of a page's first run",
+            "# TYPE movie_buddy_page_import_seconds gauge",
+            *[
+                f'movie_buddy_page_import_seconds{{page="{page}"}} '
+                f"{entry['import_ms'] / 1000:.6f}"
+                for page, entry in report.items()
+            ],
+            "# HELP movie_buddy_page_first_render_seconds First render of a page",
+            "# TYPE movie_buddy_page_first_render_seconds gauge",
+            *[
+                f'movie_buddy_page_first_render_seconds{{page="{page}"}} '
+                f"{entry['first_render_ms'] / 1000:.6f}"
+                for page, entry in report.items()
+                if entry["first_render_ms"] is not None
+            ],
+        ]
+        lines += [
+            "# HELP movie_buddy_resident_memory_bytes Resident memory of the process",
+            "# TYPE movie_buddy_resident_memory_bytes gauge",
+            f"movie_buddy_resident_memory_bytes {int(memory_mb() * 2**20)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+### trace of the page rerun running in this thread (Streamlit runs a session's
+### script in its own thread), None when that rerun isn't timed
+_local = threading.local()
+
+
+def _active():
+    return ALWAYS_ON or getattr(_local, "trace", None) is not None
+
+
+def _record(stage, seconds):
+    METRICS.observe(stage, seconds)
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace["stages"].append((stage, seconds * 1000))
+
+
+@contextmanager
+def timer(stage):
+    """time the enclosed block as `stage`, even when it raises (e.g. a rerun)"""
+    if not _active():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    """decorator timing every call of a function as `stage`"""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _active():
+                return fn(*args, **kwargs)
+            with timer(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, n=1):
+    """increment an event counter when timing is on"""
+    if _active():
+        METRICS.count(name, n)
+
+
+def memory_mb():
+    """resident memory of the process, the peak where the current isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        ### kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def start_trace(page, enabled):
+    """
+    start timing a rerun of `page` in this thread, when `enabled`. a rerun still
+    being timed was interrupted (e.g. by `st.experimental_rerun` after a button
+    click), it is finished and kept as the interrupted trace of this thread
+    """
+    _local.interrupted = finish_trace(interrupted=True)
+    if enabled or ALWAYS_ON:
+        _local.trace = {"page": page, "start": time.perf_counter(), "stages": []}
+
+
+def finish_trace(interrupted=False):
+    """
+    stop timing the rerun of this thread, log it and return it as a dict with the
+    stages (name, ms) in order of completion, total time (ms) & memory (MB), None
+    when the rerun wasn't timed
+    """
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    if trace is None:
+        return None
+    total = time.perf_counter() - trace.pop("start")
+    METRICS.observe(f"{trace['page']}_rerun", total)
+    trace["total_ms"] = total * 1000
+    trace["memory_mb"] = memory_mb()
+    trace["interrupted"] = interrupted
+    logger.info(json.dumps(trace))
+    return trace
+
+
+####
+#### COLD START
+####
+
+### first run of every page in this process, see `page_imported`
+_startup = {}
+_startup_lock = threading.Lock()
+
+
+def page_imported(page, start):
+    """
+    record how long the imports of the first run of `page` in this process took,
+    `start` being `time.perf_counter()` before them (later runs find the modules
+    already imported)
+    """
+    with _startup_lock:
+        if page not in _startup:
+            _startup[page] = {"start": start, "imported": time.perf_counter()}
+
+
+def page_rendered(page):
+    """record the end of the first complete render of `page` in this process"""
+    with _startup_lock:
+        entry = _startup.get(page)
+        if entry is None or "rendered" in entry:
+            return
+        entry["rendered"] = time.perf_counter()
+    logger.info(json.dumps({"page": page, "cold_start": startup_report()[page]}))
+
+
+def startup_report():
+    """
+    page -> imports (ms) and first render (ms, imports included, None until done)
+    of the first run of every page in this process
+    """
+    with _startup_lock:
+        return {
+            page: {
+                "import_ms": (entry["imported"] - entry["start"]) * 1000,
+                "first_render_ms": (
+                    (entry["rendered"] - entry["start"]) * 1000
+                    if "rendered" in entry
+                    else None
+                ),
+            }
+            for page, entry in _startup.items()
+        }
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server_lock = threading.Lock()
+_metrics_server = None
+
+
+def start_metrics_server(port=None):
+    """
+    serve the metrics in a background thread on `port` (by default the one in the
+    `MOVIE_BUDDY_METRICS_PORT` environment variable, not served when unset), once
+    per process however many times it is called
+    """
+    global _metrics_server
+    port = port or os.environ.get(METRICS_PORT_ENV_VAR)
+    if not port:
+        return
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer(
+                ("127.0.0.1", int(port)), _MetricsHandler
+            )
+            threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+
+
+####
+#### STREAMLIT
+####
+
+
+def timing_requested():
+    """whether this session asked for timing with the `?timing=1` query param"""
+    if ALWAYS_ON:
+        return True
+    import streamlit as st
+
+    value = st.experimental_get_query_params().get(QUERY_PARAM, ["0"])[-1]
+    return value.lower() in ("1", "true", "yes")
+
+
+def _stage_table(trace):
+    rows = "\n".join(f"| {stage} | {ms:.2f} |" for stage, ms in trace["stages"])
+    return f"| stage | ms |\n|---|---:|\n{rows}"
+
+
+def render_timing_panel():
+    """
+    finish the trace of this rerun and show it in a sidebar debug panel, along with
+    the rerun before it: the one that was interrupted to start this one (where
+    e.g. the recommendations were computed) or else the previous rerun's total.
+    nothing is shown when the rerun isn't timed
+    """
+    interrupted = getattr(_local, "interrupted", None)
+    _local.interrupted = None
+    trace = finish_trace()
+    if trace is None:
+        return
+    import streamlit as st
+
+    previous = st.session_state.get("timing_previous")
+    with st.sidebar.expander("⏱️ Timing", expanded=True):
+        st.caption(
+            f"This rerun: {trace['total_ms']:.1f} ms, "
+            f"memory: {trace['memory_mb']:.0f} MB"
+        )
+        st.markdown(_stage_table(trace))
+        cold_start = startup_report().get(trace["page"])
+        if cold_start is not None and cold_start["first_render_ms"] is not None:
+            st.caption(
+                f"Cold start of this page: imports {cold_start['import_ms']:.0f} ms, "
+                f"first render {cold_start['first_render_ms']:.0f} ms"
+            )
+        if interrupted is not None:
+            st.caption(f"Rerun that triggered it: {interrupted['total_ms']:.1f} ms")
+            st.markdown(_stage_table(interrupted))
+        elif previous is not None:
+            st.caption(f"Previous rerun: {previous['total_ms']:.1f} ms")
+    st.session_state["timing_previous"] = trace
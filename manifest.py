@@ -0,0 +1,133 @@
+"""
+Manifest of the generated artifacts: which version of the movie corpus every
+embedding, neighbour table & index was built from, so that stale artifacts are
+detected and updated incrementally instead of regenerated from scratch
+"""
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+MANIFEST_FILE = "manifest.json"
+### snapshot of the (movie id, plot hash) of every row, one file per corpus version
+KEYS_DIR = "corpus_keys"
+
+
+def plot_keys(urls, plots):
+    """
+    key of every movie row: a stable movie id (its Wikipedia URL) and a hash of its
+    plot text, returned as a dataframe with `movie_id` & `plot_hash` columns
+    """
+    plot_hash = [hashlib.sha1(plot.encode("utf-8")).hexdigest()[:16] for plot in plots]
+    return pd.DataFrame({"movie_id": list(urls), "plot_hash": plot_hash})
+
+
+def corpus_version(keys):
+    """short hash of all the row keys in order, changes with any added/edited movie"""
+    digest = hashlib.sha1()
+    for movie_id, plot_hash in zip(keys["movie_id"], keys["plot_hash"]):
+        digest.update(f"{movie_id}\t{plot_hash}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def row_mapping(old_keys, new_keys):
+    """
+    for every row of `new_keys` the row of `old_keys` with the same movie id and plot
+    hash, -1 for a new or changed movie (whose embedding must be computed)
+    """
+    old_rows = {
+        key: row
+        for row, key in enumerate(zip(old_keys["movie_id"], old_keys["plot_hash"]))
+    }
+    return np.array(
+        [
+            old_rows.get(key, -1)
+            for key in zip(new_keys["movie_id"], new_keys["plot_hash"])
+        ],
+        dtype=np.int64,
+    )
+
+
+def load_manifest(artifacts_dir):
+    """the manifest as a dict, an empty one when it hasn't been written yet"""
+    file_name = os.path.join(artifacts_dir, MANIFEST_FILE)
+    if not os.path.exists(file_name):
+        return {"corpus": None, "artifacts": {}}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def _save_manifest(artifacts_dir, manifest):
+    """write the manifest atomically and drop key snapshots no longer referenced"""
+    file_name = os.path.join(artifacts_dir, MANIFEST_FILE)
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(file_name + ".tmp", file_name)
+
+    versions = {manifest["corpus"]}
+    versions.update(entry["corpus"] for entry in manifest["artifacts"].values())
+    keys_dir = os.path.join(artifacts_dir, KEYS_DIR)
+    if os.path.isdir(keys_dir):
+        for name in os.listdir(keys_dir):
+            if name.endswith(".parquet") and name[: -len(".parquet")] not in versions:
+                os.remove(os.path.join(keys_dir, name))
+
+
+def save_corpus_keys(artifacts_dir, keys):
+    """snapshot the row keys and make them the current corpus, returns its version"""
+    version = corpus_version(keys)
+    os.makedirs(os.path.join(artifacts_dir, KEYS_DIR), exist_ok=True)
+    keys.to_parquet(os.path.join(artifacts_dir, KEYS_DIR, f"{version}.parquet"))
+    manifest = load_manifest(artifacts_dir)
+    manifest["corpus"] = version
+    _save_manifest(artifacts_dir, manifest)
+    return version
+
+
+def load_corpus_keys(artifacts_dir, version):
+    """row keys of a corpus version, None when there is no snapshot of it"""
+    file_name = os.path.join(artifacts_dir, KEYS_DIR, f"{version}.parquet")
+    if version is None or not os.path.exists(file_name):
+        return None
+    return pd.read_parquet(file_name)
+
+
+def record_artifact(artifacts_dir, name, version, **info):
+    """record that artifact `name` (file name) was built from corpus `version`"""
+    manifest = load_manifest(artifacts_dir)
+    manifest["artifacts"][name] = {
+        "corpus": version,
+        "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        **info,
+    }
+    _save_manifest(artifacts_dir, manifest)
+
+
+def artifact_version(manifest, name):
+    """corpus version an artifact was built from, None if it isn't recorded"""
+    entry = manifest["artifacts"].get(name)
+    return entry["corpus"] if entry else None
+
+
+def artifact_rows(artifacts_dir, manifest, name):
+    """
+    `row_mapping` from the corpus an artifact was built from to the current corpus,
+    None when either isn't known (the artifact must be regenerated)
+    """
+    previous_keys = load_corpus_keys(artifacts_dir, artifact_version(manifest, name))
+    keys = load_corpus_keys(artifacts_dir, manifest["corpus"])
+    if previous_keys is None or keys is None:
+        return None
+    return row_mapping(previous_keys, keys)
+
+
+def is_current(manifest, name):
+    """
+    whether an artifact belongs with the current corpus, artifacts that aren't
+    recorded (generated before the manifest existed) are assumed to be
+    """
+    version = artifact_version(manifest, name)
+    return version is None or version == manifest["corpus"]
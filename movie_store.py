@@ -0,0 +1,212 @@
+""" Process-wide, read-only store of the movie catalog and its embeddings """
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from similarity import SimilarityEngine, SparseSimilarityEngine, load_sparse_embeddings
+from ann_index import IVFIndex
+from clusters import MovieClusters
+from quantization import load_quantized
+from neighbors import load_neighbors
+from manifest import is_current, load_manifest
+
+
+def _read_only(values):
+    """own copy of the given column as a numpy array that can't be modified"""
+    values = np.array(values)
+    values.setflags(write=False)
+    return values
+
+
+class MovieStore:
+    """
+    Immutable movie catalog meant to be loaded once per process and shared by every
+    user session. Movie metadata is kept as read-only arrays and embeddings as one
+    2-D matrix per embedding type, so sessions only need to remember row numbers.
+    """
+
+    def __init__(
+        self,
+        titles,
+        urls,
+        plots,
+        engines,
+        ann_indexes=None,
+        tables=None,
+        years=None,
+        clusters=None,
+    ):
+        self.titles = _read_only(titles)
+        self.urls = _read_only(urls)
+        self.plots = _read_only(plots)
+        ### release year of every movie, None for data collected without it
+        self.years = None if years is None else _read_only(years)
+        ### embedding type ("sbert"/"tfidf") -> SimilarityEngine
+        self.engines = engines
+        ### embedding type -> IVFIndex, only when enabled
+        self.ann_indexes = ann_indexes or {}
+        ### embedding type -> (neighbors, scores) precomputed top-N table
+        self.neighbor_tables = tables or {}
+        ### embedding type -> MovieClusters, used to diversify recommendations
+        self.clusters = clusters or {}
+
+    def __len__(self):
+        return len(self.titles)
+
+    def in_years(self, first, last):
+        """boolean bitmap of the movies released from year `first` to `last`"""
+        return (self.years >= first) & (self.years <= last)
+
+
+def _load_embeddings(file_name):
+    """load an embeddings parquet file as a 2-D numpy array"""
+    return pq.read_table(file_name).to_pandas().to_numpy()
+
+
+def embeddings_file(artifacts_dir, embed):
+    """file `load_engine` loads the embeddings of `embed` from, None when none exist"""
+    file_name = os.path.join(artifacts_dir, f"{embed}_embeddings")
+    for extension in [".npz", ".npy", ".parquet"]:
+        if os.path.exists(file_name + extension):
+            return file_name + extension
+    return None
+
+
+def load_engine(artifacts_dir, embed):
+    """
+    similarity engine for one embedding type, looks for (in order of preference)
+    * `.npz` sparse CSR embeddings (TF-IDF), scored sparse end to end
+    * `.npy` dense embeddings (rows already unit length) which are memory-mapped:
+      nothing is copied at startup, only the pages actually touched are read and the
+      OS page cache is shared by all worker processes
+    * `.parquet` dense embeddings
+    raises FileNotFoundError when none of them exist
+    """
+    file_name = embeddings_file(artifacts_dir, embed)
+    if file_name is None:
+        raise FileNotFoundError(f"No [{embed}] embeddings found in [{artifacts_dir}]")
+    if file_name.endswith(".npz"):
+        return SparseSimilarityEngine(load_sparse_embeddings(file_name))
+    if file_name.endswith(".npy"):
+        return SimilarityEngine(np.load(file_name, mmap_mode="r"), normalized=True)
+    return SimilarityEngine(_load_embeddings(file_name))
+
+
+def _current(manifest, file_name):
+    """whether an optional artifact exists and belongs with the current embeddings"""
+    if not os.path.exists(file_name):
+        return False
+    if not is_current(manifest, os.path.basename(file_name)):
+        print(f"Ignoring [{file_name}], it was built for another version of the corpus")
+        return False
+    return True
+
+
+def _load_optional(file_name, load, *args, **kwargs):
+    """
+    `load(file_name, ...)` of an optional artifact, None when it doesn't fit the
+    embeddings (e.g. built for another catalog size), the app starts without it
+    """
+    try:
+        return load(file_name, *args, **kwargs)
+    except ValueError as e:
+        print(f"Ignoring [{file_name}], {e}")
+        return None
+
+
+def _load_neighbor_tables(artifacts_dir, engines, manifest):
+    """
+    load the top-N neighbour table per embedding type generated by
+    `preprocessing/generate_neighbors.py`, where available and current
+    """
+    tables = {}
+    for embed, engine in engines.items():
+        file_name = os.path.join(artifacts_dir, f"{embed}_neighbors.parquet")
+        if _current(manifest, file_name):
+            neighbors, scores = load_neighbors(file_name)
+            ### a table generated for a different catalog can't be used
+            if len(neighbors) == len(engine):
+                tables[embed] = (neighbors, scores)
+    return tables
+
+
+def load_movie_store(
+    artifacts_dir="artifacts",
+    use_tfidf=False,
+    use_ann_index=False,
+    sbert_encoding=None,
+    rerank=4,
+    use_clusters=False,
+):
+    """
+    Load the movie plots, TF-IDF & BERT vectors and derived artifacts from disk.
+    `sbert_encoding` ("float16", "int8" or "pq") scores SBERT with a compact encoding
+    written by `preprocessing/quantize_embeddings.py`, the best `k * rerank` matches
+    are re-ranked on the (memory-mapped) exact vectors, `rerank=0` disables it.
+    `use_clusters` loads the SBERT clusters of `preprocessing/build_clusters.py`,
+    which also serve as the ANN index when none was built.
+    Optional artifacts the manifest says were built for another version of the corpus,
+    or that don't fit the embeddings (e.g. another catalog size), are left out
+    """
+    manifest = load_manifest(artifacts_dir)
+    plots_file = os.path.join(artifacts_dir, "movie_plots.parquet")
+    columns = ["title", "url", "plot"]
+    ### the release year is only recorded by newer runs of `collect_data.py`
+    if "year" in pq.read_schema(plots_file).names:
+        columns.append("year")
+    df = pd.read_parquet(plots_file, columns=columns)
+    exact = load_engine(artifacts_dir, "sbert")
+    engines = {"sbert": exact}
+    encoding_file = os.path.join(
+        artifacts_dir, f"sbert_embeddings_{sbert_encoding}.npz"
+    )
+    if sbert_encoding is not None and _current(manifest, encoding_file):
+        loaded = _load_optional(
+            encoding_file,
+            load_quantized,
+            exact=exact if rerank else None,
+            rerank=rerank,
+        )
+        if loaded is not None:
+            engines["sbert"] = loaded
+    ### TF-IDF embeddings are optional, skip them if they were not generated
+    if use_tfidf:
+        try:
+            tfidf = load_engine(artifacts_dir, "tfidf")
+            ### the file actually loaded, `.npz` or a dense fallback
+            tfidf_file = os.path.basename(embeddings_file(artifacts_dir, "tfidf"))
+            if is_current(manifest, tfidf_file):
+                engines["tfidf"] = tfidf
+            else:
+                print("Ignoring TF-IDF embeddings, built for another corpus version")
+        except FileNotFoundError:
+            pass
+
+    clusters = {}
+    clusters_file = os.path.join(artifacts_dir, "sbert_clusters.npz")
+    if use_clusters and _current(manifest, clusters_file):
+        loaded = _load_optional(clusters_file, MovieClusters.load, len(exact))
+        if loaded is not None:
+            clusters["sbert"] = loaded
+
+    ann_indexes = {}
+    index_file = os.path.join(artifacts_dir, "sbert_ivf_index.npz")
+    if use_ann_index and _current(manifest, index_file):
+        loaded = _load_optional(index_file, IVFIndex.load, exact)
+        if loaded is not None:
+            ann_indexes["sbert"] = loaded
+    if use_ann_index and "sbert" not in ann_indexes and "sbert" in clusters:
+        ### the clusters route a query to the movies of its closest clusters
+        ann_indexes["sbert"] = clusters["sbert"].as_index(exact)
+
+    return MovieStore(
+        titles=df["title"],
+        urls=df["url"],
+        plots=df["plot"],
+        years=df["year"] if "year" in df else None,
+        engines=engines,
+        ann_indexes=ann_indexes,
+        tables=_load_neighbor_tables(artifacts_dir, engines, manifest),
+        clusters=clusters,
+    )
@@ -0,0 +1,109 @@
+""" Precomputed top-N neighbour tables of every movie in the catalog """
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from similarity import batch_top_k
+
+
+def compute_neighbors(engine, n_neighbors=10, block_size=1024):
+    """
+    top `n_neighbors` most similar movies (excluding itself) of every movie, the
+    corpus is scored `block_size` movies at a time so memory stays bounded to a
+    (block_size, n_movies) score matrix. returns (neighbors, scores) both of shape
+    (n_movies, n_neighbors)
+    """
+    n = len(engine)
+    n_neighbors = min(n_neighbors, n - 1)
+    neighbors = np.empty((n, n_neighbors), dtype=np.int32)
+    scores = np.empty((n, n_neighbors), dtype=np.float32)
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        block_idx, block_scores = batch_top_k(
+            engine.batch_scores(rows), n_neighbors, exclude=rows
+        )
+        neighbors[rows] = block_idx
+        scores[rows] = block_scores
+    return neighbors, scores
+
+
+def update_neighbors(
+    engine, neighbors, scores, previous_rows, n_neighbors=10, block_size=1024
+):
+    """
+    update a neighbour table computed for an earlier version of the corpus, where
+    `previous_rows` (see `manifest.row_mapping`) gives for every movie its row in the
+    earlier corpus or -1 when it is new or its plot changed. only those movies and
+    the movies that had one of the removed/changed movies as a neighbour are scored
+    against the whole corpus, every other movie keeps its neighbours and is only
+    scored against the new & changed movies. returns (neighbors, scores) like
+    `compute_neighbors`
+    """
+    n = len(engine)
+    n_neighbors = min(n_neighbors, n - 1)
+    previous_to_new = np.full(len(neighbors), -1, dtype=np.int64)
+    kept = np.flatnonzero(previous_rows >= 0)
+    previous_to_new[previous_rows[kept]] = kept
+    changed = np.flatnonzero(previous_rows < 0)
+
+    new_neighbors = np.empty((n, n_neighbors), dtype=np.int32)
+    new_scores = np.empty((n, n_neighbors), dtype=np.float32)
+    ### neighbours of kept movies in new row numbers, -1 where the neighbour is gone
+    remapped = previous_to_new[neighbors[previous_rows[kept]]]
+    valid = (remapped >= 0).all(axis=1) & (remapped.shape[1] >= n_neighbors)
+    clean = kept[valid]
+    dirty = np.concatenate([changed, kept[~valid]])
+
+    ### the top-N of a clean movie is the top-N of its old neighbours and the new ones
+    remapped = remapped[valid][:, :n_neighbors]
+    previous_scores = scores[previous_rows[clean]][:, :n_neighbors]
+    for start in range(0, len(clean), block_size):
+        rows = clean[start : start + block_size]
+        candidates = np.hstack(
+            [
+                remapped[start : start + block_size],
+                np.broadcast_to(changed, (len(rows), len(changed))),
+            ]
+        )
+        candidate_scores = np.hstack(
+            [
+                previous_scores[start : start + block_size],
+                engine.batch_scores(rows, candidates=changed),
+            ]
+        )
+        idx, block_scores = batch_top_k(candidate_scores, n_neighbors)
+        new_neighbors[rows] = np.take_along_axis(candidates, idx, axis=1)
+        new_scores[rows] = block_scores
+
+    ### everything else is computed from scratch
+    for start in range(0, len(dirty), block_size):
+        rows = dirty[start : start + block_size]
+        block_idx, block_scores = batch_top_k(
+            engine.batch_scores(rows), n_neighbors, exclude=rows
+        )
+        new_neighbors[rows] = block_idx
+        new_scores[rows] = block_scores
+    return new_neighbors, new_scores
+
+
+def save_neighbors(neighbors, scores, parquet_output_file):
+    """store neighbour table as parquet, one int & one float column per rank"""
+    columns = {}
+    for rank in range(neighbors.shape[1]):
+        columns[f"neighbor_{rank + 1}"] = neighbors[:, rank]
+    for rank in range(scores.shape[1]):
+        columns[f"score_{rank + 1}"] = scores[:, rank]
+    pq.write_table(pa.table(columns), parquet_output_file)
+
+
+def load_neighbors(parquet_input_file):
+    """load a neighbour table written by `save_neighbors`, returns (neighbors, scores)"""
+    table = pq.read_table(parquet_input_file)
+    n_neighbors = table.num_columns // 2
+    neighbors = np.column_stack(
+        [table[f"neighbor_{rank + 1}"].to_numpy() for rank in range(n_neighbors)]
+    )
+    scores = np.column_stack(
+        [table[f"score_{rank + 1}"].to_numpy() for rank in range(n_neighbors)]
+    )
+    return neighbors, scores
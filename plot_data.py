@@ -0,0 +1,197 @@
+"""
+Server-side preparation of the UMAP scatter plots of the movie visualizer: only what
+can actually be seen is sent to the browser. A view with more movies than can be
+drawn shows a density grid of all of them with a thinned sample of points on top,
+the real points (with title & url on hover) are sent once the view is zoomed into a
+region holding few enough of them.
+"""
+
+import numpy as np
+import pandas as pd
+
+### coordinates are rounded before serialization, UMAP spreads movies over a range
+### of ~10-20 units so 3 decimals are far below a pixel and keep the JSON small
+DECIMALS = 3
+
+
+def _read_only(values):
+    values = np.array(values)
+    values.setflags(write=False)
+    return values
+
+
+class PlotPoints:
+    """
+    Read-only UMAP coordinates, titles & urls of the movies, meant to be loaded once
+    per process and shared by every user session
+    """
+
+    def __init__(self, df):
+        self.coords = _read_only(
+            df[["comp_1", "comp_2", "comp_3"]].to_numpy(dtype=np.float32)
+        )
+        self.titles = _read_only(df["title"])
+        self.urls = _read_only(df["url"])
+
+    def __len__(self):
+        return len(self.coords)
+
+    def bounds(self):
+        """((min, max) of comp_1, (min, max) of comp_2)"""
+        low, high = self.coords[:, :2].min(axis=0), self.coords[:, :2].max(axis=0)
+        return (float(low[0]), float(high[0])), (float(low[1]), float(high[1]))
+
+
+def load_plot_points(file_name):
+    """UMAP data written by `preprocessing/reduce_dim.py`"""
+    return PlotPoints(
+        pd.read_parquet(
+            file_name, columns=["comp_1", "comp_2", "comp_3", "title", "url"]
+        )
+    )
+
+
+def in_viewport(points, x_range, y_range):
+    """rows of the movies within the given comp_1 & comp_2 ranges"""
+    x, y = points.coords[:, 0], points.coords[:, 1]
+    return np.flatnonzero(
+        (x >= x_range[0]) & (x <= x_range[1]) & (y >= y_range[0]) & (y <= y_range[1])
+    )
+
+
+def thin(points, rows, max_points, bins=64, seed=42):
+    """
+    at most `max_points` of the given rows, the same number at most from every cell
+    of a `bins` x `bins` grid over comp_1 & comp_2: dense regions are thinned while
+    sparse regions and outliers keep all their points. returns sorted rows
+    """
+    if len(rows) <= max_points:
+        return rows
+    xy = points.coords[rows, :2]
+    low, high = xy.min(axis=0), xy.max(axis=0)
+    scale = np.where(high > low, high - low, 1.0)
+    cell_xy = ((xy - low) / scale * bins).astype(np.int64).clip(0, bins - 1)
+    cell = cell_xy[:, 0] * bins + cell_xy[:, 1]
+
+    ### random order within every cell, then rank of every point in its cell
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(rows)), cell))
+    counts = np.bincount(cell, minlength=bins * bins)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.arange(len(rows)) - starts[cell[order]]
+
+    ### largest per cell quota that keeps the total within `max_points`
+    low_quota, high_quota = 1, int(counts.max())
+    while low_quota < high_quota:
+        quota = (low_quota + high_quota + 1) // 2
+        if np.minimum(counts, quota).sum() <= max_points:
+            low_quota = quota
+        else:
+            high_quota = quota - 1
+    kept = order[rank < low_quota]
+    ### more occupied cells than points allowed, keep a random subset of them
+    if len(kept) > max_points:
+        kept = rng.choice(kept, max_points, replace=False)
+    return np.sort(rows[kept])
+
+
+def level_of_detail(
+    points, x_range=None, y_range=None, max_points=20_000, bins=200, n_sampled=None
+):
+    """
+    what to draw of the 2-D view of the given ranges (the whole map by default):
+    every movie of the view when there are at most `max_points` of them, otherwise
+    a `bins` x `bins` density grid of the view and a thinned sample of `n_sampled`
+    movies (a quarter of `max_points` by default). returns a dict with the `rows` of
+    the movies to draw, the `density` (counts, x edges, y edges) or None, the view
+    ranges and the number of movies in the view
+    """
+    full_x, full_y = points.bounds()
+    x_range, y_range = x_range or full_x, y_range or full_y
+    rows = in_viewport(points, x_range, y_range)
+    lod = {"x_range": x_range, "y_range": y_range, "n_visible": len(rows)}
+    if len(rows) <= max_points:
+        return {**lod, "rows": rows, "density": None}
+    counts, x_edges, y_edges = np.histogram2d(
+        points.coords[rows, 0],
+        points.coords[rows, 1],
+        bins=bins,
+        range=[x_range, y_range],
+    )
+    sampled = thin(points, rows, n_sampled or max_points // 4)
+    return {**lod, "rows": sampled, "density": (counts, x_edges, y_edges)}
+
+
+def _coords(values):
+    return np.round(values.astype(np.float64), DECIMALS)
+
+
+def figure_2d(points, lod, height=800):
+    """
+    WebGL (scattergl) figure of a `level_of_detail`, a density heatmap under the
+    sampled movies for an overview, the real movies with title & url on hover when
+    the view holds few enough of them
+    """
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    rows = lod["rows"]
+    if lod["density"] is not None:
+        counts, x_edges, y_edges = lod["density"]
+        fig.add_trace(
+            go.Heatmap(
+                z=np.round(np.log1p(counts.T), 2),
+                x=_coords((x_edges[:-1] + x_edges[1:]) / 2),
+                y=_coords((y_edges[:-1] + y_edges[1:]) / 2),
+                colorscale="Blues",
+                showscale=False,
+                hoverinfo="skip",
+            )
+        )
+        hover = dict(hovertext=points.titles[rows], hovertemplate="%{hovertext}")
+    else:
+        hover = dict(
+            hovertext=points.titles[rows],
+            customdata=points.urls[rows],
+            hovertemplate="<b>%{hovertext}</b><br>%{customdata}<extra></extra>",
+        )
+    fig.add_trace(
+        go.Scattergl(
+            x=_coords(points.coords[rows, 0]),
+            y=_coords(points.coords[rows, 1]),
+            mode="markers",
+            marker=dict(size=5, opacity=0.7, color="#03989e"),
+            name="",
+            **hover,
+        )
+    )
+    return fig.update_layout(
+        height=height,
+        margin=dict(l=0, r=0, b=0, t=0),
+        xaxis=dict(title="comp_1", range=list(lod["x_range"])),
+        yaxis=dict(title="comp_2", range=list(lod["y_range"])),
+        showlegend=False,
+    )
+
+
+def figure_3d(points, max_points=20_000, height=1000):
+    """3-D figure (WebGL) of at most `max_points` movies thinned over the map"""
+    import plotly.graph_objects as go
+
+    rows = thin(points, np.arange(len(points)), max_points)
+    fig = go.Figure(
+        go.Scatter3d(
+            x=_coords(points.coords[rows, 0]),
+            y=_coords(points.coords[rows, 1]),
+            z=_coords(points.coords[rows, 2]),
+            mode="markers",
+            marker=dict(size=3, opacity=0.7, color="#03989e"),
+            hovertext=points.titles[rows],
+            hovertemplate="%{hovertext}<extra></extra>",
+        )
+    )
+    return fig.update_layout(
+        height=height,
+        margin=dict(l=0, r=0, b=0, t=0),
+        scene=dict(xaxis_title="comp_1", yaxis_title="comp_2", zaxis_title="comp_3"),
+    )
@@ -0,0 +1,187 @@
+"""
+Generate the recommendations of many movies at once (e.g. for email or export jobs)
+and stream them to a parquet or JSONL file, one row per (movie, recommendation).
+Movies are given one per line by id (Wikipedia URL) or title, the whole catalog by
+default. They are scored in blocks by a pool of threads and the throughput is
+reported as blocks complete.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+### the recommendation code is shared with the app, which lives in the repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from movie_store import load_movie_store
+from recommender import candidate_bitmap, iter_recommendations, resolve_movies
+
+SCHEMA = pa.schema(
+    [
+        ("movie_id", pa.string()),
+        ("title", pa.string()),
+        ("rank", pa.int32()),
+        ("recommended_id", pa.string()),
+        ("recommended_title", pa.string()),
+        ("score", pa.float32()),
+    ]
+)
+
+
+def __read_movies(file_name):
+    """non-empty lines of a text file"""
+    with open(file_name, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def __to_table(store, block, rows, scores):
+    """long format table of the recommendations of a block of movies"""
+    n_recommended = rows.shape[1]
+    query_rows = np.repeat(block, n_recommended)
+    rows, scores = rows.ravel(), scores.ravel()
+    return pa.table(
+        {
+            "movie_id": store.urls[query_rows],
+            "title": store.titles[query_rows],
+            "rank": np.tile(
+                np.arange(1, n_recommended + 1, dtype=np.int32), len(block)
+            ),
+            "recommended_id": store.urls[rows],
+            "recommended_title": store.titles[rows],
+            "score": scores.astype(np.float32),
+        },
+        schema=SCHEMA,
+    )
+
+
+class _ParquetSink:
+    """one row group per block"""
+
+    def __init__(self, file_name):
+        self.writer = pq.ParquetWriter(file_name, SCHEMA)
+
+    def write(self, table):
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+class _JSONLinesSink:
+    """one JSON object per line"""
+
+    def __init__(self, file_name):
+        self.file = open(file_name, "w", encoding="utf-8")
+
+    def write(self, table):
+        for record in table.to_pylist():
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def batch_recommend(
+    store,
+    query_rows,
+    output_file,
+    k=10,
+    embed="sbert",
+    candidates=None,
+    block_size=1024,
+    workers=1,
+    report_every=10,
+):
+    """
+    write the top `k` recommendations of every movie of `query_rows` to a parquet
+    or JSONL file (by its extension), written to a temporary file and renamed once
+    complete. returns the number of movies per second
+    """
+    if output_file.endswith(".parquet"):
+        sink = _ParquetSink(output_file + ".partial")
+    elif output_file.endswith(".jsonl"):
+        sink = _JSONLinesSink(output_file + ".partial")
+    else:
+        raise ValueError(f"Output [{output_file}] must be a .parquet or .jsonl file")
+
+    start = time.perf_counter()
+    n_done = 0
+    try:
+        for i, (block, rows, scores) in enumerate(
+            iter_recommendations(
+                store, query_rows, k, embed, candidates, block_size, workers
+            )
+        ):
+            sink.write(__to_table(store, block, rows, scores))
+            n_done += len(block)
+            if (i + 1) % report_every == 0:
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{n_done}/{len(query_rows)} movies, "
+                    f"{n_done / elapsed:.1f} movies/s"
+                )
+    finally:
+        sink.close()
+    os.replace(output_file + ".partial", output_file)
+    elapsed = time.perf_counter() - start
+    return n_done / elapsed if elapsed > 0 else float("inf")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", help="output .parquet or .jsonl file")
+    parser.add_argument(
+        "--movies", help="file of movie ids or titles, one per line, all by default"
+    )
+    parser.add_argument("--k", type=int, default=10, help="recommendations per movie")
+    parser.add_argument("--embed", choices=["sbert", "tfidf"], default="sbert")
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs=2,
+        metavar=("FIRST", "LAST"),
+        help="only recommend movies released in these years",
+    )
+    parser.add_argument(
+        "--block-size", type=int, default=1024, help="movies scored at once"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="scoring threads, all cores by default",
+    )
+    parser.add_argument("--artifacts", default="../artifacts")
+    args = parser.parse_args()
+
+    print(f"Loading [{args.embed}] embeddings from [{args.artifacts}]...")
+    store = load_movie_store(args.artifacts, use_tfidf=args.embed == "tfidf")
+    if args.embed not in store.engines:
+        sys.exit(f"No [{args.embed}] embeddings found in [{args.artifacts}]")
+    if args.years is not None and store.years is None:
+        sys.exit("The movie data has no release years, collect it again to use them")
+
+    if args.movies is None:
+        query_rows = np.arange(len(store))
+    else:
+        query_rows, unresolved = resolve_movies(store, __read_movies(args.movies))
+        for movie in unresolved:
+            print(f"No movie matches [{movie}], skipped")
+    candidates = candidate_bitmap(store, years=args.years)
+
+    print(f"Recommending {args.k} movies for {len(query_rows)} movies...")
+    throughput = batch_recommend(
+        store,
+        query_rows,
+        args.output,
+        k=args.k,
+        embed=args.embed,
+        candidates=candidates,
+        block_size=args.block_size,
+        workers=args.workers or os.cpu_count(),
+    )
+    print(f"Saved recommendations to [{args.output}], {throughput:.1f} movies/s")
@@ -0,0 +1,94 @@
+"""
+Benchmark the HTML parser options of `html_parsing.py` over saved Wikipedia pages
+(see `wiki_standin.py`): pages/sec of every parser in one process and in a pool of
+processes, and agreement of its output with the original BeautifulSoup parser.
+Year pages are the files named `List_of_American_films_of_*.html`, every other file
+is taken as a movie page.
+"""
+
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from html_parsing import PLOT_PARSERS, YEAR_PARSERS, parse_plots, parse_year_pages
+
+
+def __load_pages(page_dir):
+    """(movie pages, year pages) as bytes"""
+    movie_pages, year_pages = [], []
+    for file_name in sorted(
+        glob.glob(os.path.join(page_dir, "**/*.html"), recursive=True)
+    ):
+        with open(file_name, "rb") as f:
+            page = f.read()
+        if os.path.basename(file_name).startswith("List_of_American_films_of_"):
+            year_pages.append(page)
+        else:
+            movie_pages.append(page)
+    return movie_pages, year_pages
+
+
+def __time(parse, pages, repeat):
+    """best wall time of `repeat` runs and the output of the last run"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = list(parse(pages))
+        best = min(best, time.perf_counter() - start)
+    return best, output
+
+
+def benchmark(movie_pages, year_pages, workers=None, repeat=3):
+    """pages/sec & agreement with bs4 for every parser, as a list of dicts"""
+    report = []
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        ### start the workers before timing anything
+        list(executor.map(abs, range(workers)))
+        for kind, pages, parsers in [
+            ("movie", movie_pages, PLOT_PARSERS),
+            ("year", year_pages, YEAR_PARSERS),
+        ]:
+            if not pages:
+                continue
+            baseline = None
+            for parser in parsers:
+                for n_workers, pool in [(1, None), (workers, executor)]:
+                    if kind == "movie":
+                        parse = lambda p: parse_plots(p, parser, pool)
+                    else:
+                        parse = lambda p: parse_year_pages(p, "", parser, pool)
+                    elapsed, output = __time(parse, pages, repeat)
+                    if baseline is None:
+                        baseline = output
+                    report.append(
+                        {
+                            "pages": kind,
+                            "parser": parser,
+                            "workers": n_workers,
+                            "pages_per_s": len(pages) / elapsed,
+                            "same_as_bs4": sum(a == b for a, b in zip(output, baseline))
+                            / len(pages),
+                        }
+                    )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", default="../artifacts/saved_pages")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="pool size, all cores by default"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    movie_pages, year_pages = __load_pages(args.pages)
+    print(
+        f"Benchmarking parsers on {len(movie_pages)} movie pages & "
+        f"{len(year_pages)} year pages from [{args.pages}]..."
+    )
+    report = benchmark(movie_pages, year_pages, args.workers, args.repeat)
+    print(pd.DataFrame(report).to_string(index=False))
@@ -0,0 +1,409 @@
+"""
+Benchmark the recommendation hot path of the app on synthetic catalogs of growing
+size: every stage (loading the parquet files, materializing the embeddings, scoring,
+top-k selection, filtered search, title search, UMAP plot data preparation...) is
+timed separately and the results are written as JSON. `compare` reports the stages
+of a run that got slower than a baseline run by more than a threshold and exits
+with status 1 when there is any, so that changes can be judged on numbers.
+
+Synthetic catalogs (dense 384-d SBERT-like embeddings around random topics, sparse
+TF-IDF-like rows with Zipf distributed terms, titles, plots & UMAP coordinates) are
+written once per size in the app's artifact layout and re-used by later runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+from numpy.lib.format import open_memmap
+
+### the app code is benchmarked as is, it lives in the repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from filtered_search import filtered_search
+from movie_store import _load_embeddings, load_engine, load_movie_store
+from plot_data import figure_2d, figure_3d, level_of_detail, load_plot_points
+from recommender import recommend_block
+from similarity import SimilarityEngine, top_k
+from title_index import TitleIndex
+
+N_DIMS = 384
+N_TERMS = 50_000
+SYLLABLES = ["ka", "ro", "mi", "ten", "sa", "lo", "dar", "vi", "nor", "el", "bu", "zan"]
+
+
+def __words(rng, n_words):
+    """pseudo words made of 2-4 syllables"""
+    lengths = rng.integers(2, 5, n_words)
+    return np.array(
+        ["".join(rng.choice(SYLLABLES, length)) for length in lengths], dtype=object
+    )
+
+
+def __write_sparse(file_name, tfidf_files, shape, terms, idf):
+    """
+    `.npz` of the CSR arrays built on disk by `generate_corpus`, in the layout of
+    `generate_embeddings.py`. the arrays are memory-mapped and `np.savez` writes them
+    in buffered chunks, so they are never loaded whole
+    """
+    data_file, indices_file, indptr_file = tfidf_files
+    np.savez(
+        file_name,
+        data=np.memmap(data_file, dtype=np.float32, mode="r"),
+        indices=np.memmap(indices_file, dtype=np.int32, mode="r"),
+        indptr=np.load(indptr_file, mmap_mode="r"),
+        shape=np.array(shape),
+        terms=terms,
+        idf=idf,
+    )
+    for tfidf_file in tfidf_files:
+        os.remove(tfidf_file)
+
+
+def generate_corpus(data_dir, n, plot_words=50, chunk_size=100_000, seed=42):
+    """
+    write a synthetic catalog of `n` movies to `data_dir` in the app's layout, every
+    file is generated & written `chunk_size` rows at a time (the TF-IDF CSR arrays
+    are appended to files on disk) so that even millions of rows don't have to fit
+    in memory at once. the UMAP file is moved in place last, its presence means
+    the catalog is complete
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    vocabulary = __words(rng, 5000)
+    topics = rng.normal(size=(max(16, int(np.sqrt(n))), N_DIMS)).astype(np.float32)
+    term_weights = 1.0 / np.arange(1, N_TERMS + 1) ** 1.1
+    term_weights /= term_weights.sum()
+
+    vectors = open_memmap(
+        os.path.join(data_dir, "sbert_embeddings.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(n, N_DIMS),
+    )
+    schema = pa.schema([(str(i), pa.float32()) for i in range(N_DIMS)])
+    writer = pq.ParquetWriter(
+        os.path.join(data_dir, "sbert_embeddings.parquet"), schema
+    )
+    plots_file = os.path.join(data_dir, "movie_plots.parquet")
+    umap_file = os.path.join(data_dir, "umap_reduced_data.parquet")
+    plots_writer, umap_writer = None, None
+    tfidf_files = [
+        os.path.join(data_dir, f"tfidf_{name}.partial")
+        for name in ["data", "indices", "indptr.npy"]
+    ]
+    data_out, indices_out = open(tfidf_files[0], "wb"), open(tfidf_files[1], "wb")
+    indptr = open_memmap(tfidf_files[2], mode="w+", dtype=np.int64, shape=(n + 1,))
+    indptr[0] = 0
+    for start in range(0, n, chunk_size):
+        m = min(chunk_size, n - start)
+        rows = np.arange(start, start + m)
+        ### dense: a random topic plus noise, unit length like SBERT output
+        labels = rng.integers(0, len(topics), m)
+        block = topics[labels] + 0.8 * rng.normal(size=(m, N_DIMS)).astype(np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+        vectors[start : start + m] = block
+        writer.write_table(pa.Table.from_arrays(list(block.T), schema=schema))
+
+        ### sparse: ~60 terms per plot drawn from a Zipf-like distribution
+        nnz = rng.poisson(60, m) + 1
+        data_out.write(rng.random(nnz.sum()).astype(np.float32).tobytes())
+        indices_out.write(
+            rng.choice(N_TERMS, nnz.sum(), p=term_weights).astype(np.int32).tobytes()
+        )
+        indptr[start + 1 : start + m + 1] = indptr[start] + np.cumsum(nnz)
+
+        title_words = rng.choice(vocabulary, (m, 3))
+        n_title_words = rng.integers(1, 4, m)
+        plot_text = rng.choice(vocabulary, (m, plot_words))
+        titles = [
+            " ".join(words[:count]).title() + " (film)"
+            for words, count in zip(title_words, n_title_words)
+        ]
+        urls = [f"https://en.wikipedia.org/wiki/Movie_{row}" for row in rows]
+        plots = pa.Table.from_pandas(
+            pd.DataFrame(
+                {
+                    "title": titles,
+                    "url": urls,
+                    "plot": [" ".join(words) for words in plot_text],
+                    "year": 1950 + rows % 75,
+                }
+            ),
+            preserve_index=False,
+        )
+        ### UMAP: 3-D coordinates around the 2-D/3-D projection of the topic
+        coords = topics[labels, :3] + 0.3 * rng.normal(size=(m, 3))
+        umap = pa.Table.from_pandas(
+            pd.DataFrame(
+                {
+                    "comp_1": coords[:, 0],
+                    "comp_2": coords[:, 1],
+                    "comp_3": coords[:, 2],
+                    "title": titles,
+                    "url": urls,
+                }
+            ),
+            preserve_index=False,
+        )
+        if plots_writer is None:
+            plots_writer = pq.ParquetWriter(plots_file, plots.schema)
+            umap_writer = pq.ParquetWriter(umap_file + ".partial", umap.schema)
+        plots_writer.write_table(plots)
+        umap_writer.write_table(umap)
+    writer.close()
+    plots_writer.close()
+    vectors.flush()
+    data_out.close()
+    indices_out.close()
+    indptr.flush()
+    del indptr
+
+    ### vocabulary & smoothed idf of the expected document frequency of every term,
+    ### from their own generator so the catalog itself doesn't depend on them
+    terms = np.char.add(
+        __words(np.random.default_rng(seed + 1), N_TERMS).astype(str),
+        np.arange(N_TERMS).astype(str),
+    )
+    doc_frequency = n * (1 - np.exp(-60 * term_weights))
+    idf = (np.log((1 + n) / (1 + doc_frequency)) + 1).astype(np.float32)
+    __write_sparse(
+        os.path.join(data_dir, "tfidf_embeddings.npz"),
+        tfidf_files,
+        (n, N_TERMS),
+        terms,
+        idf,
+    )
+    umap_writer.close()
+    os.replace(umap_file + ".partial", umap_file)
+
+
+def __time(fn, repeat):
+    """wall times (s) of `repeat` calls and the output of the last one"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = fn()
+        times.append(time.perf_counter() - start)
+    return times, output
+
+
+def __time_per_query(fn, queries, repeat):
+    """wall times (s) per query of `repeat` passes over all the queries"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for query in queries:
+            fn(query)
+        times.append((time.perf_counter() - start) / len(queries))
+    return times
+
+
+def benchmark_corpus(data_dir, n_queries=100, k=10, repeat=3, seed=42):
+    """
+    time every stage of the hot path on the catalog in `data_dir`, returns a list
+    of dicts with the median & min time of every stage (ms, per query for the
+    stages run once per query)
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+
+    def record(stage, times, **info):
+        results.append(
+            {
+                "stage": stage,
+                "ms": float(np.median(times)) * 1000,
+                "min_ms": float(np.min(times)) * 1000,
+                **info,
+            }
+        )
+
+    ### loading
+    plots_file = os.path.join(data_dir, "movie_plots.parquet")
+    times, _ = __time(
+        lambda: pd.read_parquet(plots_file, columns=["title", "url", "plot"]), repeat
+    )
+    record("plots_parquet_load", times)
+    times, _ = __time(
+        lambda: SimilarityEngine(
+            _load_embeddings(os.path.join(data_dir, "sbert_embeddings.parquet"))
+        ),
+        repeat,
+    )
+    record("embeddings_parquet_materialize", times)
+    times, _ = __time(lambda: load_engine(data_dir, "sbert"), repeat)
+    record("embeddings_npy_mmap", times)
+    times, _ = __time(lambda: load_engine(data_dir, "tfidf"), repeat)
+    record("tfidf_load", times)
+    times, store = __time(lambda: load_movie_store(data_dir, use_tfidf=True), repeat)
+    record("store_load", times)
+
+    ### scoring & selection
+    engine, tfidf = store.engines["sbert"], store.engines["tfidf"]
+    queries = rng.choice(len(store), min(n_queries, len(store)), replace=False)
+    record("sbert_score", __time_per_query(engine.scores, queries, repeat))
+    scores = engine.scores(queries[0])
+    record("top_k", __time_per_query(lambda q: top_k(scores, k, q), queries, repeat))
+    record(
+        "sbert_most_similar",
+        __time_per_query(lambda q: engine.most_similar(q, k), queries, repeat),
+    )
+    record(
+        "tfidf_most_similar",
+        __time_per_query(lambda q: tfidf.most_similar(q, k), queries, repeat),
+    )
+    block = queries[: min(64, len(queries))]
+    times, _ = __time(lambda: recommend_block(store, block, k), repeat)
+    record("sbert_batch_per_query", [t / len(block) for t in times])
+    for share in [0.01, 0.2]:
+        mask = rng.random(len(store)) < share
+        record(
+            f"filtered_search_{int(share * 100)}pct",
+            __time_per_query(
+                lambda q: filtered_search(engine, k, query_index=q, candidates=mask),
+                queries,
+                repeat,
+            ),
+        )
+
+    ### title search
+    times, index = __time(lambda: TitleIndex(store.titles), 1)
+    record("title_index_build", times)
+    words = [title.split()[0][:5] for title in store.titles[queries[:20]]]
+    record("title_search", __time_per_query(index.search, words, repeat))
+
+    ### UMAP plot data, what the visualizer page sends to the browser
+    umap_file = os.path.join(data_dir, "umap_reduced_data.parquet")
+    times, points = __time(lambda: load_plot_points(umap_file), repeat)
+    record("umap_load", times)
+    times, lod = __time(lambda: level_of_detail(points), repeat)
+    record("umap_level_of_detail", times, n_drawn=len(lod["rows"]))
+    try:
+        for stage, build in [
+            ("umap_figure_2d", lambda: figure_2d(points, lod).to_json()),
+            ("umap_figure_3d", lambda: figure_3d(points).to_json()),
+        ]:
+            times, payload = __time(build, 1)
+            record(stage, times, payload_bytes=len(payload))
+    except ImportError:
+        print("plotly is not installed, skipping the UMAP figures")
+    return results
+
+
+def __git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, data_dir, n_queries=100, k=10, repeat=3):
+    """benchmark every catalog size, generating the catalogs that don't exist yet"""
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": __git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "k": k,
+            "n_queries": n_queries,
+        },
+        "results": [],
+        "peak_rss_mb": {},
+    }
+    for n in sorted(sizes):
+        corpus_dir = os.path.join(data_dir, f"corpus_{n}")
+        if not os.path.exists(os.path.join(corpus_dir, "umap_reduced_data.parquet")):
+            print(f"Generating a synthetic catalog of {n} movies in [{corpus_dir}]...")
+            start = time.perf_counter()
+            generate_corpus(corpus_dir, n)
+            print(f"Generated in {time.perf_counter() - start:.1f}s")
+        print(f"Benchmarking {n} movies...")
+        for result in benchmark_corpus(corpus_dir, n_queries, k, repeat):
+            report["results"].append({"size": n, **result})
+        ### peak memory of the process so far (kilobytes on Linux), sizes ascending
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        report["peak_rss_mb"][str(n)] = peak
+    return report
+
+
+def compare(baseline, report, threshold=1.2):
+    """
+    (size, stage) of both reports side by side, returns the table as a dataframe
+    and whether any stage is more than `threshold` times slower than the baseline
+    """
+    columns = ["size", "stage", "ms"]
+    old = pd.DataFrame(baseline["results"])[columns]
+    new = pd.DataFrame(report["results"])[columns]
+    table = old.merge(new, on=["size", "stage"], suffixes=("_baseline", "_new"))
+    table["ratio"] = table["ms_new"] / table["ms_baseline"]
+    table["regression"] = table["ratio"] > threshold
+    return table, bool(table["regression"].any())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000], help="movies"
+    )
+    ### hundreds of MB per size, kept out of the repo (and its LFS patterns)
+    run_parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "movie_buddy_benchmark_data"),
+    )
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--queries", type=int, default=100)
+    run_parser.add_argument("--k", type=int, default=10)
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--baseline", help="compare against this earlier run")
+    run_parser.add_argument("--threshold", type=float, default=1.2)
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="a stage this many times slower is a regression",
+    )
+    args = parser.parse_args()
+
+    if args.command == "run":
+        report = run(args.sizes, args.data_dir, args.queries, args.k, args.repeat)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(pd.DataFrame(report["results"]).to_string(index=False))
+        print(f"Saved results to [{args.output}]")
+        if args.baseline is None:
+            sys.exit(0)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            report = json.load(f)
+
+    table, regressed = compare(baseline, report, args.threshold)
+    print(table.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    if regressed:
+        print(f"Stages more than {args.threshold}x slower than the baseline!")
+    sys.exit(1 if regressed else 0)
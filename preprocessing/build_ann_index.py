@@ -0,0 +1,57 @@
+"""
+Build an approximate nearest neighbour (IVF) index over the SBERT embeddings, report
+its recall against exact search and save it to disk
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+### the index implementation is shared with the app, which lives in the repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from manifest import artifact_rows, load_manifest, record_artifact
+from movie_store import load_engine
+from ann_index import IVFIndex, recall_report
+
+
+if __name__ == "__main__":
+    target_dir = "../artifacts/"
+    index_output_file = target_dir + "sbert_ivf_index.npz"
+    ### recall/latency knobs: more lists make each probe cheaper, more probes
+    ### (chosen at query time) find more of the true neighbours
+    n_lists = None  # None means ~4 * sqrt(number of movies)
+    n_iter = 20
+    sample_size = 50_000
+    ### keep the centroids of the existing index and only assign new & changed
+    ### movies to lists, unless more than this fraction of the corpus changed
+    incremental = True
+    rebuild_fraction = 0.2
+
+    print(f"\nLoading SBERT embeddings from [{target_dir}]...")
+    engine = load_engine(target_dir, "sbert")
+
+    manifest = load_manifest(target_dir)
+    name = os.path.basename(index_output_file)
+    previous_rows = None
+    if incremental and os.path.exists(index_output_file):
+        previous_rows = artifact_rows(target_dir, manifest, name)
+    if previous_rows is not None and (previous_rows < 0).mean() <= rebuild_fraction:
+        print(
+            f"Updating IVF index for {(previous_rows < 0).sum()} new or changed movies..."
+        )
+        with np.load(index_output_file) as data:
+            previous = IVFIndex(None, data["centroids"], data["offsets"], data["rows"])
+        index = previous.update(engine, previous_rows)
+    else:
+        print(f"Building IVF index over {len(engine)} movies...")
+        index = IVFIndex.build(
+            engine, n_lists=n_lists, n_iter=n_iter, sample_size=sample_size
+        )
+    index.save(index_output_file)
+    record_artifact(target_dir, name, manifest["corpus"])
+    print(f"Saved IVF index with {index.n_lists} lists to [{index_output_file}]\n")
+
+    ### compare against exact search so that the speed-up can be judged on quality
+    print("Recall against exact search:")
+    print(pd.DataFrame(recall_report(index)).to_string(index=False))
@@ -0,0 +1,66 @@
+"""
+Cluster the SBERT embeddings with mini-batch k-means and save the centroids & the
+cluster of every movie to disk, used by the app to diversify recommendations and to
+route queries to the closest clusters when no ANN index was built
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+### the clustering code is shared with the app, which lives in the repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from manifest import artifact_rows, load_manifest, record_artifact
+from movie_store import load_engine
+from clusters import MovieClusters
+
+
+if __name__ == "__main__":
+    target_dir = "../artifacts/"
+    clusters_output_file = target_dir + "sbert_clusters.npz"
+    ### more clusters group every movie with fewer, closer relatives
+    n_clusters = None  # None means ~4 * sqrt(number of movies)
+    ### rows read per mini-batch & number of mini-batches
+    batch_size = 4096
+    n_iter = 100
+    ### keep the centroids and only assign new & changed movies to a cluster,
+    ### unless more than this fraction of the corpus changed
+    incremental = True
+    rebuild_fraction = 0.2
+
+    print(f"\nLoading SBERT embeddings from [{target_dir}]...")
+    engine = load_engine(target_dir, "sbert")
+
+    manifest = load_manifest(target_dir)
+    name = os.path.basename(clusters_output_file)
+    previous_rows = None
+    if incremental and os.path.exists(clusters_output_file):
+        previous_rows = artifact_rows(target_dir, manifest, name)
+    if previous_rows is not None and (previous_rows < 0).mean() <= rebuild_fraction:
+        print(f"Assigning {(previous_rows < 0).sum()} new or changed movies...")
+        with np.load(clusters_output_file) as data:
+            previous = MovieClusters(data["centroids"], data["labels"])
+        clusters = previous.update(engine, previous_rows)
+    else:
+        print(f"Clustering {len(engine)} movies...")
+        clusters = MovieClusters.build(
+            engine, n_clusters=n_clusters, batch_size=batch_size, n_iter=n_iter
+        )
+    clusters.save(clusters_output_file)
+    record_artifact(target_dir, name, manifest["corpus"])
+    print(f"Saved {clusters.n_clusters} clusters to [{clusters_output_file}]\n")
+
+    ### how tight the clusters are, a movie's neighbours should mostly share its
+    ### cluster while no cluster should hold a large share of the catalog
+    sizes = np.bincount(clusters.labels, minlength=clusters.n_clusters)
+    rng = np.random.default_rng(42)
+    queries = rng.choice(len(engine), min(200, len(engine)), replace=False)
+    same = np.mean(
+        [
+            np.mean(clusters.labels[engine.most_similar(q, 5)[0]] == clusters.labels[q])
+            for q in queries
+        ]
+    )
+    print(pd.Series(sizes).describe().to_string())
+    print(f"Share of top-5 neighbours in the same cluster: {same:.2f}")
@@ -1,69 +1,134 @@
 """ Extract and collect American movie plots from wikipedia """
 
-from bs4 import BeautifulSoup
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from tqdm import tqdm
-from urllib import request
+from fetcher import Fetcher
+from html_parsing import parse_plots, parse_year_pages
+from http_cache import HTTPCache
 
 
-def __get_plot(movie_page):
-    """Open the given movie webpage, extract and return the plot text for this movie"""
-    plot = ""
-    try:
-        html = request.urlopen(movie_page)
-        soup = BeautifulSoup(html, "lxml")
-        h = soup.find(id="Plot").find_parent()
-        elem = h.find_next_sibling()
-        while elem.name == "p":
-            plot = plot + elem.text
-            elem = elem.find_next_sibling()
-    except:
-        pass
-    return plot
-
-
-def __extract_movie_plot(movie_url_list):
-    """Run through the movie URL list and extract movie plot for each movie"""
-    plots = []
-    for url in tqdm(movie_url_list):
-        plot = __get_plot(url)
-        plots.append(plot)
-    return plots
+def __load_checkpoints(checkpoint_dir):
+    """plots saved by earlier (interrupted) runs as url -> plot, and number of shards"""
+    files = sorted(glob.glob(os.path.join(checkpoint_dir, "shard_*.parquet")))
+    if not files:
+        return {}, 0
+    df = pd.concat([pd.read_parquet(f) for f in files])
+    return dict(zip(df["url"], df["plot"])), len(files)
 
 
-def __process_one_year(year_page, base_url, movie_list):
-    """Process the page containing movie list for one year and collect the details"""
-    # create soup object from html obtained for parsing
-    soup = BeautifulSoup(year_page, "lxml")
-    all_tables = soup.find_all("table", class_="wikitable")
-    for table in all_tables:
-        # locate the tables containing list of movies for this year
-        ths = table.find_all("th")
-        if ths:
-            th_text = [th.text.strip() for th in ths]
-            # if this is our table with list of movies then extract the movie tile and URL
-            if "Production company" in th_text and "Title" in th_text:
-                trs = table.tbody.find_all("tr")
-                for tr in trs:
-                    movie = tr.find_all("i")
-                    # if tag found i.e. its non-empty
-                    if movie:
-                        a = movie[0].find("a")
-                        if a:
-                            movie_list["url"].append(base_url + a["href"])
-                            movie_list["title"].append(movie[0].a["title"])
-    return movie_list
+def __save_checkpoint(checkpoint_dir, n_shard, plots):
+    """save the plots (url -> plot) of one chunk of movie urls as a parquet shard"""
+    shard_file = os.path.join(checkpoint_dir, f"shard_{n_shard:05d}.parquet")
+    pd.DataFrame({"url": list(plots), "plot": list(plots.values())}).to_parquet(
+        shard_file
+    )
+
+
+def __extract_movie_plot(
+    movie_url_list,
+    fetcher,
+    known_plots=None,
+    revalidate=False,
+    checkpoint_dir=None,
+    checkpoint_every=500,
+    parser="lxml-section",
+    executor=None,
+):
+    """
+    Fetch all movie URLs concurrently and extract movie plot for each movie.
+    `known_plots` (url -> plot) of an earlier run are re-used without fetching, or
+    with `revalidate` only when the server says the page didn't change (304).
+    URLs are processed in chunks of `checkpoint_every`, the pages of a chunk are
+    parsed by the workers of `executor` while the next chunk is being fetched, the
+    plots of every chunk are saved as a parquet shard in `checkpoint_dir` so that an
+    interrupted run resumes where it stopped.
+    """
+    known_plots = known_plots or {}
+    done = {}
+    n_shards = 0
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        done, n_shards = __load_checkpoints(checkpoint_dir)
+        if done:
+            print(f"Resuming from {len(done)} checkpointed movie urls")
+    if not revalidate:
+        done.update(
+            {url: known_plots[url] for url in movie_url_list if url in known_plots}
+        )
+    todo = list(dict.fromkeys(url for url in movie_url_list if url not in done))
+    print(f"{len(todo)} of {len(movie_url_list)} movie urls to fetch")
+
+    parse_time = 0.0
+    n_empty = 0
+    pending = None
+    for start in range(0, len(todo) + checkpoint_every, checkpoint_every):
+        chunk = todo[start : start + checkpoint_every]
+        submitted = None
+        if chunk:
+            results = fetcher.fetch_all(chunk, desc="movie pages")
+            ### failed urls are left out of the checkpoint to be retried on resume
+            fetched = {}
+            to_parse = []
+            for result in results:
+                if not result.ok:
+                    continue
+                if result.from_cache and result.url in known_plots:
+                    fetched[result.url] = known_plots[result.url]
+                else:
+                    to_parse.append(result)
+            plots = parse_plots(
+                [r.body for r in to_parse], parser, executor, timed=True
+            )
+            submitted = (fetched, to_parse, plots)
+        ### collect the previous chunk, parsed in the background during this fetch
+        if pending is not None:
+            fetched, to_parse, plots = pending
+            for result, (plot, seconds) in zip(to_parse, plots):
+                parse_time += seconds
+                ### a page without a plot (or the parser failing on it) is left out
+                ### of the checkpoint too, it is fetched & parsed again on resume
+                if plot:
+                    fetched[result.url] = plot
+                else:
+                    n_empty += 1
+            done.update(fetched)
+            if checkpoint_dir is not None and fetched:
+                __save_checkpoint(checkpoint_dir, n_shards, fetched)
+                n_shards += 1
+        pending = submitted
+        if not chunk:
+            break
+    if todo:
+        ### time spent parsing in the workers (summed), the fetches it overlaps with
+        ### are not counted
+        print(f"Parsed movie pages with [{parser}] parser in {parse_time:.1f}s")
+        if n_empty:
+            print(f"{n_empty} movie pages without a plot, retried on the next run")
+    plots = [done.get(url, "") for url in movie_url_list]
+    return plots
 
 
-def __process_yearly_list(yearly_list_url, base_url):
-    """Run through the list of years and process each year one by one and grab the movie URLS"""
-    movie_list = {"url": [], "title": []}
-    for url in yearly_list_url:
-        try:
-            html = request.urlopen(url)
-            movie_list = __process_one_year(html, base_url, movie_list)
-        except:
-            pass
+def __process_yearly_list(
+    yearly_list_url, base_url, fetcher, parser="lxml-section", executor=None
+):
+    """
+    Fetch the list of years concurrently and process each year to grab the movie URLS,
+    the release year of a movie is the year of the list it was found in
+    """
+    movie_list = {"url": [], "title": [], "year": []}
+    results = [r for r in fetcher.fetch_all(yearly_list_url, desc="year pages") if r.ok]
+    year_links = parse_year_pages([r.body for r in results], base_url, parser, executor)
+    for result, movie_links in zip(results, year_links):
+        if movie_links is None:
+            print(f"Failed to parse year page [{result.url}]")
+            continue
+        year = int(result.url.rsplit("_", 1)[-1])
+        for url, title in movie_links:
+            movie_list["url"].append(url)
+            movie_list["title"].append(title)
+            movie_list["year"].append(year)
     return movie_list
 
 
@@ -73,10 +138,55 @@ def __get_url_list_by_year(root_url, start_year, end_year):
     return yearly_list_url
 
 
-def preprocess_data(start_year, end_year):
-    """main function to orchestrate data processing"""
+def __print_fetch_stats(fetcher):
+    """report the timing and errors of all the requests made"""
+    stats = fetcher.stats()
+    print(
+        f"Fetched {stats['urls']} urls in {stats['wall_time_s']:.1f}s "
+        f"({stats['urls_per_s']:.1f} urls/s, {stats['bytes'] / 2**20:.1f} MB), "
+        f"latency mean {stats['mean_s']:.2f}s p50 {stats['p50_s']:.2f}s "
+        f"p95 {stats['p95_s']:.2f}s, {stats['retries']} retries"
+    )
+    if stats["not_modified"]:
+        print(f"{stats['not_modified']} urls not modified, served from the cache")
+    if stats["failed"]:
+        print(f"{stats['failed']} urls failed: {stats['errors']}")
+
+
+def preprocess_data(
+    start_year,
+    end_year,
+    base_url="https://en.wikipedia.org",
+    max_workers=8,
+    rate_limit=20,
+    cache_dir=None,
+    checkpoint_dir=None,
+    previous_file=None,
+    revalidate=False,
+    parser="lxml-section",
+    parse_workers=None,
+):
+    """
+    main function to orchestrate data processing, pages are fetched by `max_workers`
+    threads with at most `rate_limit` requests per second. `base_url` can point to a
+    local stand-in (see `wiki_standin.py`) serving saved pages.
+    Fetched pages are cached in `cache_dir` and re-validated with conditional
+    requests, progress is checkpointed in `checkpoint_dir`. Incremental mode: plots
+    of a `previous_file` (earlier movie_plots.parquet) are re-used, only new movies
+    are fetched, or with `revalidate` also the movie pages changed since.
+    Pages are parsed with the given `parser` (see `html_parsing.py`) by a pool of
+    `parse_workers` processes (all cores when None, in this process when 1)
+    """
+    cache = HTTPCache(cache_dir) if cache_dir is not None else None
+    fetcher = Fetcher(max_workers=max_workers, rate_limit=rate_limit, cache=cache)
+    known_plots = {}
+    if previous_file is not None and os.path.exists(previous_file):
+        df_previous = pd.read_parquet(previous_file, columns=["url", "plot"])
+        known_plots = dict(zip(df_previous["url"], df_previous["plot"]))
+        print(
+            f"Incremental mode, {len(known_plots)} plots known from [{previous_file}]"
+        )
     # Get the list of URL containing movie list by year
-    base_url = "https://en.wikipedia.org"
     root_url = base_url + "/wiki/List_of_American_films_of_"
     print(f"\nBuilding yearly url list from year {start_year} to {end_year}...")
     yearly_list_url = __get_url_list_by_year(root_url, start_year, end_year)
@@ -85,12 +195,30 @@ def preprocess_data(start_year, end_year):
     # Run through the list of years and process each year one by one and grab the
     # movie URLS
     print(f"Building movie url list from yearly url list...")
-    movie_list = __process_yearly_list(yearly_list_url, base_url)
-    print(f"DONE. Collected {len(movie_list['url'])} movie urls\n")
+    executor = None
+    if parse_workers != 1:
+        executor = ProcessPoolExecutor(max_workers=parse_workers)
+    try:
+        movie_list = __process_yearly_list(
+            yearly_list_url, base_url, fetcher, parser, executor
+        )
+        print(f"DONE. Collected {len(movie_list['url'])} movie urls\n")
 
-    # Extract the plot from each movie URL
-    print(f"Extracting movie plot from movie urls...")
-    movie_plots = __extract_movie_plot(movie_list["url"])
+        # Extract the plot from each movie URL
+        print(f"Extracting movie plot from movie urls...")
+        movie_plots = __extract_movie_plot(
+            movie_list["url"],
+            fetcher,
+            known_plots=known_plots,
+            revalidate=revalidate,
+            checkpoint_dir=checkpoint_dir,
+            parser=parser,
+            executor=executor,
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    __print_fetch_stats(fetcher)
 
     # Save the collected movie data as compressed parquet file and failed URLS as CSV
     movie_list["plot"] = movie_plots
@@ -105,12 +233,15 @@ def preprocess_data(start_year, end_year):
     return df, df_failed
 
 
-def save_data(df, df_failed, parquet_data_file_, csv_fail_file):
-    """function to write processed data to disk"""
+def save_data(df, df_failed, parquet_data_file_, csv_fail_file, checkpoint_dir=None):
+    """function to write processed data to disk, checkpoints are no longer needed"""
     df.to_parquet(parquet_data_file_)
     print(f"Saved movie plots data to [{parquet_data_file_}]")
     df_failed.to_csv(csv_fail_file)
     print(f"Saved failed movie urls to [{csv_fail_file}]\n")
+    if checkpoint_dir is not None:
+        for file_name in glob.glob(os.path.join(checkpoint_dir, "shard_*.parquet")):
+            os.remove(file_name)
 
 
 if __name__ == "__main__":
@@ -119,7 +250,21 @@ if __name__ == "__main__":
     rel_dir_name = "../artifacts/"
     parquet_data_file_ = rel_dir_name + "movie_plots.parquet"
     csv_fail_file = rel_dir_name + "failed_plots.csv"
+    ### fetched pages & progress of an interrupted run are kept here
+    cache_dir = rel_dir_name + "http_cache"
+    checkpoint_dir = rel_dir_name + "crawl_checkpoints"
+    ### re-use the plots of the last run and only fetch new movies, set `revalidate`
+    ### to also re-fetch the movie pages that changed since
+    incremental = True
+    revalidate = False
 
     ### collect, pre-process and save the data
-    df, df_failed = preprocess_data(start_year, end_year)
-    save_data(df, df_failed, parquet_data_file_, csv_fail_file)
+    df, df_failed = preprocess_data(
+        start_year,
+        end_year,
+        cache_dir=cache_dir,
+        checkpoint_dir=checkpoint_dir,
+        previous_file=parquet_data_file_ if incremental else None,
+        revalidate=revalidate,
+    )
+    save_data(df, df_failed, parquet_data_file_, csv_fail_file, checkpoint_dir)
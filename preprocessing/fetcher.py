@@ -0,0 +1,242 @@
+""" Concurrent, rate-limited HTTP fetcher with keep-alive connections and retries """
+
+import http.client
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from urllib.parse import urljoin, urlsplit
+from tqdm import tqdm
+
+USER_AGENT = (
+    "movie-recommender-data-collection/1.0 "
+    "(+https://github.com/sssingh/movie-recommender)"
+)
+### statuses worth retrying, everything else is final
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class FetchResult:
+    """outcome of fetching one URL"""
+
+    url: str
+    status: int = 0
+    body: bytes = b""
+    headers: dict = field(default_factory=dict)
+    size: int = 0
+    elapsed: float = 0.0
+    attempts: int = 0
+    error: str = ""
+    ### body served from the cache after a 304 Not Modified
+    from_cache: bool = False
+
+    @property
+    def ok(self):
+        return self.status == 200
+
+
+class RateLimiter:
+    """allow at most `rate` requests per second across all threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Fetcher:
+    """
+    Fetch many URLs with a pool of `max_workers` threads. Every thread keeps one
+    keep-alive connection per host, requests are spread to at most `rate_limit` per
+    second (None for no limit), failures are retried `max_retries` times with
+    exponential backoff. Timing & errors of every URL are kept for `stats()`.
+    With an `HTTPCache` every cached URL is requested conditionally (ETag /
+    Last-Modified) and a 304 Not Modified is answered with the cached body.
+    """
+
+    def __init__(
+        self,
+        max_workers=8,
+        rate_limit=None,
+        max_retries=3,
+        backoff=0.5,
+        timeout=30,
+        max_redirects=5,
+        cache=None,
+    ):
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.cache = cache
+        self.local = threading.local()
+        self.results = []
+        self.results_lock = threading.Lock()
+        self.wall_time = 0.0
+
+    def _connection(self, scheme, netloc):
+        """this thread's keep-alive connection to the given host, opened on demand"""
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+        key = (scheme, netloc)
+        if key not in connections:
+            connection_class = (
+                http.client.HTTPSConnection
+                if scheme == "https"
+                else http.client.HTTPConnection
+            )
+            connections[key] = connection_class(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def _drop_connection(self, scheme, netloc):
+        """close a broken connection so that the next request opens a fresh one"""
+        connection = self.local.connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _request(self, url, headers):
+        """one GET request following redirects, returns (status, body, headers)"""
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request(
+                    "GET", path, headers={"User-Agent": USER_AGENT, **headers}
+                )
+                response = connection.getresponse()
+                ### the body must be read completely before the connection is reused
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                self._drop_connection(parts.scheme, parts.netloc)
+                raise
+            if response.will_close:
+                self._drop_connection(parts.scheme, parts.netloc)
+            response_headers = {k.lower(): v for k, v in response.getheaders()}
+            if response.status in (301, 302, 303, 307, 308):
+                url = urljoin(url, response_headers.get("location", ""))
+                continue
+            return response.status, body, response_headers
+        raise http.client.HTTPException(f"Too many redirects for [{url}]")
+
+    def _fetch_with_retries(self, result, url, headers):
+        """one request retried on network errors & retryable statuses, into `result`"""
+        for attempt in range(1, self.max_retries + 2):
+            result.attempts += 1
+            retry_after = None
+            try:
+                status, body, response_headers = self._request(url, headers)
+                result.status = status
+                result.body = body
+                result.size = len(body)
+                result.headers = response_headers
+                result.error = "" if status in (200, 304) else f"HTTP {status}"
+                if status not in RETRY_STATUSES:
+                    break
+                retry_after = response_headers.get("retry-after")
+            except (http.client.HTTPException, OSError) as e:
+                result.error = f"{type(e).__name__}: {e}"
+            if attempt <= self.max_retries:
+                delay = self.backoff * 2 ** (attempt - 1) * (1 + random.random())
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                time.sleep(delay)
+
+    def fetch(self, url, headers=None):
+        """fetch one URL with retries, never raises: errors end up in the result"""
+        result = FetchResult(url=url)
+        start = time.perf_counter()
+        headers = headers or {}
+        if self.cache is None:
+            self._fetch_with_retries(result, url, headers)
+        else:
+            self._fetch_with_retries(
+                result, url, {**self.cache.validators(url), **headers}
+            )
+            self._use_cache(result)
+            if result.status == 304:
+                ### the cached body was evicted since the validators were read, the
+                ### page is requested again without them
+                self._fetch_with_retries(result, url, headers)
+                self._use_cache(result)
+        result.elapsed = time.perf_counter() - start
+        ### keep everything but the body (could be a lot of memory) for `stats()`
+        with self.results_lock:
+            self.results.append(replace(result, body=b""))
+        return result
+
+    def _use_cache(self, result):
+        """store a fresh body in the cache or answer a 304 with the cached one"""
+        if result.status == 200:
+            self.cache.put(result.url, result.body, result.headers)
+        elif result.status == 304:
+            body = self.cache.get(result.url)
+            if body is None:
+                result.error = "304 without cached body"
+                return
+            self.cache.touch(result.url)
+            result.status = 200
+            result.body = body
+            result.from_cache = True
+
+    def fetch_all(self, urls, headers=None, desc=None):
+        """fetch all URLs concurrently, results are returned in the order of `urls`"""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(
+                tqdm(
+                    executor.map(lambda url: self.fetch(url, headers), urls),
+                    total=len(urls),
+                    desc=desc,
+                )
+            )
+        self.wall_time += time.perf_counter() - start
+        return results
+
+    def stats(self):
+        """summary of all requests made so far: counts, errors, latency & throughput"""
+        with self.results_lock:
+            results = list(self.results)
+        elapsed = sorted(r.elapsed for r in results)
+        errors = {}
+        for r in results:
+            if r.error:
+                kind = r.error.split(":")[0]
+                errors[kind] = errors.get(kind, 0) + 1
+
+        def _percentile(p):
+            return (
+                elapsed[min(int(p * len(elapsed)), len(elapsed) - 1)] if elapsed else 0
+            )
+
+        return {
+            "urls": len(results),
+            "ok": sum(r.ok for r in results),
+            "failed": sum(bool(r.error) for r in results),
+            "retries": sum(r.attempts - 1 for r in results),
+            "not_modified": sum(r.from_cache for r in results),
+            "errors": errors,
+            "bytes": sum(r.size for r in results),
+            "mean_s": sum(elapsed) / len(elapsed) if elapsed else 0,
+            "p50_s": _percentile(0.5),
+            "p95_s": _percentile(0.95),
+            "wall_time_s": self.wall_time,
+            "urls_per_s": len(results) / self.wall_time if self.wall_time else 0,
+        }
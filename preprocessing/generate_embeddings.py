@@ -1,37 +1,170 @@
 """
 Generate TF-IDF & SBERT embeddings for a given text corpus and save data to disk in 
-parquet format
+parquet format (TF-IDF as sparse CSR arrays in a numpy `.npz` file, SBERT streamed in
+resumable batches into a memory-mapped `.npy` file)
 """
 
+import json
+import os
+import sys
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
+import torch
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
 from sentence_transformers import SentenceTransformer
+from tqdm import tqdm
+
+### the manifest & embedding loaders are shared with the app, which lives in the
+### repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from manifest import (
+    artifact_rows,
+    load_manifest,
+    plot_keys,
+    record_artifact,
+    save_corpus_keys,
+)
+from similarity import load_sparse_embeddings
 
 
 def __generate_tfidf_embeddings(df):
     """function to generate TF-IDF embeddings"""
     ### get a TF-IDF representation of text, returned values are sparse vectors
+    ### with L2-normalized rows, they are kept sparse (a dense vocabulary-wide matrix
+    ### is too large to deploy)
     print(f"Generating TF-IDF embeds for movie plot text...")
-    vec = TfidfVectorizer()
-    X = vec.fit_transform(df["plot"]).toarray()
+    vec = TfidfVectorizer(dtype=np.float32)
+    X = vec.fit_transform(df["plot"])
+    return X, vec.get_feature_names_out().astype(str), vec.idf_.astype(np.float32)
+
+
+def __update_tfidf_embeddings(df, previous_file, previous_rows):
+    """
+    function to update TF-IDF embeddings: rows of unchanged movies are copied from
+    `previous_file`, only new or changed plots are transformed with the vocabulary
+    and idf fitted earlier (terms that are new to the corpus are not in it)
+    """
+    with np.load(previous_file, allow_pickle=False) as data:
+        terms, idf = data["terms"], data["idf"]
+    X_previous = load_sparse_embeddings(previous_file)
+    kept = np.flatnonzero(previous_rows >= 0)
+    changed = np.flatnonzero(previous_rows < 0)
+    print(f"Updating TF-IDF embeds of {len(changed)} new or changed movie plots...")
+    ### same as `TfidfVectorizer.transform`: term counts scaled by idf, L2-normalized
+    counts = CountVectorizer(vocabulary=terms, dtype=np.float32).transform(
+        df["plot"].iloc[changed]
+    )
+    X_changed = normalize(sp.csr_matrix(counts.multiply(idf)))
+    ### stack kept & changed rows, then put them back in corpus order
+    order = np.empty(len(df), dtype=np.int64)
+    order[kept] = np.arange(len(kept))
+    order[changed] = len(kept) + np.arange(len(changed))
+    X = sp.vstack([X_previous[previous_rows[kept]], X_changed], format="csr")[order]
+    return X.astype(np.float32), terms, idf
+
+
+def __load_progress(progress_file, settings):
+    """number of rows already embedded by an interrupted run with the same settings"""
+    if not os.path.exists(progress_file):
+        return 0
+    with open(progress_file) as f:
+        progress = json.load(f)
+    if progress["settings"] != settings:
+        print(f"Ignoring [{progress_file}], the corpus or settings have changed")
+        return 0
+    return progress["done"]
+
 
-    ### convert sparse vectors into a dataframe
-    df_embeddings = pd.DataFrame(X)
-    return df_embeddings
+def __save_progress(progress_file, settings, done):
+    """record the number of rows embedded, written atomically"""
+    with open(progress_file + ".tmp", "w") as f:
+        json.dump({"settings": settings, "done": done}, f)
+    os.replace(progress_file + ".tmp", progress_file)
 
 
-def __generate_sbert_embeddings(df):
-    """function to generate SBERT embeddings"""
+def __generate_sbert_embeddings(
+    input_file,
+    npy_output_file,
+    batch_size=4096,
+    encode_batch_size=64,
+    n_threads=None,
+    version=None,
+    previous_rows=None,
+):
+    """
+    function to generate SBERT embeddings, streamed: plots are read from the parquet
+    file `batch_size` at a time, encoded with `n_threads` CPU threads (all cores
+    when None) and every batch is written to a memory-mapped `.npy` file, so memory
+    doesn't grow with the corpus. progress is recorded after every batch and an
+    interrupted run resumes from the last completed batch. the embeddings are
+    L2-normalized, stored as float32 (memory-mapped as is by the app, without a copy)
+    and the `.npy` file is moved in place when done.
+    `previous_rows` (see `manifest.row_mapping`) gives for every movie its row in the
+    existing `.npy` file, only movies without one (-1) are encoded, the others are
+    copied. returns the number of plots encoded
+    """
     ### get a SBERT representation of a plot, returned values are 384 dim vector
     print(f"Generating SBERT embeds for movie plot text...")
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
     model = SentenceTransformer("all-MiniLM-L6-v2")
-    sentence_embeddings = model.encode(df["plot"])
+    n_dims = model.get_sentence_embedding_dimension()
+    plots = pq.ParquetFile(input_file)
+    n_rows = plots.metadata.num_rows
+    previous = None
+    if previous_rows is not None:
+        previous = np.load(npy_output_file, mmap_mode="r")
 
-    ### convert sparse vectors into a dataframe
-    df_embeddings = pd.DataFrame(sentence_embeddings)
-    return df_embeddings
+    partial_file = npy_output_file + ".partial"
+    progress_file = npy_output_file + ".progress.json"
+    settings = {"rows": n_rows, "dims": n_dims, "dtype": "float32", "corpus": version}
+    done = 0
+    if os.path.exists(partial_file):
+        done = __load_progress(progress_file, settings)
+    if done:
+        print(f"Resuming from row {done} of {n_rows}")
+        embeddings = np.load(partial_file, mmap_mode="r+")
+    else:
+        embeddings = np.lib.format.open_memmap(
+            partial_file, mode="w+", dtype=np.float32, shape=(n_rows, n_dims)
+        )
+
+    start = 0
+    n_encoded = 0
+    with tqdm(total=n_rows, initial=done) as progress_bar:
+        for batch in plots.iter_batches(batch_size=batch_size, columns=["plot"]):
+            stop = start + batch.num_rows
+            ### skip the rows embedded by an earlier run
+            if stop > done:
+                first = max(done, start)
+                texts = np.array(batch.column("plot").to_pylist()[first - start :])
+                rows = np.arange(first, stop)
+                ### unchanged movies are copied from the existing embeddings
+                encode = np.ones(len(rows), dtype=bool)
+                if previous is not None:
+                    encode = previous_rows[rows] < 0
+                    embeddings[rows[~encode]] = previous[previous_rows[rows[~encode]]]
+                if encode.any():
+                    embeddings[rows[encode]] = model.encode(
+                        list(texts[encode]),
+                        batch_size=encode_batch_size,
+                        normalize_embeddings=True,
+                    )
+                    n_encoded += int(encode.sum())
+                embeddings.flush()
+                __save_progress(progress_file, settings, stop)
+                progress_bar.update(stop - first)
+            start = stop
+    del embeddings, previous
+    os.replace(partial_file, npy_output_file)
+    os.remove(progress_file)
+    print(f"Encoded {n_encoded} of {n_rows} movie plots")
+    print(f"Saved normalized float32 embeddings to [{npy_output_file}]\n")
+    return n_encoded
 
 
 def __read_plot_corpus(input_file):
@@ -42,26 +175,99 @@ def __read_plot_corpus(input_file):
     return df
 
 
-def __save_embeddings(df, parquet_output_file):
-    """function to write processed data to disk"""
-    ### store the embeddings as arrow table in a parquet file
-    table = pa.Table.from_pandas(df)
-    pq.write_table(table, parquet_output_file)
+def __save_embeddings(npy_file, parquet_output_file, batch_size=4096):
+    """function to write embeddings to disk, copied from the `.npy` file in batches"""
+    ### store the embeddings as arrow table in a parquet file, one row group a batch
+    embeddings = np.load(npy_file, mmap_mode="r")
+    schema = pa.schema([(str(i), pa.float32()) for i in range(embeddings.shape[1])])
+    with pq.ParquetWriter(parquet_output_file, schema) as writer:
+        for start in range(0, len(embeddings), batch_size):
+            batch = np.asarray(embeddings[start : start + batch_size], dtype=np.float32)
+            writer.write_table(pa.Table.from_arrays(list(batch.T), schema=schema))
     print(f"Saved embeddings to [{parquet_output_file}]\n")
 
 
+def __save_sparse_embeddings(X, terms, idf, npz_output_file):
+    """
+    function to write sparse embeddings as CSR arrays (data, indices, indptr, shape)
+    together with the fitted vocabulary (terms ordered by column) and idf vector
+    """
+    X = X.tocsr()
+    np.savez(
+        npz_output_file,
+        data=X.data,
+        indices=X.indices,
+        indptr=X.indptr,
+        shape=np.array(X.shape),
+        terms=terms,
+        idf=idf,
+    )
+    print(f"Saved sparse embeddings to [{npz_output_file}]\n")
+
+
 if __name__ == "__main__":
     target_dir = "../artifacts/"
     input_file = target_dir + "movie_plots.parquet"
-    tfidf_output_file = target_dir + "tfidf_embeddings.parquet"
+    tfidf_output_file = target_dir + "tfidf_embeddings.npz"
     sbert_output_file = target_dir + "sbert_embeddings.parquet"
+    sbert_npy_output_file = target_dir + "sbert_embeddings.npy"
+    ### SBERT knobs: plots read & checkpointed per batch, plots per forward pass and
+    ### CPU threads used by the model (None for all cores)
+    batch_size = 4096
+    encode_batch_size = 64
+    n_threads = None
+
+    ### only encode new or changed plots and copy the rest from the existing files,
+    ### TF-IDF is re-fitted when more than this fraction of the plots is new/changed
+    incremental = True
+    tfidf_refit_fraction = 0.2
 
     ### load the dataframe containing the movie plot corpus
     df_plots = __read_plot_corpus(input_file)
+    ### key every row by movie id & plot hash, the manifest records which corpus
+    ### version every artifact was built from
+    keys = plot_keys(df_plots["url"], df_plots["plot"])
+    version = save_corpus_keys(target_dir, keys)
+    manifest = load_manifest(target_dir)
+    print(f"Corpus version [{version}], {len(keys)} movies")
 
     ### generate and save TFIDF embeddings
-    df_embeddings = __generate_tfidf_embeddings(df_plots)
-    __save_embeddings(df_embeddings, tfidf_output_file)
-    ### generate and save SBERT embeddings
-    df_embeddings = __generate_sbert_embeddings(df_plots)
-    __save_embeddings(df_embeddings, sbert_output_file)
+    previous_rows = None
+    if incremental and os.path.exists(tfidf_output_file):
+        previous_rows = artifact_rows(
+            target_dir, manifest, os.path.basename(tfidf_output_file)
+        )
+    if previous_rows is not None and (previous_rows < 0).mean() <= tfidf_refit_fraction:
+        X, terms, idf = __update_tfidf_embeddings(
+            df_plots, tfidf_output_file, previous_rows
+        )
+        n_encoded = int((previous_rows < 0).sum())
+    else:
+        X, terms, idf = __generate_tfidf_embeddings(df_plots)
+        n_encoded = len(df_plots)
+    __save_sparse_embeddings(X, terms, idf, tfidf_output_file)
+    record_artifact(
+        target_dir, os.path.basename(tfidf_output_file), version, encoded=n_encoded
+    )
+    del df_plots, X
+
+    ### generate and save SBERT embeddings, streamed from the plots file
+    previous_rows = None
+    if incremental and os.path.exists(sbert_npy_output_file):
+        previous_rows = artifact_rows(
+            target_dir, manifest, os.path.basename(sbert_npy_output_file)
+        )
+    n_encoded = __generate_sbert_embeddings(
+        input_file,
+        sbert_npy_output_file,
+        batch_size=batch_size,
+        encode_batch_size=encode_batch_size,
+        n_threads=n_threads,
+        version=version,
+        previous_rows=previous_rows,
+    )
+    record_artifact(
+        target_dir, os.path.basename(sbert_npy_output_file), version, encoded=n_encoded
+    )
+    __save_embeddings(sbert_npy_output_file, sbert_output_file, batch_size)
+    record_artifact(target_dir, os.path.basename(sbert_output_file), version)
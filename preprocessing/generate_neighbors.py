@@ -0,0 +1,95 @@
+"""
+Precompute the top-N most similar movies of every movie for each embedding type and
+save them to disk in parquet format, so that the app answers a recommendation with a
+lookup instead of scoring the whole corpus
+"""
+
+import os
+import sys
+import pyarrow.parquet as pq
+
+### the similarity code is shared with the app, which lives in the repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from manifest import artifact_rows, artifact_version, load_manifest, record_artifact
+from movie_store import load_engine
+from neighbors import (
+    compute_neighbors,
+    load_neighbors,
+    save_neighbors,
+    update_neighbors,
+)
+
+
+def __generate_neighbors(engine, n_neighbors, block_size):
+    """function to compute the neighbour table for all movies of an engine"""
+    print(f"Computing top-{n_neighbors} neighbours for {len(engine)} movies...")
+    return compute_neighbors(engine, n_neighbors=n_neighbors, block_size=block_size)
+
+
+def __table_width(neighbors_file):
+    """number of neighbours per movie of a saved table, read from its schema only"""
+    return len(pq.read_schema(neighbors_file).names) // 2
+
+
+def __update_neighbors(engine, previous_file, previous_rows, n_neighbors, block_size):
+    """function to update the neighbour table of an earlier version of the corpus"""
+    n_changed = int((previous_rows < 0).sum())
+    print(
+        f"Updating top-{n_neighbors} neighbours for {n_changed} new or changed movies..."
+    )
+    neighbors, scores = load_neighbors(previous_file)
+    return update_neighbors(
+        engine,
+        neighbors,
+        scores,
+        previous_rows,
+        n_neighbors=n_neighbors,
+        block_size=block_size,
+    )
+
+
+if __name__ == "__main__":
+    target_dir = "../artifacts/"
+    ### the app shows at most 5 recommendations, diversified ones are picked from the
+    ### 3 * 5 most similar movies (see `recommender.POOL_FACTOR`)
+    n_neighbors = 15
+    ### number of movies scored at once, bounds memory to block_size x n_movies
+    block_size = 1024
+    ### update the tables of an earlier corpus version instead of recomputing them
+    incremental = True
+
+    manifest = load_manifest(target_dir)
+    for embed in ["sbert", "tfidf"]:
+        neighbors_output_file = target_dir + f"{embed}_neighbors.parquet"
+        name = os.path.basename(neighbors_output_file)
+        print(f"Loading [{embed}] embeddings from [{target_dir}]...")
+        ### TF-IDF embeddings are optional
+        try:
+            engine = load_engine(target_dir, embed)
+        except FileNotFoundError as e:
+            print(f"Skipping [{embed}], {e}\n")
+            continue
+        previous_rows = None
+        ### a table of another width (e.g. built before `n_neighbors` was raised) is
+        ### rebuilt, the app only uses it for k up to its width
+        if (
+            incremental
+            and os.path.exists(neighbors_output_file)
+            and __table_width(neighbors_output_file) == n_neighbors
+        ):
+            if (
+                manifest["corpus"]
+                and artifact_version(manifest, name) == manifest["corpus"]
+            ):
+                print(f"[{neighbors_output_file}] is up to date\n")
+                continue
+            previous_rows = artifact_rows(target_dir, manifest, name)
+        if previous_rows is not None and len(previous_rows) == len(engine):
+            neighbors, scores = __update_neighbors(
+                engine, neighbors_output_file, previous_rows, n_neighbors, block_size
+            )
+        else:
+            neighbors, scores = __generate_neighbors(engine, n_neighbors, block_size)
+        save_neighbors(neighbors, scores, neighbors_output_file)
+        record_artifact(target_dir, name, manifest["corpus"])
+        print(f"Saved neighbours to [{neighbors_output_file}]\n")
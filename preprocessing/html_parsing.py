@@ -0,0 +1,178 @@
+"""
+Extraction of movie plots & movie lists from Wikipedia pages, the CPU-bound parser
+stage of the data collection that can run in a pool of processes. Every extraction
+comes in several flavours with the same output:
+    - bs4: BeautifulSoup tree of the whole page (the original implementation)
+    - lxml: lxml tree of the whole page searched with XPath
+    - lxml-section: only the page up to the end of the Plot section is parsed,
+      pages without a Plot section are not parsed at all
+"""
+
+import time
+from functools import partial
+from bs4 import BeautifulSoup
+import lxml.html
+
+### pages are served as UTF-8, lxml would otherwise guess latin-1 without a <meta>
+UTF8_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+WIKITABLE_XPATH = (
+    "//table[contains(concat(' ', normalize-space(@class), ' '), ' wikitable ')]"
+)
+
+
+def get_plot_bs4(html):
+    """Parse the given movie webpage, extract and return the plot text for this movie"""
+    plot = ""
+    try:
+        soup = BeautifulSoup(html, "lxml")
+        h = soup.find(id="Plot").find_parent()
+        elem = h.find_next_sibling()
+        while elem.name == "p":
+            plot = plot + elem.text
+            elem = elem.find_next_sibling()
+    ### page has no plot section
+    except AttributeError:
+        pass
+    return plot
+
+
+def __parse_tree(html):
+    """lxml tree of a page given as bytes or str"""
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    return lxml.html.document_fromstring(html, parser=UTF8_PARSER)
+
+
+def __plot_from_tree(root):
+    """text of the paragraphs following the heading of the Plot section"""
+    plot_ids = root.xpath("(//*[@id='Plot'])[1]")
+    if not plot_ids or plot_ids[0].getparent() is None:
+        return ""
+    plot = ""
+    for elem in plot_ids[0].getparent().itersiblings():
+        if elem.tag != "p":
+            break
+        plot = plot + elem.text_content()
+    return plot
+
+
+def get_plot_lxml(html):
+    """same as `get_plot_bs4` on an lxml tree, several times faster"""
+    try:
+        return __plot_from_tree(__parse_tree(html))
+    ### empty or unparsable page
+    except lxml.etree.ParserError:
+        return ""
+
+
+def get_plot_section(html):
+    """
+    same as `get_plot_lxml` but only the page up to the next section heading after
+    the Plot heading is parsed (unclosed tags are closed by the parser), the rest of
+    the page (cast, reception, references...) is never looked at
+    """
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    pos = html.find(b'id="Plot"')
+    if pos < 0:
+        return ""
+    end = html.find(b"<h2", pos)
+    return get_plot_lxml(html if end < 0 else html[:end])
+
+
+PLOT_PARSERS = {
+    "bs4": get_plot_bs4,
+    "lxml": get_plot_lxml,
+    "lxml-section": get_plot_section,
+}
+
+
+def get_movie_links_bs4(year_page, base_url):
+    """
+    Process the page containing movie list for one year and collect the details,
+    returns a list of (url, title)
+    """
+    movie_links = []
+    # create soup object from html obtained for parsing
+    soup = BeautifulSoup(year_page, "lxml")
+    all_tables = soup.find_all("table", class_="wikitable")
+    for table in all_tables:
+        # locate the tables containing list of movies for this year
+        ths = table.find_all("th")
+        if ths:
+            th_text = [th.text.strip() for th in ths]
+            # if this is our table with list of movies then extract the movie tile and URL
+            if "Production company" in th_text and "Title" in th_text:
+                trs = table.tbody.find_all("tr")
+                for tr in trs:
+                    movie = tr.find_all("i")
+                    # if tag found i.e. its non-empty
+                    if movie:
+                        a = movie[0].find("a")
+                        if a:
+                            movie_links.append((base_url + a["href"], a["title"]))
+    return movie_links
+
+
+def get_movie_links_lxml(year_page, base_url):
+    """same as `get_movie_links_bs4` on an lxml tree searched with XPath"""
+    movie_links = []
+    root = __parse_tree(year_page)
+    for table in root.xpath(WIKITABLE_XPATH):
+        th_text = [th.text_content().strip() for th in table.xpath(".//th")]
+        if "Production company" in th_text and "Title" in th_text:
+            tbody = table.find(".//tbody")
+            if tbody is None:
+                raise AttributeError("movie table without tbody")
+            for tr in tbody.iter("tr"):
+                a = tr.xpath("(.//i)[1]//a[1]")
+                if a:
+                    movie_links.append((base_url + a[0].get("href"), a[0].get("title")))
+    return movie_links
+
+
+YEAR_PARSERS = {
+    "bs4": get_movie_links_bs4,
+    "lxml": get_movie_links_lxml,
+    ### a year page is one big table, there is nothing to skip
+    "lxml-section": get_movie_links_lxml,
+}
+
+
+def __timed_parse(page, parse):
+    start = time.perf_counter()
+    plot = parse(page)
+    return plot, time.perf_counter() - start
+
+
+def parse_plots(pages, parser="lxml-section", executor=None, chunksize=16, timed=False):
+    """
+    extract the plots of movie pages, in this process or in the worker processes of
+    `executor` (a `ProcessPoolExecutor`). pages are sent to the workers `chunksize`
+    at a time to keep the inter-process overhead low. with an executor the plots are
+    returned as an iterator right away while the workers are parsing. when `timed`
+    every plot comes as (plot, seconds spent parsing its page), timed where it is
+    parsed so the time doesn't include waiting for the workers
+    """
+    parse = PLOT_PARSERS[parser]
+    if timed:
+        parse = partial(__timed_parse, parse=parse)
+    if executor is None:
+        return [parse(page) for page in pages]
+    return executor.map(parse, pages, chunksize=chunksize)
+
+
+def __parse_year_page(page, parse, base_url):
+    try:
+        return parse(page, base_url)
+    ### unexpected page layout
+    except AttributeError:
+        return None
+
+
+def parse_year_pages(pages, base_url, parser="lxml-section", executor=None):
+    """movie links (url, title) of every year page, None for a page that failed"""
+    parse = partial(__parse_year_page, parse=YEAR_PARSERS[parser], base_url=base_url)
+    if executor is None:
+        return [parse(page) for page in pages]
+    return list(executor.map(parse, pages))
@@ -0,0 +1,96 @@
+""" On-disk, content-addressed cache of fetched pages with HTTP validators """
+
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+class HTTPCache:
+    """
+    Page bodies are stored gzipped under `root/objects/` named by the sha256 of their
+    content (identical pages are stored once), an sqlite index maps every URL to its
+    body hash and the ETag/Last-Modified validators sent by the server, so that a
+    page can be re-validated with a conditional request instead of re-downloaded.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            os.path.join(root, "index.sqlite"), check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, sha256 TEXT, "
+            "etag TEXT, last_modified TEXT, fetched_at REAL)"
+        )
+        self.db.commit()
+
+    def _object_file(self, sha256):
+        return os.path.join(self.root, "objects", sha256[:2], sha256 + ".gz")
+
+    def lookup(self, url):
+        """cache entry of a URL as a dict (without body), None if not cached"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha256, etag, last_modified, fetched_at FROM pages WHERE url=?",
+                (url,),
+            ).fetchone()
+        if row is None or not os.path.exists(self._object_file(row[0])):
+            return None
+        return dict(zip(["sha256", "etag", "last_modified", "fetched_at"], row))
+
+    def validators(self, url):
+        """conditional request headers for a cached URL, empty if not cached"""
+        entry = self.lookup(url)
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get(self, url):
+        """cached body of a URL, None if not cached"""
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        with gzip.open(self._object_file(entry["sha256"]), "rb") as f:
+            return f.read()
+
+    def put(self, url, body, headers):
+        """store a freshly fetched body with the validators of its response headers"""
+        sha256 = hashlib.sha256(body).hexdigest()
+        file_name = self._object_file(sha256)
+        if not os.path.exists(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            ### write to a temporary file first so a crash never leaves a partial body
+            tmp_file = f"{file_name}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp_file, "wb") as f:
+                f.write(body)
+            os.replace(tmp_file, file_name)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (
+                    url,
+                    sha256,
+                    headers.get("etag"),
+                    headers.get("last-modified"),
+                    time.time(),
+                ),
+            )
+            self.db.commit()
+        return sha256
+
+    def touch(self, url):
+        """mark a cached URL as re-validated (server answered 304 Not Modified)"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE pages SET fetched_at=? WHERE url=?", (time.time(), url)
+            )
+            self.db.commit()
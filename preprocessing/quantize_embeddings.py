@@ -0,0 +1,51 @@
+"""
+Encode the SBERT embeddings in compact forms (float16, int8 scalar quantization and
+product quantization), report the memory saved against the recall lost relative to
+exact float32 results and save the encodings to disk
+"""
+
+import os
+import sys
+import pandas as pd
+
+### the encodings are shared with the app, which lives in the repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from manifest import load_manifest, record_artifact
+from movie_store import load_engine
+from quantization import Float16Engine, Int8Engine, PQEngine, compression_report
+
+
+if __name__ == "__main__":
+    target_dir = "../artifacts/"
+    ### PQ knob: more subspaces is more accurate but larger (1 byte per subspace)
+    n_subspaces = 48
+    ### number of compact matches re-ranked on the exact vectors
+    rerank = 4
+
+    print(f"\nLoading SBERT embeddings from [{target_dir}]...")
+    exact = load_engine(target_dir, "sbert")
+    vectors = exact.matrix
+
+    print("Encoding embeddings...")
+    encoded = {
+        "float16": Float16Engine(vectors),
+        "int8": Int8Engine(vectors),
+        "pq": PQEngine(vectors, n_subspaces=n_subspaces),
+    }
+    for encoding, engine in encoded.items():
+        output_file = target_dir + f"sbert_embeddings_{encoding}.npz"
+        engine.save(output_file)
+        record_artifact(
+            target_dir,
+            os.path.basename(output_file),
+            load_manifest(target_dir)["corpus"],
+        )
+        print(f"Saved {encoding} embeddings to [{output_file}]")
+
+    ### the same encodings with the final top-k re-ranked on exact vectors, the
+    ### exact vectors are memory-mapped by the app hence not counted as memory used
+    engines = {"float32": exact, **encoded}
+    for encoding, engine in encoded.items():
+        engines[f"{encoding}+rerank"] = engine.with_exact(exact, rerank=rerank)
+    print("\nMemory saved & recall against exact float32 results:")
+    print(pd.DataFrame(compression_report(vectors, engines)).to_string(index=False))
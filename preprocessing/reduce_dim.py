@@ -1,34 +1,166 @@
+"""
+Reduce the SBERT embeddings to 3 dimensions with UMAP for the movie visualizer. The
+fitted scaler & UMAP model are saved next to the artifacts: after an incremental
+crawl only the new or changed movies are projected with the saved model (`transform`)
+while the others keep their coordinates, the model is only re-fitted when too much
+of the corpus has changed. UMAP can be fitted on a sample of the movies, the rest
+being projected in chunks, so time & memory don't grow with the whole catalog.
+"""
+
+import os
+import sys
+import time
+import joblib
 import numpy as np
 import pandas as pd
-import pyarrow.parquet as pq
 from sklearn.preprocessing import StandardScaler
 import umap
-import plotly.express as px
+
+### the manifest & embedding loaders are shared with the app, which lives in the
+### repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from manifest import artifact_rows, load_manifest, record_artifact
+from movie_store import load_engine
+
+COLUMNS = ["comp_1", "comp_2", "comp_3"]
+
+
+def __fit_scaler(vectors, chunk_size):
+    """function to standardize the embeddings, fitted one chunk at a time"""
+    scaler = StandardScaler()
+    for start in range(0, len(vectors), chunk_size):
+        scaler.partial_fit(np.asarray(vectors[start : start + chunk_size]))
+    return scaler
+
+
+def __fit_umap(vectors, fit_sample, chunk_size, parallel, seed=42):
+    """
+    function to fit the scaler on all the embeddings and UMAP on `fit_sample` of
+    them (all when None), returns the scaler, the model, the rows it was fitted on
+    and their coordinates. a parallel fit uses all cores but isn't reproducible
+    (UMAP only runs single threaded with a fixed random state)
+    """
+    scaler = __fit_scaler(vectors, chunk_size)
+    rows = np.arange(len(vectors))
+    if fit_sample is not None and fit_sample < len(vectors):
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(vectors), fit_sample, replace=False))
+    print(f"Fitting UMAP on {len(rows)} of {len(vectors)} movies...")
+    reducer = umap.UMAP(
+        n_components=3,
+        random_state=None if parallel else seed,
+        n_jobs=-1 if parallel else 1,
+    )
+    reduced = reducer.fit_transform(scaler.transform(np.asarray(vectors[rows])))
+    return scaler, reducer, rows, reduced
+
+
+def __transform(scaler, reducer, vectors, rows, chunk_size):
+    """function to project the given rows with a fitted model, a chunk at a time"""
+    reduced = np.empty((len(rows), len(COLUMNS)), dtype=np.float32)
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start : start + chunk_size]
+        reduced[start : start + len(chunk)] = reducer.transform(
+            scaler.transform(np.asarray(vectors[chunk]))
+        )
+        print(f"Projected {start + len(chunk)} of {len(rows)} movies")
+    return reduced
+
+
+def __load_previous(model_file, output_file, previous_rows):
+    """
+    function to load the saved model & the coordinates of an earlier version of the
+    corpus, None when either is missing
+    """
+    if previous_rows is None or not os.path.exists(model_file):
+        return None
+    if not os.path.exists(output_file):
+        return None
+    model = joblib.load(model_file)
+    previous = pd.read_parquet(output_file, columns=COLUMNS).to_numpy(np.float32)
+    if len(previous) <= previous_rows.max(initial=-1):
+        return None
+    return model, previous
+
 
 if __name__ == "__main__":
+    target_dir = "../artifacts/"
+    output_file = target_dir + "umap_reduced_data.parquet"
+    ### fitted StandardScaler & UMAP model, re-used to project new movies
+    model_file = target_dir + "umap_model.joblib"
+    ### number of movies UMAP is fitted on (None for all), the rest are projected
+    fit_sample = 50_000
+    ### movies projected at once, bounds the memory of the projection
+    chunk_size = 20_000
+    ### fit UMAP on all cores, the layout is then not reproducible run to run
+    parallel = False
+    ### project only new or changed movies with the saved model, UMAP is re-fitted
+    ### when more than this fraction of the movies is new/changed
+    incremental = True
+    refit_fraction = 0.2
+
     ### load the movie data
-    input_file = "../artifacts/movie_plots.parquet"
+    input_file = target_dir + "movie_plots.parquet"
     print(f"\nLoading movie data from [{input_file}]...")
-    df = pd.read_parquet("../artifacts/movie_plots.parquet")
-    ### load sbert embeds as pandas dataframe of 384 columns
-    input_file = "../artifacts/sbert_embeddings.parquet"
-    print(f"Loading embeddings from [{input_file}]...")
-    sbert_df = pq.read_table(input_file).to_pandas()
-
-    ## standardize the data, this helps UMAP to converge quickly and produce better o/p
-    scaler = StandardScaler()
-    sbert_df = pd.DataFrame(scaler.fit_transform(sbert_df))
+    df = pd.read_parquet(input_file, columns=["url", "title"])
+    ### SBERT embeddings, memory-mapped when generated as `.npy`
+    print(f"Loading SBERT embeddings from [{target_dir}]...")
+    vectors = load_engine(target_dir, "sbert").matrix
+    manifest = load_manifest(target_dir)
+    start = time.perf_counter()
 
-    ### use UMAP to reduce sbert dimention to 3
-    print(f"Running UMAP...")
-    reducer = umap.UMAP(n_components=3, random_state=42)
-    reduced = reducer.fit_transform(sbert_df)
+    previous = None
+    if incremental:
+        previous_rows = artifact_rows(
+            target_dir, manifest, os.path.basename(output_file)
+        )
+        previous = __load_previous(model_file, output_file, previous_rows)
+    if previous is not None and (previous_rows < 0).mean() <= refit_fraction:
+        ### copy the coordinates of unchanged movies, project the others
+        (model, reduced_previous), rows = previous, np.flatnonzero(previous_rows < 0)
+        print(f"Projecting {len(rows)} new or changed movies with [{model_file}]...")
+        reduced = np.empty((len(df), len(COLUMNS)), dtype=np.float32)
+        kept = np.flatnonzero(previous_rows >= 0)
+        reduced[kept] = reduced_previous[previous_rows[kept]]
+        reduced[rows] = __transform(
+            model["scaler"], model["reducer"], vectors, rows, chunk_size
+        )
+        n_projected = len(rows)
+    else:
+        ### standardize the data, this helps UMAP to converge quickly and produce
+        ### better o/p, then use UMAP to reduce sbert dimention to 3
+        scaler, reducer, fitted, reduced_fitted = __fit_umap(
+            vectors, fit_sample, chunk_size, parallel
+        )
+        reduced = np.empty((len(df), len(COLUMNS)), dtype=np.float32)
+        reduced[fitted] = reduced_fitted
+        rows = np.setdiff1d(np.arange(len(df)), fitted)
+        reduced[rows] = __transform(scaler, reducer, vectors, rows, chunk_size)
+        n_projected = len(df)
+        joblib.dump({"scaler": scaler, "reducer": reducer}, model_file)
+        record_artifact(
+            target_dir,
+            os.path.basename(model_file),
+            manifest["corpus"],
+            fitted=len(fitted),
+        )
+        print(f"Saved the fitted scaler & UMAP model to [{model_file}]")
 
     ### concat the reduced dim with movie url and title
-    sbert_df = pd.DataFrame(data=reduced, columns=["comp_1", "comp_2", "comp_3"])
-    sbert_df = pd.concat([df[["url", "title"]], sbert_df], axis=1)
+    umap_df = pd.concat(
+        [df[["url", "title"]], pd.DataFrame(data=reduced, columns=COLUMNS)], axis=1
+    )
 
-    ### save the reduced data as parquet file
-    output_file = "../artifacts/umap_reduced_data.parquet"
-    sbert_df.to_parquet(output_file)
-    print(f"Saved UMAP reduced output to [{output_file}].")
+    ### save the reduced data as parquet file, atomically
+    umap_df.to_parquet(output_file + ".partial")
+    os.replace(output_file + ".partial", output_file)
+    record_artifact(
+        target_dir,
+        os.path.basename(output_file),
+        manifest["corpus"],
+        encoded=n_projected,
+    )
+    print(
+        f"Saved UMAP reduced output to [{output_file}], {n_projected} movies "
+        f"projected in {time.perf_counter() - start:.1f} s."
+    )
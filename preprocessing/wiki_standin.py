@@ -0,0 +1,88 @@
+"""
+Local HTTP stand-in for Wikipedia serving saved HTML pages, so that the data
+collection can be run and timed without hitting the real site.
+A request for `/wiki/<page>` is answered with the file `<root>/wiki/<page>.html`.
+"""
+
+import argparse
+import os
+import time
+from email.utils import formatdate
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class WikiStandinHandler(BaseHTTPRequestHandler):
+    """serve saved pages over keep-alive HTTP/1.1 with an optional artificial delay"""
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, root, delay, **kwargs):
+        self.root = os.path.abspath(root)
+        self.delay = delay
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        ### never serve anything outside of the root folder
+        path = self.path.split("?")[0].lstrip("/")
+        file_name = os.path.abspath(os.path.join(self.root, path + ".html"))
+        if self.delay:
+            time.sleep(self.delay)
+        if not file_name.startswith(self.root + os.sep) or not os.path.isfile(
+            file_name
+        ):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        ### validators like Wikipedia's, so that conditional requests get a 304
+        stat = os.stat(file_name)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        with open(file_name, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def save_pages(results, root):
+    """save fetched pages (`FetchResult`s) under `root` in the layout served here"""
+    for result in results:
+        if result.ok:
+            path = result.url.split("://", 1)[-1].split("/", 1)[-1]
+            file_name = os.path.join(root, path + ".html")
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            with open(file_name, "wb") as f:
+                f.write(result.body)
+
+
+def serve(root, port=8000, delay=0.0):
+    """serve saved pages until interrupted"""
+    handler = partial(WikiStandinHandler, root=root, delay=delay)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"Serving pages from [{root}] at http://127.0.0.1:{port}/wiki/...")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--root", default="../artifacts/saved_pages")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--delay", type=float, default=0.0, help="seconds added to every response"
+    )
+    args = parser.parse_args()
+    serve(args.root, args.port, args.delay)
@@ -0,0 +1,356 @@
+""" Compact (reduced precision & quantized) encodings of movie plot embeddings """
+
+import abc
+import time
+import numpy as np
+from similarity import SimilarityEngine, l2_normalize, top_k
+
+
+def _kmeans(vectors, n_clusters, n_iter=15, seed=42, chunk_size=8192):
+    """plain (euclidean) k-means, returns centroids of shape (n_clusters, n_dims)"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for _ in range(n_iter):
+        ### argmin ||x - c||^2 == argmin ||c||^2 - 2 x.c
+        c_sq = (centroids**2).sum(axis=1)
+        for start in range(0, len(vectors), chunk_size):
+            block = vectors[start : start + chunk_size]
+            labels[start : start + chunk_size] = (
+                c_sq - 2 * block @ centroids.T
+            ).argmin(axis=1)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        ### re-seed empty clusters with random vectors
+        n_empty = (~filled).sum()
+        if n_empty:
+            centroids[~filled] = vectors[
+                rng.choice(len(vectors), n_empty, replace=False)
+            ]
+    return centroids
+
+
+class QuantizedEngine(SimilarityEngine, abc.ABC):
+    """
+    Base class of compact encodings, same API as `SimilarityEngine` but the corpus is
+    stored in a lossy compact form and scored in blocks. When `exact` embeddings
+    (a `SimilarityEngine`, typically memory-mapped) are attached, `most_similar`
+    re-ranks the best `k * rerank` approximate matches on the exact vectors, which
+    only touches those rows of the exact matrix.
+    """
+
+    encoding = None
+
+    def __init__(self, exact=None, rerank=4, block_size=16384):
+        self.exact = exact
+        self.rerank = rerank
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.n_movies
+
+    @property
+    @abc.abstractmethod
+    def nbytes(self):
+        """memory used by the compact encoding"""
+
+    @abc.abstractmethod
+    def decode(self, rows):
+        """approximate float32 vectors of the given rows"""
+
+    @abc.abstractmethod
+    def _score_block(self, query, start, stop):
+        """approximate scores of rows `start:stop` against a unit length query"""
+
+    @abc.abstractmethod
+    def _score_rows(self, query, rows):
+        """approximate scores of arbitrary rows against a unit length query"""
+
+    def _query(self, query_index):
+        """query vector of a movie, exact when available"""
+        if self.exact is not None:
+            return self.exact.matrix[query_index]
+        return l2_normalize(self.decode([query_index]))[0]
+
+    def score_vector(self, vector, candidates=None):
+        query = l2_normalize(np.reshape(vector, (1, -1)))[0]
+        if candidates is not None:
+            return self._score_rows(query, np.asarray(candidates))
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            stop = min(start + self.block_size, len(self))
+            scores[start:stop] = self._score_block(query, start, stop)
+        return scores
+
+    def scores(self, query_index, candidates=None):
+        return self.score_vector(self._query(query_index), candidates=candidates)
+
+    def batch_scores(self, query_indices, candidates=None):
+        return np.vstack([self.scores(q, candidates=candidates) for q in query_indices])
+
+    def most_similar(
+        self, query_index, k, candidates=None, exclude_query=True, min_score=None
+    ):
+        if self.exact is None or self.rerank <= 1:
+            return super().most_similar(
+                query_index, k, candidates, exclude_query, min_score
+            )
+        ### shortlist with the compact encoding, then re-rank on the exact vectors
+        shortlist, _ = super().most_similar(
+            query_index, k * self.rerank, candidates, exclude_query
+        )
+        return self.exact.most_similar(
+            query_index,
+            k,
+            candidates=shortlist,
+            exclude_query=False,
+            min_score=min_score,
+        )
+
+    def most_similar_vector(self, vector, k, candidates=None, min_score=None):
+        if self.exact is None or self.rerank <= 1:
+            return super().most_similar_vector(vector, k, candidates, min_score)
+        shortlist, _ = super().most_similar_vector(vector, k * self.rerank, candidates)
+        return self.exact.most_similar_vector(
+            vector, k, candidates=shortlist, min_score=min_score
+        )
+
+    def with_exact(self, exact, rerank=4):
+        """same encoding (arrays are shared) with exact vectors attached to re-rank"""
+        return type(self).from_arrays(self._arrays(), exact=exact, rerank=rerank)
+
+    def save(self, file_name):
+        """persist the encoding as a numpy .npz file"""
+        np.savez(file_name, encoding=self.encoding, **self._arrays())
+
+    @abc.abstractmethod
+    def _arrays(self):
+        """named arrays that fully describe the encoding, written by `save`"""
+
+    @classmethod
+    def from_arrays(cls, arrays, **kwargs):
+        """rebuild an engine from the arrays written by `save`"""
+        engine = cls.__new__(cls)
+        QuantizedEngine.__init__(engine, **kwargs)
+        for name, values in arrays.items():
+            setattr(engine, name, values)
+        engine.n_movies = len(engine.codes)
+        return engine
+
+
+class Float16Engine(QuantizedEngine):
+    """unit length vectors stored as float16, half the size of float32"""
+
+    encoding = "float16"
+
+    def __init__(self, vectors, exact=None, rerank=4, block_size=16384):
+        super().__init__(exact, rerank, block_size)
+        self.codes = l2_normalize(vectors).astype(np.float16)
+        self.n_movies = len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def decode(self, rows):
+        return self.codes[rows].astype(np.float32)
+
+    def _score_block(self, query, start, stop):
+        return self.codes[start:stop].astype(np.float32) @ query
+
+    def _score_rows(self, query, rows):
+        return self.decode(rows) @ query
+
+    def _arrays(self):
+        return {"codes": self.codes}
+
+
+class Int8Engine(QuantizedEngine):
+    """
+    scalar quantization: every dimension is scaled by its own factor into int8, a
+    quarter of the size of float32. a score is the dot product of the int8 codes with
+    the query pre-multiplied by the scales
+    """
+
+    encoding = "int8"
+
+    def __init__(self, vectors, exact=None, rerank=4, block_size=16384):
+        super().__init__(exact, rerank, block_size)
+        vectors = l2_normalize(vectors)
+        ### symmetric per-dimension scale so that the largest value maps to 127
+        self.scale = np.abs(vectors).max(axis=0) / 127
+        self.scale[self.scale == 0] = 1.0
+        self.codes = np.round(vectors / self.scale).astype(np.int8)
+        self.n_movies = len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scale.nbytes
+
+    def decode(self, rows):
+        return self.codes[rows].astype(np.float32) * self.scale
+
+    def _score_block(self, query, start, stop):
+        return self.codes[start:stop].astype(np.float32) @ (query * self.scale)
+
+    def _score_rows(self, query, rows):
+        return self.codes[rows].astype(np.float32) @ (query * self.scale)
+
+    def _arrays(self):
+        return {"codes": self.codes, "scale": self.scale}
+
+
+class PQEngine(QuantizedEngine):
+    """
+    product quantization: the vector is split into `n_subspaces` chunks and each chunk
+    is replaced by the id (uint8) of its nearest of 256 k-means centroids, 384 float32
+    dims become 48 bytes by default. a query is scored with asymmetric distance
+    computation (ADC): the query is kept exact, its dot product with every centroid is
+    computed once per query and a movie's score is the sum of the looked up entries
+    """
+
+    encoding = "pq"
+
+    def __init__(
+        self,
+        vectors,
+        n_subspaces=48,
+        n_iter=15,
+        sample_size=20_000,
+        seed=42,
+        exact=None,
+        rerank=4,
+        block_size=16384,
+    ):
+        super().__init__(exact, rerank, block_size)
+        vectors = l2_normalize(vectors)
+        n, n_dims = vectors.shape
+        if n_dims % n_subspaces != 0:
+            raise ValueError(
+                f"{n_dims} dimensions can't be split into {n_subspaces} subspaces"
+            )
+        sub_dims = n_dims // n_subspaces
+        n_centroids = min(256, n)
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if n > sample_size:
+            sample = vectors[rng.choice(n, sample_size, replace=False)]
+
+        ### one codebook per subspace: (n_subspaces, n_centroids, sub_dims)
+        self.codebooks = np.stack(
+            [
+                _kmeans(
+                    sample[:, j * sub_dims : (j + 1) * sub_dims],
+                    n_centroids,
+                    n_iter,
+                    seed,
+                )
+                for j in range(n_subspaces)
+            ]
+        )
+        self.codes = np.empty((n, n_subspaces), dtype=np.uint8)
+        for j in range(n_subspaces):
+            sub = vectors[:, j * sub_dims : (j + 1) * sub_dims]
+            c = self.codebooks[j]
+            for start in range(0, n, block_size):
+                block = sub[start : start + block_size]
+                dist = (c**2).sum(axis=1) - 2 * block @ c.T
+                self.codes[start : start + block_size, j] = dist.argmin(axis=1)
+        self.n_movies = n
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def decode(self, rows):
+        codes = self.codes[rows]
+        n_subspaces = self.codebooks.shape[0]
+        parts = [self.codebooks[j][codes[:, j]] for j in range(n_subspaces)]
+        return np.concatenate(parts, axis=1)
+
+    def _lookup_table(self, query):
+        """dot product of every query chunk with every centroid of its subspace"""
+        n_subspaces, _, sub_dims = self.codebooks.shape
+        return np.einsum(
+            "jcd,jd->jc", self.codebooks, query.reshape(n_subspaces, sub_dims)
+        )
+
+    def _adc(self, table, codes):
+        return table[np.arange(table.shape[0]), codes].sum(axis=1, dtype=np.float32)
+
+    def _score_block(self, query, start, stop):
+        return self._adc(self._lookup_table(query), self.codes[start:stop])
+
+    def _score_rows(self, query, rows):
+        return self._adc(self._lookup_table(query), self.codes[rows])
+
+    def score_vector(self, vector, candidates=None):
+        ### build the lookup table once instead of once per block
+        query = l2_normalize(np.reshape(vector, (1, -1)))[0]
+        table = self._lookup_table(query)
+        codes = self.codes if candidates is None else self.codes[candidates]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), self.block_size):
+            stop = min(start + self.block_size, len(codes))
+            scores[start:stop] = self._adc(table, codes[start:stop])
+        return scores
+
+    def _arrays(self):
+        return {"codes": self.codes, "codebooks": self.codebooks}
+
+
+ENCODINGS = {
+    "float16": Float16Engine,
+    "int8": Int8Engine,
+    "pq": PQEngine,
+}
+
+
+def load_quantized(file_name, exact=None, rerank=4):
+    """load an encoding saved by `QuantizedEngine.save`, optionally with exact vectors"""
+    with np.load(file_name, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+    engine_class = ENCODINGS[str(arrays.pop("encoding"))]
+    engine = engine_class.from_arrays(arrays, exact=exact, rerank=rerank)
+    if exact is not None and len(exact) != len(engine):
+        raise ValueError(
+            f"[{file_name}] has {len(engine)} movies but exact embeddings have "
+            f"{len(exact)}, please re-encode"
+        )
+    return engine
+
+
+def compression_report(vectors, engines, k=5, n_queries=200, seed=42):
+    """
+    compare compact encodings against the exact cosine similarity results of the
+    float32 embeddings (the model output, scored in float64) on randomly picked
+    movies. `engines` maps a label to an engine, returns a list of dicts with memory,
+    memory saved against float32, recall@k and mean query latency (ms)
+    """
+    float32_nbytes = np.asarray(vectors, dtype=np.float32).nbytes
+    baseline = np.asarray(vectors, dtype=np.float64)
+    baseline = baseline / np.linalg.norm(baseline, axis=1, keepdims=True).clip(1e-12)
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(baseline), min(n_queries, len(baseline)), replace=False)
+    truth = [set(top_k(baseline @ baseline[q], k, exclude=q)[0]) for q in queries]
+
+    report = []
+    for label, engine in engines.items():
+        start = time.perf_counter()
+        found = [engine.most_similar(q, k)[0] for q in queries]
+        query_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(t.intersection(rows)) for t, rows in zip(truth, found))
+        nbytes = getattr(engine, "nbytes", None) or engine.matrix.nbytes
+        report.append(
+            {
+                "encoding": label,
+                "MB": nbytes / 2**20,
+                "saved_vs_float32": 1 - nbytes / float32_nbytes,
+                f"recall@{k}": hits / (k * len(queries)),
+                "query_ms": query_ms,
+            }
+        )
+    return report
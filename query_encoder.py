@@ -0,0 +1,103 @@
+""" Encoder of free-text movie descriptions into the SBERT embedding space """
+
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from filtered_search import as_candidates, filtered_search
+
+### must be the model used by `preprocessing/generate_embeddings.py`
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+
+class QueryEncoder:
+    """
+    Encode free-text queries with the SBERT model, meant to be created once per
+    process and shared by every user session: the model is loaded on the first query
+    and the vectors of the last `cache_size` distinct queries are kept in an LRU
+    cache, so a repeated query skips the model entirely.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, cache_size=1024):
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self.model = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _model(self):
+        """the sentence transformer, loaded once"""
+        with self.lock:
+            if self.model is None:
+                ### heavy import, only paid by processes that actually encode queries
+                from sentence_transformers import SentenceTransformer
+
+                self.model = SentenceTransformer(self.model_name)
+            return self.model
+
+    def load(self):
+        """load the model now rather than on the first query, e.g. in the background"""
+        self._model()
+
+    @staticmethod
+    def _key(text):
+        """queries differing only in white space share a cache entry"""
+        return " ".join(text.split())
+
+    def encode(self, text):
+        """unit length float32 vector of a query, returns (vector, cached)"""
+        key = self._key(text)
+        with self.lock:
+            vector = self.cache.get(key)
+            if vector is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return vector, True
+            self.misses += 1
+        vector = self._model().encode([key], normalize_embeddings=True)[0]
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        with self.lock:
+            self.cache[key] = vector
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return vector, False
+
+    def cache_info(self):
+        """hits, misses and current size of the query cache"""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.cache)}
+
+
+def search_by_description(
+    engine, encoder, text, k, candidates=None, ann_index=None, n_probe=8
+):
+    """
+    top `k` movies of an SBERT engine matching a free-text description, optionally
+    only among `candidates` (bitmap or row ids) and with an `IVFIndex`, see
+    `filtered_search`. returns (corpus row indices, scores, timings) where timings
+    splits the time spent encoding the query from the time spent searching (ms)
+    """
+    start = time.perf_counter()
+    vector, cached = encoder.encode(text)
+    encoded = time.perf_counter()
+    _, subset = as_candidates(candidates, len(engine))
+    rows, scores, strategy = filtered_search(
+        engine,
+        k,
+        vector=vector,
+        candidates=subset,
+        ann_index=ann_index,
+        n_probe=n_probe,
+    )
+    searched = time.perf_counter()
+    timings = {
+        "encode_ms": (encoded - start) * 1000,
+        "search_ms": (searched - encoded) * 1000,
+        "cached": cached,
+        "n_searched": len(engine) if subset is None else len(subset),
+        "strategy": strategy,
+    }
+    return rows, scores, timings
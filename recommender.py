@@ -0,0 +1,224 @@
+"""
+Movie recommendations for one movie (the app) or many movies at once (batch and
+export jobs, see `preprocessing/batch_recommend.py`), on top of a `MovieStore`
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from clusters import diversify
+from filtered_search import filtered_search
+from similarity import batch_top_k
+from title_index import normalize
+
+### a diversified top-k is picked from the `POOL_FACTOR * k` most similar movies
+POOL_FACTOR = 3
+
+
+def candidate_bitmap(store, rows=None, years=None):
+    """
+    boolean bitmap of the movies a recommendation may come from: the store `rows`
+    (e.g. of a title filter) and/or the movies released within `years` (first, last).
+    None when every movie may be recommended
+    """
+    candidates = None
+    if rows is not None and len(rows) < len(store):
+        candidates = np.zeros(len(store), dtype=bool)
+        candidates[np.asarray(rows)] = True
+    if years is not None:
+        in_years = store.in_years(*years)
+        candidates = in_years if candidates is None else candidates & in_years
+    if candidates is not None and candidates.all():
+        return None
+    return candidates
+
+
+def recommend(
+    store,
+    query_row,
+    k,
+    embed="sbert",
+    candidates=None,
+    n_probe=8,
+    diversity=0.0,
+    per_cluster=None,
+    pool=None,
+):
+    """
+    the `k` movies most similar to the movie at `query_row`, optionally only among
+    `candidates` (bitmap or row ids). looked up in the precomputed neighbour table
+    when possible, otherwise scored with `filtered_search`. a `diversity` above 0
+    and/or a `per_cluster` quota (with clusters loaded) re-rank the most similar
+    movies with `clusters.diversify` to leave out near-duplicates. with a
+    `ScoringPool` movies are scored exactly in one of its worker processes instead.
+    returns (store rows, scores) of the movie itself followed by its recommendations
+    """
+    engine = store.engines[embed]
+    diversified = diversity > 0 or (per_cluster is not None and embed in store.clusters)
+    n_pool = k * POOL_FACTOR if diversified else k
+    table = store.neighbor_tables.get(embed)
+    if candidates is None and table is not None and n_pool <= table[0].shape[1]:
+        ### precomputed at preprocessing time, just look the answer up
+        top_rows, top_scores = (
+            table[0][query_row, :n_pool],
+            table[1][query_row, :n_pool],
+        )
+    elif pool is not None:
+        ### off the GIL of this process, the embeddings are shared with the workers
+        top_rows, top_scores = pool.score_block([query_row], n_pool, embed, candidates)
+        top_rows, top_scores = top_rows[0], top_scores[0]
+    else:
+        ### score the given movie against the candidates only (or the whole corpus),
+        ### brute force or with the ANN index depending on how many candidates there
+        ### are, and select the `n_pool` best (excluding itself)
+        top_rows, top_scores, _ = filtered_search(
+            engine,
+            n_pool,
+            query_index=query_row,
+            candidates=candidates,
+            ann_index=store.ann_indexes.get(embed),
+            n_probe=n_probe,
+        )
+    if diversified and len(top_rows) > k:
+        ### only the pool is compared pairwise, a few hundred dot products at most
+        similarities = _batch_engine(store, embed).batch_scores(
+            top_rows, candidates=top_rows
+        )
+        clusters = store.clusters.get(embed)
+        picked = diversify(
+            top_scores,
+            similarities,
+            k,
+            diversity=diversity,
+            labels=None if clusters is None else clusters.labels[top_rows],
+            per_cluster=per_cluster,
+        )
+        top_rows, top_scores = top_rows[picked], top_scores[picked]
+
+    ### first one is always the movie we are searching for, scored on the exact
+    ### vectors as a compact encoding would show the movie less similar to itself
+    exact = _batch_engine(store, embed)
+    self_score = exact.scores(query_row, candidates=[query_row])[0]
+    match_rows = np.concatenate(([query_row], top_rows))
+    scores = np.concatenate(([self_score], top_scores))
+    return match_rows, scores
+
+
+class MovieResolver:
+    """
+    store row of a movie given by id (Wikipedia URL) or title, titles are matched
+    exactly first then ignoring case, accents & punctuation (the first of several
+    movies with the same title wins). built once, then every lookup is a dict access
+    """
+
+    def __init__(self, store):
+        self.by_url = {url: row for row, url in enumerate(store.urls)}
+        self.by_title, self.by_normalized = {}, {}
+        for row, title in enumerate(store.titles):
+            self.by_title.setdefault(title, row)
+            self.by_normalized.setdefault(" ".join(normalize(title)), row)
+
+    def resolve(self, movie):
+        """row of the movie, None when no movie matches"""
+        row = self.by_url.get(movie, self.by_title.get(movie))
+        if row is None:
+            row = self.by_normalized.get(" ".join(normalize(movie)))
+        return row
+
+
+def resolve_movies(store, movies):
+    """store rows of movies given by id or title, returns (rows, unmatched names)"""
+    resolver = MovieResolver(store)
+    rows, unresolved = [], []
+    for movie in movies:
+        row = resolver.resolve(movie)
+        if row is None:
+            unresolved.append(movie)
+        else:
+            rows.append(row)
+    return np.array(rows, dtype=np.int64), unresolved
+
+
+def _batch_engine(store, embed):
+    """
+    engine to score many movies at once with, compact encodings score one movie at
+    a time so their exact vectors are used when attached
+    """
+    engine = store.engines[embed]
+    return getattr(engine, "exact", None) or engine
+
+
+def score_block(engine, query_rows, k, candidates=None):
+    """
+    top `k` movies (excluding the movie itself) of every movie of `query_rows` among
+    all movies or the `candidates` (bitmap or row ids), scored as one matrix product.
+    returns (rows, scores) both of shape (len(query_rows), <= k)
+    """
+    query_rows = np.asarray(query_rows)
+    if candidates is not None:
+        candidates = np.asarray(candidates)
+        if candidates.dtype == bool:
+            candidates = np.flatnonzero(candidates)
+        ### position of every query movie among the candidates, -1 when not there
+        position = np.full(len(engine), -1, dtype=np.int64)
+        position[candidates] = np.arange(len(candidates))
+        idx, scores = batch_top_k(
+            engine.batch_scores(query_rows, candidates=candidates),
+            k,
+            exclude=position[query_rows],
+        )
+        return candidates[idx], scores
+    return batch_top_k(engine.batch_scores(query_rows), k, exclude=query_rows)
+
+
+def recommend_block(store, query_rows, k, embed="sbert", candidates=None, pool=None):
+    """
+    top `k` recommendations (excluding the movie itself) of every movie of
+    `query_rows`, scored as one matrix product or looked up in the precomputed
+    neighbour table. a `ScoringPool` (see `shared_store.py`) scores them in one of
+    its worker processes. returns (rows, scores) both of shape (len(query_rows), <= k)
+    """
+    query_rows = np.asarray(query_rows)
+    table = store.neighbor_tables.get(embed)
+    if candidates is None and table is not None and k <= table[0].shape[1]:
+        return table[0][query_rows, :k], table[1][query_rows, :k]
+    if pool is not None:
+        return pool.score_block(query_rows, k, embed, candidates)
+    return score_block(_batch_engine(store, embed), query_rows, k, candidates)
+
+
+def iter_recommendations(
+    store, query_rows, k, embed="sbert", candidates=None, block_size=1024, workers=1
+):
+    """
+    `recommend_block` over many movies, `block_size` movies at a time so memory
+    stays bounded to a (block_size, n_movies) score matrix. with several `workers`
+    blocks are scored by a pool of threads (matrix products and top-k selection run
+    outside the GIL and the store is shared, not copied), at most two blocks per
+    worker are in flight. yields (query rows, rows, scores) per block, in order
+    """
+    query_rows = np.asarray(query_rows)
+    blocks = [
+        query_rows[start : start + block_size]
+        for start in range(0, len(query_rows), block_size)
+    ]
+    if workers <= 1:
+        for block in blocks:
+            yield (block, *recommend_block(store, block, k, embed, candidates))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for block in blocks:
+            pending.append(
+                (
+                    block,
+                    executor.submit(
+                        recommend_block, store, block, k, embed, candidates
+                    ),
+                )
+            )
+            if len(pending) >= 2 * workers:
+                block, future = pending.pop(0)
+                yield (block, *future.result())
+        for block, future in pending:
+            yield (block, *future.result())
@@ -0,0 +1,454 @@
+"""
+Lightweight HTTP/JSON recommendation service over the movie store used by the app,
+for other apps that don't need the Streamlit UI:
+    GET /similar?id=<movie id or title>&k=5&embed=sbert
+    GET /search?q=<free-text description>&k=5
+    GET /stats
+    GET /metrics (Prometheus text format, see `instrumentation.py`)
+Concurrent `/similar` requests arriving within a few milliseconds are scored as one
+matrix product (micro-batching) and responses are cached per (movie, k, embed).
+With `--workers` batches are scored by a pool of processes sharing the embeddings
+(see `shared_store.py`).
+`python service.py load` runs a load generator against a running service.
+"""
+
+import argparse
+import http.client
+import importlib.util
+import json
+import logging
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+import numpy as np
+import pandas as pd
+from instrumentation import METRICS, count, timer
+from movie_store import load_movie_store
+from query_encoder import QueryEncoder, search_by_description
+from recommender import MovieResolver, recommend_block
+from shared_store import ScoringPool
+
+MAX_K = 50
+### longest a request waits for its batch to be scored before a 503
+SCORE_TIMEOUT_S = 30.0
+
+logger = logging.getLogger("movie_buddy.service")
+
+
+class MicroBatcher:
+    """
+    Queue of recommendation requests for one embedding type scored by a background
+    thread: after the first request of a batch it waits at most `max_wait_ms` for
+    more (up to `max_batch`), then scores them all with one `recommend_block` call,
+    i.e. one (batch, n_movies) matrix product instead of one per request. with a
+    `ScoringPool` the batch is scored by a worker process while the next one is
+    collected
+    """
+
+    def __init__(self, store, embed, max_wait_ms=2.0, max_batch=64, pool=None):
+        self.store = store
+        self.embed = embed
+        self.pool = pool
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.n_batches = 0
+        self.n_requests = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, row, k):
+        """future of the (rows, scores) of the top `k` recommendations of a movie"""
+        future = Future()
+        self.queue.put((row, k, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(
+                        self.queue.get(timeout=timeout)
+                        if timeout > 0
+                        else self.queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+            self._score(batch)
+
+    def _score(self, batch):
+        rows = np.array([row for row, _, _ in batch], dtype=np.int64)
+        k = max(k for _, k, _ in batch)
+        count(f"{self.embed}_batches")
+        count(f"{self.embed}_batched_requests", len(batch))
+        if self.pool is not None:
+            try:
+                scored = self.pool.submit(rows, k, self.embed)
+            except Exception as e:
+                ### pool closed or broken (a worker died), fail this batch but keep
+                ### the batcher thread running for the next ones
+                scored = Future()
+                scored.set_exception(e)
+        else:
+            scored = Future()
+            try:
+                with timer(f"{self.embed}_batch"):
+                    scored.set_result(recommend_block(self.store, rows, k, self.embed))
+            except Exception as e:
+                scored.set_exception(e)
+        scored.add_done_callback(partial(self._deliver, batch))
+
+    def _deliver(self, batch, scored):
+        try:
+            top_rows, top_scores = scored.result()
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.n_batches += 1
+        self.n_requests += len(batch)
+        for i, (_, k, future) in enumerate(batch):
+            future.set_result((top_rows[i, :k], top_scores[i, :k]))
+
+
+class ResponseCache:
+    """LRU cache of encoded responses, shared by the request threads"""
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.entries[key] = body
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class ServiceError(Exception):
+    """a request that can't be answered, with its HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RecommendationService:
+    """request handling independent of HTTP, every answer is JSON encoded bytes"""
+
+    def __init__(
+        self, store, max_wait_ms=2.0, max_batch=64, cache_size=4096, pool=None
+    ):
+        self.store = store
+        self.pool = pool
+        self.resolver = MovieResolver(store)
+        self.batchers = {
+            embed: MicroBatcher(store, embed, max_wait_ms, max_batch, pool)
+            for embed in store.engines
+        }
+        self.cache = ResponseCache(cache_size)
+        self.encoder = None
+        if importlib.util.find_spec("sentence_transformers") is not None:
+            self.encoder = QueryEncoder()
+
+    def _results(self, rows, scores):
+        return [
+            {
+                "id": self.store.urls[row],
+                "title": self.store.titles[row],
+                "score": score,
+            }
+            for row, score in zip(rows.tolist(), scores.tolist())
+        ]
+
+    @staticmethod
+    def _k(params):
+        try:
+            k = int(params.get("k", 5))
+        except ValueError:
+            raise ServiceError(400, "k must be an integer")
+        if not 1 <= k <= MAX_K:
+            raise ServiceError(400, f"k must be between 1 and {MAX_K}")
+        return k
+
+    def similar(self, params):
+        movie = params.get("id")
+        if not movie:
+            raise ServiceError(400, "missing movie id")
+        k = self._k(params)
+        embed = params.get("embed", "sbert")
+        if embed not in self.batchers:
+            raise ServiceError(400, f"embed must be one of {sorted(self.batchers)}")
+        row = self.resolver.resolve(movie)
+        if row is None:
+            raise ServiceError(404, f"no movie matches [{movie}]")
+
+        key = ("similar", row, k, embed)
+        body = self.cache.get(key)
+        if body is None:
+            table = self.store.neighbor_tables.get(embed)
+            if table is not None and k <= table[0].shape[1]:
+                ### precomputed, nothing to batch
+                rows, scores = table[0][row, :k], table[1][row, :k]
+            else:
+                rows, scores = self._scored(self.batchers[embed].submit(row, k))
+            body = json.dumps(
+                {
+                    "id": self.store.urls[row],
+                    "title": self.store.titles[row],
+                    "embed": embed,
+                    "results": self._results(rows, scores),
+                }
+            ).encode("utf-8")
+            self.cache.put(key, body)
+        return body
+
+    @staticmethod
+    def _scored(future):
+        """result of a batcher future, a 503 when scoring is unavailable or too slow"""
+        try:
+            return future.result(timeout=SCORE_TIMEOUT_S)
+        except FutureTimeoutError:
+            raise ServiceError(503, "timed out waiting for the scoring workers")
+        except BrokenExecutor as e:
+            raise ServiceError(503, f"scoring workers unavailable: {e}")
+
+    def search(self, params):
+        if self.encoder is None:
+            raise ServiceError(503, "free-text search needs sentence-transformers")
+        text = " ".join(params.get("q", "").split())
+        if not text:
+            raise ServiceError(400, "missing query")
+        k = self._k(params)
+
+        key = ("search", text, k)
+        body = self.cache.get(key)
+        if body is None:
+            rows, scores, _ = search_by_description(
+                self.store.engines["sbert"],
+                self.encoder,
+                text,
+                k,
+                ann_index=self.store.ann_indexes.get("sbert"),
+            )
+            body = json.dumps(
+                {"query": text, "results": self._results(rows, scores)}
+            ).encode("utf-8")
+            self.cache.put(key, body)
+        return body
+
+    def stats(self, params):
+        batchers = {
+            embed: {
+                "requests": batcher.n_requests,
+                "batches": batcher.n_batches,
+                "mean_batch_size": batcher.n_requests / max(batcher.n_batches, 1),
+            }
+            for embed, batcher in self.batchers.items()
+        }
+        cache = {
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "size": len(self.cache.entries),
+        }
+        workers = 0 if self.pool is None else self.pool.workers
+        return json.dumps(
+            {"batchers": batchers, "cache": cache, "workers": workers}
+        ).encode("utf-8")
+
+    def metrics(self, params):
+        return METRICS.prometheus().encode("utf-8")
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """route GET requests to a `RecommendationService` over keep-alive HTTP/1.1"""
+
+    protocol_version = "HTTP/1.1"
+    ### headers & body are written separately, don't let the body wait for an ACK
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, service, **kwargs):
+        self.service = service
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        route = {
+            "/similar": self.service.similar,
+            "/search": self.service.search,
+            "/stats": self.service.stats,
+            "/metrics": self.service.metrics,
+        }.get(url.path)
+        content_type = "application/json"
+        if url.path == "/metrics":
+            content_type = "text/plain; version=0.0.4"
+        try:
+            if route is None:
+                raise ServiceError(404, f"unknown path [{url.path}]")
+            with timer(url.path.lstrip("/")):
+                status, body = 200, route(params)
+        except ServiceError as e:
+            status, body = e.status, json.dumps({"error": str(e)}).encode("utf-8")
+            content_type = "application/json"
+        except Exception as e:
+            ### a bug or a crashed worker pool, still answer so the client isn't left
+            ### with a dropped connection
+            logger.exception(f"[{self.path}] failed")
+            METRICS.count("server_errors")
+            status = 500
+            body = json.dumps({"error": f"{type(e).__name__}: {e}"}).encode("utf-8")
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(store, port=8080, max_wait_ms=2.0, max_batch=64, cache_size=4096, workers=0):
+    """
+    serve recommendations until interrupted, scored by a pool of `workers`
+    processes sharing the embeddings (in this process when 0)
+    """
+    pool = None
+    if workers:
+        ### stopped by a process manager (SIGTERM), exit normally so that the shared
+        ### memory of the workers is released
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        pool = ScoringPool(store, workers)
+        print(f"Started {workers} scoring workers, {pool.shared_mb:.0f} MB shared")
+    service = RecommendationService(store, max_wait_ms, max_batch, cache_size, pool)
+    handler = partial(ServiceHandler, service=service)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"Serving recommendations at http://127.0.0.1:{port}/similar?id=...&k=5")
+    server.serve_forever()
+
+
+def load_test(url, paths, n_requests=2000, concurrency=16):
+    """
+    send `n_requests` GET requests picked at random from `paths` with `concurrency`
+    keep-alive connections. returns a dict with the QPS, p50/p99 latency (ms) and
+    the number of failed requests
+    """
+    target = urlparse(url)
+    per_worker = [n_requests // concurrency] * concurrency
+    for i in range(n_requests % concurrency):
+        per_worker[i] += 1
+
+    def _worker(n, seed):
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection(target.hostname, target.port)
+        latencies, failed = [], 0
+        for _ in range(n):
+            start = time.perf_counter()
+            connection.request("GET", rng.choice(paths))
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            failed += response.status != 200
+        connection.close()
+        return latencies, failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_worker, per_worker, range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = np.concatenate([r[0] for r in results]) * 1000
+    return {
+        "requests": len(latencies),
+        "failed": sum(r[1] for r in results),
+        "qps": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the service")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--artifacts", default="artifacts")
+    serve_parser.add_argument("--tfidf", action="store_true", help="serve TF-IDF too")
+    serve_parser.add_argument(
+        "--max-wait-ms", type=float, default=2.0, help="time a request waits for more"
+    )
+    serve_parser.add_argument("--max-batch", type=int, default=64)
+    serve_parser.add_argument("--cache-size", type=int, default=4096)
+    serve_parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="scoring processes sharing the embeddings, 0 scores in the service",
+    )
+    load_parser = commands.add_parser("load", help="load test a running service")
+    load_parser.add_argument("--url", default="http://127.0.0.1:8080")
+    load_parser.add_argument("--artifacts", default="artifacts")
+    load_parser.add_argument("--requests", type=int, default=2000)
+    load_parser.add_argument("--concurrency", type=int, default=16)
+    load_parser.add_argument("--k", type=int, default=5)
+    load_parser.add_argument(
+        "--movies",
+        type=int,
+        default=1000,
+        help="number of distinct movies requested, fewer means more cache hits",
+    )
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(
+            load_movie_store(args.artifacts, use_tfidf=args.tfidf),
+            args.port,
+            args.max_wait_ms,
+            args.max_batch,
+            args.cache_size,
+            args.workers,
+        )
+    else:
+        ### only the movie ids are needed, not the embeddings
+        urls = pd.read_parquet(
+            f"{args.artifacts}/movie_plots.parquet", columns=["url"]
+        )["url"]
+        movies = random.Random(42).sample(list(urls), min(args.movies, len(urls)))
+        paths = [f"/similar?{urlencode({'id': m, 'k': args.k})}" for m in movies]
+        print(
+            f"Sending {args.requests} requests for {len(movies)} movies to "
+            f"[{args.url}] over {args.concurrency} connections..."
+        )
+        report = load_test(args.url, paths, args.requests, args.concurrency)
+        print(
+            f"{report['qps']:.1f} QPS, p50 {report['p50_ms']:.2f} ms, "
+            f"p99 {report['p99_ms']:.2f} ms, {report['failed']} failed"
+        )
+        target = urlparse(args.url)
+        connection = http.client.HTTPConnection(target.hostname, target.port)
+        connection.request("GET", "/stats")
+        print(f"Service stats: {connection.getresponse().read().decode('utf-8')}")
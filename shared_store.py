@@ -0,0 +1,179 @@
+"""
+Multi-process scoring: the embeddings of a `MovieStore` are published once into
+named shared memory blocks and a pool of worker processes attaches to them without
+copying, so recommendations are scored on all cores outside of the GIL of the
+Streamlit (or HTTP service) process, with a single copy of the embeddings however
+many workers there are. The loading process keeps the metadata and the neighbour
+tables, only the scoring is sent to the workers.
+"""
+
+import atexit
+import multiprocessing as mp
+import os
+import sys
+import types
+from contextlib import contextmanager
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import scipy.sparse as sp
+from recommender import score_block
+from similarity import SimilarityEngine, SparseSimilarityEngine
+
+
+def _publish_array(values, blocks):
+    """copy an array into a new shared memory block, returns how to attach to it"""
+    values = np.ascontiguousarray(values)
+    block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+    blocks.append(block)
+    return block.name, values.shape, values.dtype.str
+
+
+def _publish_engine(engine, blocks):
+    """
+    shared copy of the (exact) normalized embeddings of an engine, compact encodings
+    are published as the exact vectors they were built from when attached
+    """
+    engine = getattr(engine, "exact", None) or engine
+    if sp.issparse(engine.matrix):
+        matrix = engine.matrix.tocsr()
+        arrays = {
+            key: _publish_array(getattr(matrix, key), blocks)
+            for key in ["data", "indices", "indptr"]
+        }
+        return {"sparse": True, "shape": matrix.shape, "arrays": arrays}
+    return {
+        "sparse": False,
+        "shape": engine.matrix.shape,
+        "arrays": {"matrix": _publish_array(engine.matrix, blocks)},
+    }
+
+
+####
+#### WORKER PROCESSES
+####
+
+### embedding type -> engine over the shared embeddings, in every worker process
+_engines = {}
+### the attached blocks, the arrays are only valid as long as they are open
+_attached = []
+
+
+def _attach_array(name, shape, dtype):
+    block = shared_memory.SharedMemory(name=name)
+    _attached.append(block)
+    values = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    values.setflags(write=False)
+    return values
+
+
+def _init_worker(spec):
+    """attach to the published embeddings, once per worker process"""
+    ### one BLAS thread per worker, the pool already uses every core
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    for embed, published in spec.items():
+        arrays = {
+            key: _attach_array(*attach) for key, attach in published["arrays"].items()
+        }
+        if published["sparse"]:
+            matrix = sp.csr_matrix(
+                (arrays["data"], arrays["indices"], arrays["indptr"]),
+                shape=published["shape"],
+            )
+            _engines[embed] = SparseSimilarityEngine(matrix, normalized=True)
+        else:
+            _engines[embed] = SimilarityEngine(arrays["matrix"], normalized=True)
+
+
+def _score(embed, query_rows, k, candidates):
+    return score_block(_engines[embed], query_rows, k, candidates)
+
+
+def _ready():
+    return os.getpid()
+
+
+@contextmanager
+def _main_hidden():
+    """
+    spawned processes import the main module of their parent, which under Streamlit
+    is the page script itself: every worker would run the whole page. the workers
+    only need this module, the main module is hidden while they are started
+    """
+    main = sys.modules.get("__main__")
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+
+class ScoringPool:
+    """
+    Pool of `workers` processes (all cores by default) scoring recommendations over
+    the embeddings of `store`, published once in shared memory. meant to be created
+    once per process, it is closed (and the shared memory released) at exit
+    """
+
+    def __init__(self, store, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.blocks = []
+        self.closed = False
+        spec = {
+            embed: _publish_engine(engine, self.blocks)
+            for embed, engine in store.engines.items()
+        }
+        ### workers are started fresh ("spawn"), forking a process running threads
+        ### (Streamlit, the HTTP server) isn't safe
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(spec,),
+        )
+        atexit.register(self.close)
+        ### start all the workers now rather than on the first recommendations, a
+        ### worker is started by every task submitted while none is idle
+        try:
+            with _main_hidden():
+                futures = [self.executor.submit(_ready) for _ in range(self.workers)]
+            for future in futures:
+                future.result()
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def shared_mb(self):
+        """size of the embeddings shared with the workers"""
+        return sum(block.size for block in self.blocks) / 2**20
+
+    def submit(self, query_rows, k, embed="sbert", candidates=None):
+        """
+        future of `recommender.score_block` run in a worker process, raises
+        `BrokenExecutor` once the pool is closed or a worker died
+        """
+        if self.closed:
+            raise BrokenExecutor("the scoring pool is closed")
+        return self.executor.submit(
+            _score, embed, np.asarray(query_rows), k, candidates
+        )
+
+    def score_block(self, query_rows, k, embed="sbert", candidates=None):
+        """`recommender.score_block` run in a worker process"""
+        return self.submit(query_rows, k, embed, candidates).result()
+
+    def close(self):
+        """stop the workers and release the shared memory, safe to call twice"""
+        self.closed = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
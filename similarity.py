@@ -0,0 +1,207 @@
+""" Vectorized cosine similarity between movie plot embeddings """
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def l2_normalize(vectors):
+    """return a contiguous float32 copy of given vectors with unit length rows"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    ### an empty plot can produce an all-zero vector, leave it as is (score will be 0)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k, exclude=None, min_score=None):
+    """
+    select the `k` highest scores without sorting the whole array, only the selected
+    ones are sorted. `exclude` is an index (or list of indices) that must never be
+    returned e.g. the query movie itself, `min_score` drops weaker matches.
+    returns (indices, scores) in descending order of score
+    """
+    scores = np.asarray(scores)
+    exclude = np.atleast_1d([] if exclude is None else exclude).astype(np.intp)
+    n = len(scores)
+    ### over-select by the number of excluded items so we still end up with `k` of them
+    kk = min(k + len(exclude), n)
+    if k <= 0 or kk == 0:
+        return np.empty(0, dtype=np.intp), scores[:0]
+
+    ### O(n) partial selection, then O(k log k) sort of the selected ones only
+    if kk < n:
+        idx = np.argpartition(scores, n - kk)[n - kk :]
+    else:
+        idx = np.arange(n)
+    idx = idx[np.argsort(-scores[idx], kind="stable")]
+
+    if len(exclude) > 0:
+        idx = idx[~np.isin(idx, exclude)]
+    idx = idx[:k]
+    if min_score is not None:
+        idx = idx[scores[idx] >= min_score]
+    return idx, scores[idx]
+
+
+def batch_top_k(scores, k, exclude=None):
+    """
+    row-wise `top_k` of a 2-D score matrix (one row per query), `exclude` holds one
+    column index per row to skip e.g. the query movie itself (-1 when the row has
+    none). returns (indices, scores) both of shape (n_queries, min(k, n)), or
+    (n_queries, min(k, n - 1)) when some row excludes one of the n columns: rows are
+    kept the same length, so when k >= n the rows without a column to exclude drop
+    their lowest score too
+    """
+    scores = np.asarray(scores)
+    n_queries, n = scores.shape
+    if exclude is not None:
+        exclude = np.asarray(exclude).reshape(-1)
+        if not ((exclude >= 0) & (exclude < n)).any():
+            exclude = None
+    n_excluded = 0 if exclude is None else 1
+    width = max(min(k, n - n_excluded), 0)
+    kk = min(width + n_excluded, n)
+    if width == 0:
+        empty = np.empty((n_queries, 0), dtype=np.intp)
+        return empty, np.take_along_axis(scores, empty, axis=1)
+
+    if kk < n:
+        idx = np.argpartition(scores, n - kk, axis=1)[:, n - kk :]
+    else:
+        idx = np.tile(np.arange(n), (n_queries, 1))
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1, kind="stable")
+    idx = np.take_along_axis(idx, order, axis=1)
+
+    if exclude is not None:
+        ### push the excluded column of every row to the end, keeping the order of rest
+        keep = idx != exclude.reshape(-1, 1)
+        order = np.argsort(~keep, axis=1, kind="stable")
+        idx = np.take_along_axis(idx, order, axis=1)
+    idx = idx[:, :width]
+    return idx, np.take_along_axis(scores, idx, axis=1)
+
+
+class SimilarityEngine:
+    """
+    Hold the corpus embeddings as one contiguous, L2-normalized float32 matrix.
+    Since every row has unit length, cosine similarity of a query against the whole
+    corpus is just a single matrix-vector product.
+    """
+
+    def __init__(self, vectors, normalized=False):
+        if normalized:
+            ### rows already have unit length (e.g. a memory-mapped `.npy` file written
+            ### by `generate_embeddings.py`), float32 input is used without a copy
+            self.matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        else:
+            self.matrix = l2_normalize(vectors)
+        ### the matrix is shared by every caller, make sure nobody modifies it in place
+        self.matrix.setflags(write=False)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def _corpus(self, candidates):
+        """return the full matrix or only the candidate rows of it"""
+        if candidates is None:
+            return self.matrix
+        return self.matrix[candidates]
+
+    def scores(self, query_index, candidates=None):
+        """
+        cosine similarity of the movie at `query_index` against all movies (or only
+        the `candidates` row indices), returns a 1-D array
+        """
+        return self._corpus(candidates) @ self.matrix[query_index]
+
+    def score_vector(self, vector, candidates=None):
+        """cosine similarity of an arbitrary (un-normalized) vector against the corpus"""
+        query = l2_normalize(np.reshape(vector, (1, -1)))[0]
+        return self._corpus(candidates) @ query
+
+    def batch_scores(self, query_indices, candidates=None):
+        """
+        cosine similarity of many movies at once, returns a 2-D array of shape
+        (len(query_indices), n_corpus) computed as one matrix-matrix product
+        """
+        queries = self.matrix[np.asarray(query_indices)]
+        return queries @ self._corpus(candidates).T
+
+    def most_similar(
+        self, query_index, k, candidates=None, exclude_query=True, min_score=None
+    ):
+        """
+        top `k` movies most similar to the movie at `query_index`, optionally only
+        among `candidates` rows. returns (corpus row indices, scores)
+        """
+        scores = self.scores(query_index, candidates=candidates)
+        exclude = None
+        if exclude_query:
+            if candidates is None:
+                exclude = query_index
+            else:
+                exclude = np.flatnonzero(np.asarray(candidates) == query_index)
+        idx, top_scores = top_k(scores, k, exclude=exclude, min_score=min_score)
+        if candidates is not None:
+            idx = np.asarray(candidates)[idx]
+        return idx, top_scores
+
+    def most_similar_vector(self, vector, k, candidates=None, min_score=None):
+        """
+        top `k` movies most similar to an arbitrary vector (e.g. an encoded text
+        query), optionally only among `candidates` rows. returns (corpus row indices,
+        scores)
+        """
+        scores = self.score_vector(vector, candidates=candidates)
+        idx, top_scores = top_k(scores, k, min_score=min_score)
+        if candidates is not None:
+            idx = np.asarray(candidates)[idx]
+        return idx, top_scores
+
+
+def load_sparse_embeddings(file_name):
+    """
+    load a CSR matrix saved by `generate_embeddings.py` as separate data, indices,
+    indptr & shape arrays in a `.npz` file
+    """
+    with np.load(file_name, allow_pickle=False) as data:
+        return sp.csr_matrix(
+            (data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"])
+        )
+
+
+class SparseSimilarityEngine(SimilarityEngine):
+    """
+    `SimilarityEngine` for sparse embeddings (TF-IDF), the corpus stays a CSR matrix
+    with L2-normalized rows so memory is proportional to the number of non-zero terms
+    and a query is scored with a sparse dot product
+    """
+
+    def __init__(self, matrix, normalized=False):
+        matrix = sp.csr_matrix(matrix, dtype=np.float32)
+        if normalized:
+            ### rows already have unit length (e.g. shared by another process), the
+            ### float32 CSR arrays are used without a copy
+            self.matrix = matrix
+            return
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        self.matrix = sp.diags(1.0 / norms).astype(np.float32) @ matrix
+
+    def scores(self, query_index, candidates=None):
+        query = self.matrix[query_index]
+        return (self._corpus(candidates) @ query.T).toarray().ravel()
+
+    def score_vector(self, vector, candidates=None):
+        """cosine similarity of an arbitrary (dense or sparse) vector against corpus"""
+        if not sp.issparse(vector):
+            vector = np.reshape(vector, (1, -1))
+        query = sp.csr_matrix(vector, dtype=np.float32)
+        norm = np.sqrt(query.multiply(query).sum())
+        if norm > 0:
+            query = query / norm
+        return (self._corpus(candidates) @ query.T).toarray().ravel()
+
+    def batch_scores(self, query_indices, candidates=None):
+        queries = self.matrix[np.asarray(query_indices)]
+        return (queries @ self._corpus(candidates).T).toarray()
@@ -0,0 +1,161 @@
+""" Inverted index over movie titles for fast, typo-tolerant & ranked title search """
+
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+import numpy as np
+
+### score of a title token matching a query token, by kind of match
+EXACT, PREFIX, INFIX, TYPO = 1.0, 0.8, 0.6, 0.5
+
+
+def normalize(text):
+    """lower case words of a text without accents or punctuation"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r"\w+", text)
+
+
+def _trigrams(token):
+    return {token[i : i + 3] for i in range(len(token) - 2)}
+
+
+def _within_one_edit(a, b):
+    """
+    whether `a` becomes `b` with at most one insertion, deletion, substitution or swap
+    of two adjacent letters
+    """
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1 :] == b[i + 1 :] or (
+            a[i : i + 2] == b[i : i + 2][::-1] and a[i + 2 :] == b[i + 2 :]
+        )
+    return a[i:] == b[i + 1 :]
+
+
+class TitleIndex:
+    """
+    Token inverted index over normalized titles, meant to be built once per process
+    and shared by every user session. A query token matches a title token exactly,
+    as a prefix, inside it (e.g. "man" in "batman") or with one typo; every query
+    token must match. Titles are ranked by how well their tokens match, then titles
+    equal to or starting with the query, then shorter titles.
+    """
+
+    def __init__(self, titles):
+        postings = defaultdict(list)
+        self.n_tokens = np.empty(len(titles), dtype=np.int32)
+        self.titles = []
+        for row, title in enumerate(titles):
+            tokens = normalize(title)
+            self.titles.append(" ".join(tokens))
+            self.n_tokens[row] = len(tokens)
+            for token in set(tokens):
+                postings[token].append(row)
+        ### sorted vocabulary, the tokens sharing a prefix are next to each other
+        self.vocabulary = sorted(postings)
+        self.postings = [
+            np.array(postings[token], dtype=np.int32) for token in self.vocabulary
+        ]
+        ### trigram -> ids of the tokens containing it, for infix & typo matches
+        trigrams = defaultdict(list)
+        for token_id, token in enumerate(self.vocabulary):
+            for trigram in _trigrams(token):
+                trigrams[trigram].append(token_id)
+        self.trigrams = {
+            t: np.array(ids, dtype=np.int32) for t, ids in trigrams.items()
+        }
+
+    def __len__(self):
+        return len(self.titles)
+
+    def _matching_tokens(self, token):
+        """ids of the vocabulary tokens matching a query token, with their score"""
+        matches = {}
+        ### prefix matches are a contiguous run of the sorted vocabulary
+        start = bisect_left(self.vocabulary, token)
+        for token_id in range(start, len(self.vocabulary)):
+            if not self.vocabulary[token_id].startswith(token):
+                break
+            matches[token_id] = EXACT if self.vocabulary[token_id] == token else PREFIX
+        if len(token) < 3:
+            return matches
+
+        ### infix: tokens containing every trigram of the query token
+        token_trigrams = _trigrams(token)
+        candidates = None
+        for trigram in token_trigrams:
+            ids = self.trigrams.get(trigram)
+            if ids is None:
+                candidates = None
+                break
+            candidates = ids if candidates is None else np.intersect1d(candidates, ids)
+        for token_id in [] if candidates is None else candidates.tolist():
+            if token_id not in matches and token in self.vocabulary[token_id]:
+                matches[token_id] = INFIX
+
+        ### typo: tokens sharing a trigram and within one edit, for longer tokens only
+        if len(token) >= 4:
+            shared = [self.trigrams[t] for t in token_trigrams if t in self.trigrams]
+            for token_id in (
+                np.unique(np.concatenate(shared)).tolist() if shared else []
+            ):
+                if token_id not in matches and _within_one_edit(
+                    token, self.vocabulary[token_id]
+                ):
+                    matches[token_id] = TYPO
+        return matches
+
+    def search(self, query, rows=None, limit=None):
+        """
+        rows of the titles matching all the words of `query`, best match first,
+        optionally only among `rows` (e.g. an already filtered subset of the catalog)
+        """
+        tokens = normalize(query)
+        if not tokens:
+            return np.empty(0, dtype=np.int64)
+        scores = None
+        for token in tokens:
+            ### best score of any matching title token, for every title
+            token_scores = {}
+            for token_id, score in self._matching_tokens(token).items():
+                for row in self.postings[token_id].tolist():
+                    if score > token_scores.get(row, 0):
+                        token_scores[row] = score
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {
+                    row: scores[row] + score
+                    for row, score in token_scores.items()
+                    if row in scores
+                }
+            if not scores:
+                return np.empty(0, dtype=np.int64)
+
+        matched = np.fromiter(scores, dtype=np.int64, count=len(scores))
+        if rows is not None and len(rows) < len(self):
+            matched = matched[np.isin(matched, np.asarray(rows))]
+        if len(matched) == 0:
+            return matched
+        ### whole title equal to / starting with the query gets a bonus
+        normalized = " ".join(tokens)
+        relevance = np.array(
+            [
+                scores[row]
+                + (0.5 if self.titles[row] == normalized else 0.0)
+                + (0.2 if self.titles[row].startswith(normalized) else 0.0)
+                for row in matched.tolist()
+            ]
+        )
+        ### most relevant first, then shorter titles, then catalog order
+        order = np.lexsort((matched, self.n_tokens[matched], -relevance))
+        matched = matched[order]
+        return matched if limit is None else matched[:limit]
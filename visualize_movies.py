@@ -1,41 +1,65 @@
+import time
+
+### start of this page's imports, the first run in a process reports how long they
+### took (see `instrumentation.page_imported`)
+IMPORT_START = time.perf_counter()
+
 import streamlit as st
-import pandas as pd
-import plotly.express as px
+from instrumentation import (
+    page_imported,
+    page_rendered,
+    render_timing_panel,
+    start_metrics_server,
+    start_trace,
+    timed,
+    timer,
+    timing_requested,
+)
+from plot_data import figure_2d, figure_3d, level_of_detail, load_plot_points
+from warmup import warm_up_app
 
+### most movies drawn as individual points, a larger view shows a density overview
+### with a sample of the movies on top, zoom in to see every movie of a region
+MAX_POINTS = 20_000
+### resolution of the density overview (bins per axis)
+DENSITY_BINS = 200
+### most movies drawn in the 3-D view, thinned evenly over the map
+MAX_POINTS_3D = 20_000
 
-@st.cache_data
+
+@timed("load_umap_data")
+@st.cache_resource
 def _load_data(file_name):
-    """Load the parquet file with plots, TF-IDF & BERT vector"""
-    df = pd.read_parquet(file_name)
-    return df
-
-
-@st.cache_data
-def _plot_movies(df):
-    """plot a scatter plot of movies"""
-    ### plot the UMAP produced data in 3-D
-    fig_3d = px.scatter_3d(
-        data_frame=df,
-        x="comp_1",
-        y="comp_2",
-        z="comp_3",
-        hover_name="title",
-        hover_data=["url"],
-        height=1000,
-        opacity=0.7,
-    ).update_layout(margin=dict(l=-0, r=-0, b=0, t=0))
-
-    ### plot the UMAP produced data in 2-D
-    fig_2d = px.scatter(
-        data_frame=df,
-        x="comp_1",
-        y="comp_2",
-        hover_name="title",
-        hover_data=["url"],
-        height=800,
-        opacity=0.7,
-    ).update_layout(margin=dict(l=-0, r=-0, b=0, t=0))
-    return fig_3d, fig_2d
+    """
+    Load the UMAP coordinates, titles & urls once per process, the returned points
+    are read-only and shared by all user sessions
+    """
+    return load_plot_points(file_name)
+
+
+@timed("plot_movies")
+@st.cache_resource(max_entries=64)
+def _plot_movies(choice, x_range=None, y_range=None):
+    """
+    build only the selected figure of the movies (for the given 2-D view ranges),
+    returns (figure, number of movies drawn, number in view, whether the view is a
+    density overview, size of the figure JSON sent to the browser in bytes, ms spent)
+    """
+    start = time.perf_counter()
+    points = _load_data("artifacts/umap_reduced_data.parquet")
+    if choice == "2-D":
+        lod = level_of_detail(
+            points, x_range, y_range, max_points=MAX_POINTS, bins=DENSITY_BINS
+        )
+        fig = figure_2d(points, lod)
+        n_drawn, n_visible = len(lod["rows"]), lod["n_visible"]
+        overview = lod["density"] is not None
+    else:
+        fig = figure_3d(points, max_points=MAX_POINTS_3D)
+        n_drawn, n_visible, overview = len(fig.data[0].x), len(points), False
+    payload = len(fig.to_json())
+    build_ms = (time.perf_counter() - start) * 1000
+    return fig, n_drawn, n_visible, overview, payload, build_ms
 
 
 def init(title, icon):
@@ -53,29 +77,80 @@ def init(title, icon):
     col2.image("images/logo.png", width=100)
     st.divider()
 
-    ### load data & initialize session state
-    df = _load_data("artifacts/umap_reduced_data.parquet")
-    if "umap_data" not in st.session_state:
-        st.session_state["umap_data"] = df
+    ### load data once per process, sessions only keep their view ranges
+    _load_data("artifacts/umap_reduced_data.parquet")
+
 
+def _render_zoom(points):
+    """comp_1 & comp_2 ranges of the 2-D view, None for the whole map"""
+    (x_min, x_max), (y_min, y_max) = points.bounds()
+    with st.expander("Zoom into a region...", expanded=False):
+        x_range = st.slider(
+            "comp_1 range:",
+            min_value=x_min,
+            max_value=x_max,
+            value=(x_min, x_max),
+            step=(x_max - x_min) / 100 or 1.0,
+        )
+        y_range = st.slider(
+            "comp_2 range:",
+            min_value=y_min,
+            max_value=y_max,
+            value=(y_min, y_max),
+            step=(y_max - y_min) / 100 or 1.0,
+        )
+    if x_range == (x_min, x_max) and y_range == (y_min, y_max):
+        return None, None
+    return x_range, y_range
 
+
+@timed("render_page")
 def render_page():
+    points = _load_data("artifacts/umap_reduced_data.parquet")
     choice = st.radio("Graph Type:", ["2-D", "3-D"])
-    fig_3d, fig_2d = _plot_movies(st.session_state["umap_data"])
+    x_range, y_range = None, None
     if choice == "2-D":
-        fig = fig_2d
-    else:
-        fig = fig_3d
-    st.plotly_chart(fig, use_container_width=True)
+        x_range, y_range = _render_zoom(points)
+    fig, n_drawn, n_visible, overview, payload, build_ms = _plot_movies(
+        choice, x_range, y_range
+    )
+    ### the figure is serialized to JSON & sent to the browser here
+    start = time.perf_counter()
+    with timer("plotly_chart"):
+        st.plotly_chart(fig, use_container_width=True)
+    send_ms = (time.perf_counter() - start) * 1000
+
+    if overview:
+        st.info(
+            f"Density of the {n_visible} movies in view with {n_drawn} of them on top, "
+            f"zoom into a region with at most {MAX_POINTS} movies to see all of them."
+        )
+    elif n_drawn < n_visible:
+        st.info(f"{n_drawn} of {n_visible} movies shown, evenly thinned.")
     st.info("Use the toolbar at top right to zoom/pan into the graph.")
+    st.caption(
+        f"Figure: {payload / 1024:.0f} KB sent, built in {build_ms:.0f} ms "
+        f"(cached after the first time), sent in {send_ms:.0f} ms"
+    )
 
 
 ####
 #### MAIN APP FLOW
 ####
 
+### time this rerun when asked for, see `instrumentation.py`
+page_imported("visualize", IMPORT_START)
+start_trace("visualize", timing_requested())
+start_metrics_server()
+### imports & artifacts of the other pages are loaded in the background
+warm_up_app()
+
 ### initialize page title, icon, app data and session_state
 init(title="Movie Buddy", icon="🎥")
 
 ### build page UI and show content
 render_page()
+page_rendered("visualize")
+
+### show where the time of this rerun went, only when timed
+render_timing_panel()
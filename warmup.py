@@ -0,0 +1,113 @@
+"""
+Warm-up of a fresh app process (e.g. a container just started by autoscaling): the
+first page rendered queues the heavy imports & the artifact files the pages need in
+a background thread, which imports the modules and reads the files into the OS page
+cache while the page is shown, so the first render of the other pages (and the first
+free-text search) doesn't wait on imports & disk. Every task runs once per process,
+its time is logged (`movie_buddy.timing` logger) and exported with the metrics.
+"""
+
+import importlib
+import importlib.util
+import json
+import os
+import queue
+import threading
+import time
+from instrumentation import METRICS, logger
+
+### modules imported by the pages after their first render, when installed
+MODULES = ["pyarrow.parquet", "scipy.sparse", "plotly.graph_objects"]
+### embeddings loaded by the pages, only from the file `movie_store.load_engine` uses
+EMBEDDINGS = ["sbert", "tfidf"]
+### other artifacts loaded by the pages, when they exist
+ARTIFACTS = [
+    "movie_plots.parquet",
+    "sbert_neighbors.parquet",
+    "tfidf_neighbors.parquet",
+    "sbert_ivf_index.npz",
+    "sbert_clusters.npz",
+    "umap_reduced_data.parquet",
+]
+### files are read in chunks of this many bytes, only to get them in the page cache
+CHUNK_SIZE = 8 * 2**20
+
+_lock = threading.Lock()
+_queued = set()
+_tasks = queue.Queue()
+_thread = None
+
+
+def _run():
+    while True:
+        name, fn = _tasks.get()
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            ### a failed warm-up only means the page pays the cost itself
+            logger.warning(f"warm-up [{name}] failed: {e!r}")
+            continue
+        seconds = time.perf_counter() - start
+        METRICS.observe(f"warmup_{name}", seconds)
+        logger.info(json.dumps({"warmup": name, "ms": seconds * 1000}))
+
+
+def warm_up(name, fn):
+    """run `fn()` in the background warm-up thread, once per process per `name`"""
+    global _thread
+    with _lock:
+        if name in _queued:
+            return
+        _queued.add(name)
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="warmup", daemon=True)
+            _thread.start()
+    _tasks.put((name, fn))
+
+
+def _import(name):
+    if importlib.util.find_spec(name.split(".")[0]) is not None:
+        importlib.import_module(name)
+        if name == "plotly.graph_objects":
+            ### trace classes & their validators are only imported on first use
+            import plotly.graph_objects as go
+
+            go.Figure([go.Scattergl(), go.Heatmap(), go.Scatter3d()])
+
+
+def _read(file_name):
+    if os.path.exists(file_name):
+        with open(file_name, "rb") as f:
+            while f.read(CHUNK_SIZE):
+                pass
+
+
+def _read_embeddings(artifacts_dir, embed):
+    from movie_store import embeddings_file
+
+    file_name = embeddings_file(artifacts_dir, embed)
+    ### a `.npy` matrix is memory-mapped, only the pages scoring touches are read
+    if file_name is not None and not file_name.endswith(".npy"):
+        _read(file_name)
+
+
+def warm_up_app(
+    artifacts_dir="artifacts",
+    modules=MODULES,
+    embeddings=EMBEDDINGS,
+    artifacts=ARTIFACTS,
+):
+    """queue the imports & artifacts shared by the pages, called by every page"""
+    for name in modules:
+        warm_up(f"import_{name}", lambda name=name: _import(name))
+    for embed in embeddings:
+        warm_up(
+            f"read_{embed}_embeddings",
+            lambda embed=embed: _read_embeddings(artifacts_dir, embed),
+        )
+    for file_name in artifacts:
+        warm_up(
+            f"read_{file_name}",
+            lambda file_name=file_name: _read(os.path.join(artifacts_dir, file_name)),
+        )